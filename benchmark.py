@@ -0,0 +1,301 @@
+import argparse
+import glob
+import os
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+def best_of(func, repeat=3):
+    '''Run func repeat times and return (best elapsed seconds, last result)'''
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def report(name, reference, candidate, error=None):
+    line = f'{name}: {reference*1e3:.1f} ms -> {candidate*1e3:.1f} ms ({reference/candidate:.1f}x)'
+    if error is not None:
+        line += f', max abs difference {error:.2e}'
+    print(line)
+
+def bench_trend(args):
+    '''moving_trend against statsmodels seasonal_decompose, as used by pv_det_sea'''
+    from statsmodels.tsa.seasonal import seasonal_decompose
+    from denoise import moving_trend
+
+    rng = np.random.default_rng(0)
+    x = np.cumsum(rng.standard_normal((args.n_samples, args.channels)), axis=0)
+    for period in (int(0.25*args.fs), int(2*args.fs)):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            reference, expected = best_of(lambda: seasonal_decompose(x, model='additive', extrapolate_trend='freq',
+                                                                     period=period).trend, args.repeat)
+        candidate, trend = best_of(lambda: moving_trend(x, period), args.repeat)
+        report(f'trend, period {period}', reference, candidate, np.abs(trend - expected).max())
+        candidate, trend = best_of(lambda: moving_trend(x, period, dtype=np.float32), args.repeat)
+        report(f'trend float32, period {period}', reference, candidate, np.abs(trend - expected).max())
+
+# Per-channel implementations the notebooks used before utils handled (n, C) arrays
+
+def legacy_despike(arr, window_size, threshold):
+    pad_size = window_size // 2
+    arr_padded = np.pad(arr, pad_size, mode='reflect')
+    arr_rolled = np.convolve(arr_padded, np.ones(window_size)/window_size, mode='same')
+    spikes = np.abs(arr-arr_rolled[pad_size:-pad_size]) > threshold
+    arr_despiked = np.copy(arr)
+    arr_despiked[spikes] = arr_rolled[pad_size:-pad_size][spikes]
+    return arr_despiked
+
+def legacy_detrend_linear(arr):
+    from sklearn.linear_model import LinearRegression
+    x = np.arange(len(arr)).reshape(-1, 1)
+    return arr - LinearRegression().fit(x, arr).predict(x).flatten()
+
+def legacy_detrend_polyfit(arr):
+    # The same per-channel least-squares line without sklearn
+    x = np.arange(len(arr))
+    return arr - np.polyval(np.polyfit(x, arr, 1), x)
+
+def legacy_bandpass(arr):
+    from scipy.signal import butter, sosfiltfilt
+    sos = butter(2, [0.1, 20], 'bandpass', output='sos', fs=1000)
+    return sosfiltfilt(sos, arr)
+
+def legacy_frame(frame):
+    # The swallowing cell of adapGRU.ipynb before upsampling: columns pv0..pv3, roll, pitch, yaw,
+    # one channel and one filter design at a time
+    from scipy.signal import butter, sosfiltfilt
+    frame = frame.copy()
+    for c in (5, 6):
+        frame[:, c] -= sosfiltfilt(butter(3, 2, btype='lowpass', output='sos', fs=1000), frame[:, c])
+    for c in (4, 5, 6):
+        frame[:, c] = legacy_despike(frame[:, c], 10, 0.2)
+    for c in range(4):
+        frame[:, c] = sosfiltfilt(butter(3, [0.1, 3], btype='bandpass', output='sos', fs=1000), frame[:, c])
+    for c in (4, 5, 6):
+        frame[:, c] = sosfiltfilt(butter(2, [3, 7], btype='bandstop', output='sos', fs=1000), frame[:, c])
+    return frame
+
+def batched_frame(frame):
+    import utils
+    frame = frame.copy()
+    frame[:, 5:7] = utils.detrend(frame[:, 5:7], method='butter', fc=2)
+    frame[:, 4:7] = utils.despike(frame[:, 4:7], 10, 0.2)
+    frame[:, :4] = utils.butter_filter(frame[:, :4], 3, [0.1, 3], 'bandpass')
+    frame[:, 4:7] = utils.butter_filter(frame[:, 4:7], 2, [3, 7], 'bandstop')
+    return frame
+
+def bench_preprocess(args):
+    '''Batched utils preprocessing on one frame against a loop over its channels'''
+    import utils
+
+    rng = np.random.default_rng(0)
+    frame = np.cumsum(rng.standard_normal((args.frame, args.channels)), axis=0)
+    frame[::97] += 5
+    per_channel = lambda func: lambda: np.column_stack([func(frame[:, c]) for c in range(frame.shape[1])])
+    cases = [('despike', per_channel(lambda x: legacy_despike(x, 10, 0.2)), lambda: utils.despike(frame, 10, 0.2)),
+             ('detrend linear', per_channel(legacy_detrend_linear), lambda: utils.detrend(frame)),
+             ('detrend linear (polyfit)', per_channel(legacy_detrend_polyfit), lambda: utils.detrend(frame)),
+             ('bandpass', per_channel(legacy_bandpass), lambda: utils.butter_filter(frame, 2, [0.1, 20], 'bandpass'))]
+    if frame.shape[1] == 7:
+        cases.append(('swallowing cell', lambda: legacy_frame(frame), lambda: batched_frame(frame)))
+    for name, legacy, batched in cases:
+        try:
+            reference, expected = best_of(legacy, args.repeat * 10)
+        except ImportError as e:
+            print(f'{name}: skipped, {e}')
+            continue
+        candidate, result = best_of(batched, args.repeat * 10)
+        report(f'{name}, {frame.shape}', reference, candidate, np.abs(result - expected).max())
+
+def legacy_peak_expand(peaks, n, max):
+    return np.array([list(range(peak - n//2, peak + n//2)) for peak in peaks
+                     if all(0 < x < max for x in range(peak - n//2, peak + n//2))])
+
+def legacy_windows(data, peaks, width):
+    expanded_peaks = legacy_peak_expand(peaks, width, len(data))
+    slices = np.array([data[expanded_peaks[idx, :]] for idx in range(len(expanded_peaks))])
+    return np.transpose(slices, (0, 2, 1))
+
+def peak_memory(func):
+    '''Peak bytes allocated by func'''
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def bench_windows(args):
+    '''Peak-centered windows through utils.peak_windows against peak_expand index arrays'''
+    import utils
+
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((args.n_samples, args.channels))
+    peaks = np.sort(rng.choice(args.n_samples, args.n_samples // args.frame, replace=False))
+    reference, expected = best_of(lambda: legacy_windows(data, peaks, args.frame), args.repeat)
+    candidate, windows = best_of(lambda: utils.peak_windows(data, peaks, args.frame), args.repeat)
+    report(f'peak windows, {windows.shape}', reference, candidate, np.abs(windows - expected).max())
+    print(f'peak windows memory: {peak_memory(lambda: legacy_windows(data, peaks, args.frame))/1e6:.0f} MB -> '
+          f'{peak_memory(lambda: utils.peak_windows(data, peaks, args.frame))/1e6:.0f} MB '
+          f'(windows {windows.nbytes/1e6:.0f} MB)')
+
+def legacy_filter_windows(all_windows):
+    window_to_keep = np.ones(all_windows.shape[0])
+    avg = np.mean(all_windows, axis=0)
+    std = np.std(all_windows, axis=0)
+    for window_idx, window in enumerate(all_windows):
+        for idx, val in enumerate(window):
+            if np.abs(val-avg[idx]) > 3*std[idx]:
+                window_to_keep[window_idx] = 0
+    return window_to_keep
+
+def bench_filter(args):
+    '''utils.filter_windows on an (n, C, W) stack against the per-position loop of the notebooks'''
+    import utils
+    from streaming import StreamingWindowFilter
+
+    rng = np.random.default_rng(0)
+    windows = rng.uniform(-1, 1, (args.n_samples // args.frame, args.channels, args.frame))
+    windows[rng.integers(0, len(windows), 5), :, rng.integers(0, args.frame, 5)] += 10
+    legacy = lambda: np.all([legacy_filter_windows(position) for position in np.transpose(windows, (2, 0, 1))],
+                            axis=0)
+    reference, expected = best_of(legacy, 1)
+    for name, candidate_func in [('std', lambda: utils.filter_windows(windows)),
+                                 ('streaming', lambda: StreamingWindowFilter(min_windows=len(windows)).push(windows)[1])]:
+        candidate, keep = best_of(candidate_func, args.repeat)
+        report(f'filter windows {name}, {windows.shape}', reference, candidate, np.abs(keep.astype(float) - expected).max())
+    candidate, keep = best_of(lambda: utils.filter_windows(windows, criterion='mad'), args.repeat)
+    print(f'filter windows mad: {candidate*1e3:.1f} ms, keeps {keep.sum()} of {len(keep)} (std keeps {int(expected.sum())})')
+
+def legacy_upsample(timestamp, arr, ratio=10):
+    from scipy import interpolate
+    f = interpolate.interp1d(timestamp, arr)
+    timestamp_upsampled = np.linspace(start=timestamp[0], stop=timestamp[-1], num=int(np.around((len(timestamp)+1)*ratio+1)))
+    return timestamp_upsampled, f(timestamp_upsampled)
+
+def legacy_upsample_columns(timestamps, data_combined, ratio):
+    data = np.zeros((int(np.around((len(timestamps) + 1) * ratio + 1)), data_combined.shape[1]))
+    for i in range(data_combined.shape[1]):
+        _, data[:, i] = legacy_upsample(timestamps, data_combined[:, i], ratio=ratio)
+    timestamps, _ = legacy_upsample(timestamps, timestamps, ratio=ratio)
+    return timestamps, data
+
+def bench_upsample(args):
+    '''Single-call float32 upsampling against one utils.upsample per column, on the longest dataset csv'''
+    import pandas as pd
+    import utils
+
+    paths = sorted(glob.glob(os.path.join('dataset', '**', '*.csv'), recursive=True), key=os.path.getsize)
+    if paths:
+        raw = pd.read_csv(paths[-1], delimiter=',', header=None).to_numpy(dtype=float)
+        print(f'upsample: {paths[-1]}, {raw.shape}')
+    else:
+        rng = np.random.default_rng(0)
+        raw = np.column_stack([np.arange(args.n_samples // 100) * 100., rng.standard_normal((args.n_samples // 100, 7))])
+    timestamps, values = raw[:, 0] - raw[0, 0], raw[:, 1:]
+    ratio = 100
+    peaks = np.linspace(args.frame, (len(timestamps) - 1) * ratio - args.frame, 50).astype(int)
+
+    _, expected = legacy_upsample_columns(timestamps, values, ratio)
+    windows = utils.peak_expand(peaks, args.frame, len(expected))
+    def chunked():
+        # e.g. the maximum of channel 0, one chunk at a time
+        return max(chunk[:, 0].max() for _, chunk in utils.upsample_chunks(timestamps, values, ratio))
+    cases = [('float64', lambda: utils.upsample(timestamps, values, ratio)[1], expected),
+             ('float32', lambda: utils.upsample(timestamps, values, ratio, dtype=np.float32)[1], expected),
+             ('chunks', chunked, expected[:, 0].max()),
+             ('around peaks', lambda: utils.upsample_at(timestamps, values, windows, ratio), expected[windows])]
+    legacy = lambda: legacy_upsample_columns(timestamps, values, ratio)
+    reference, _ = best_of(legacy, args.repeat)
+    legacy_memory = peak_memory(legacy)
+    for name, func, reference_result in cases:
+        candidate, result = best_of(func, args.repeat)
+        report(f'upsample {name}', reference, candidate, np.abs(result - reference_result).max())
+        print(f'upsample {name} memory: {legacy_memory/1e6:.0f} MB -> {peak_memory(func)/1e6:.0f} MB')
+
+def bench_loader(args):
+    '''DataLoader epoch over the memory-mapped LHMMemmapDataset against the pickled LHMDualDataset'''
+    try:
+        import torch
+        from torch.utils.data import DataLoader
+    except ImportError as e:
+        print(f'loader: skipped, {e}')
+        return
+    from lhm_dataset import LHMBatchSampler, LHMDualDataset, LHMMemmapDataset, write_memmap
+
+    rng = np.random.default_rng(0)
+    n_windows = max(args.n_samples // args.frame, 32)
+    windows = rng.standard_normal((n_windows, 7, args.frame))
+    labels = rng.integers(0, 4, n_windows)
+    batch_size = 32
+
+    def epoch(loader):
+        n = 0
+        for pv, euler, label in loader:
+            n += len(label)
+        return n
+
+    with tempfile.TemporaryDirectory() as directory:
+        # As the notebook builds it: float64 features, pickled with torch.save
+        torch.save(LHMDualDataset(torch.tensor(windows), torch.tensor(labels)[:, None]),
+                   os.path.join(directory, 'dual.pt'))
+        write_memmap(os.path.join(directory, 'dual'), windows, labels)
+
+        def legacy():
+            ds = torch.load(os.path.join(directory, 'dual.pt'), weights_only=False)
+            return epoch(DataLoader(ds, batch_size=batch_size, shuffle=True))
+        def memmap(block_batches=1):
+            ds = LHMMemmapDataset(os.path.join(directory, 'dual'))
+            sampler = LHMBatchSampler(len(ds), batch_size, shuffle=True, block_batches=block_batches)
+            return epoch(DataLoader(ds, sampler=sampler, batch_size=None))
+        reference, n = best_of(legacy, args.repeat)
+        candidate, _ = best_of(memmap, args.repeat)
+        mixed, _ = best_of(lambda: memmap(block_batches=8), args.repeat)
+        report(f'loader epoch, {n} windows of {args.frame}', reference, candidate)
+        report('loader epoch, batches mixed in blocks of 8', reference, mixed)
+        print(f'loader: {n/reference:.0f} -> {n/candidate:.0f} samples/s, {n/mixed:.0f} with mixed batches')
+
+BENCHMARKS = {'trend': bench_trend,
+              'preprocess': bench_preprocess,
+              'windows': bench_windows,
+              'filter': bench_filter,
+              'upsample': bench_upsample,
+              'loader': bench_loader}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the preprocessing functions.')
+    parser.add_argument('names', nargs='*',
+                        help=f'Benchmarks to run among {", ".join(BENCHMARKS)}, default all')
+    parser.add_argument('-n', '--n-samples',
+                        help='Samples per channel, default 1000000',
+                        default=1000000, type=int)
+    parser.add_argument('-c', '--channels',
+                        help='Number of channels, default 7',
+                        default=7, type=int)
+    parser.add_argument('-f', '--frame',
+                        help='Samples per frame in the preprocessing benchmarks, default 3000',
+                        default=3000, type=int)
+    parser.add_argument('--fs',
+                        help='Sampling frequency, default 1000',
+                        default=1000, type=int)
+    parser.add_argument('-r', '--repeat',
+                        help='Runs per function, default 3',
+                        default=3, type=int)
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+    return args
+
+def main():
+    args = parse_args()
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name](args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+'''Build the LHMDualDataset windows of whole subject folders, one shard per recording.
+
+Every recording whose name has a recipe (RECORDING_RECIPES) goes through the
+pipeline.py recipe in a process pool and becomes a .npz shard of float32
+windows [n, 7, n_points] and int64 labels [n]. manifest.json lists the shards
+with the checksum, size and mtime of their source and the hash of their
+stages and of the pipeline code. A rebuild only processes the recordings of
+the given subjects that are new or whose source, stages or code changed, so
+adding a subject costs that subject alone.
+
+The trims of the recipes were picked on the yihan_20231130 recordings, other
+subjects are not trimmed. SUBJECT_OVERRIDES tunes the stages of a subject,
+e.g. its trims or peak distances.
+'''
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from catalog import sha1sum
+from pipeline import CODE_VERSION, RECIPES, Pipeline, override
+
+OUTPUT_DIR = os.path.join('dataset', 'preprocessed')
+MANIFEST_FILE = 'manifest.json'
+
+# Recording file name -> recipe of pipeline.RECIPES. The notebook labels running as JUMPING_JACK.
+RECORDING_RECIPES = {'swallow': 'swallowing',
+                     'swallowing': 'swallowing',
+                     'dry_cough': 'dry_cough',
+                     'throat_clearing': 'throat_clearing',
+                     'running': 'running',
+                     'jumping_jack': 'running'}
+
+# Subjects the trims of the recipes were picked on
+TRIMMED_SUBJECTS = ('yihan_20231130',)
+# Subject folder -> recipe -> pipeline.override assignments, e.g.
+# {'tano': {'running': ['load.trim=[100, 700]', 'find_peaks.distance=600']}}
+SUBJECT_OVERRIDES = {}
+
+
+def recording_stages(path, recipe):
+    '''Stages of the recipe for the subject of path'''
+    subject = os.path.basename(os.path.dirname(path))
+    stages = RECIPES[recipe]['stages']
+    if subject not in TRIMMED_SUBJECTS:
+        stages = override(stages, 'load.trim=[0, null]')
+    for assignment in SUBJECT_OVERRIDES.get(subject, {}).get(recipe, []):
+        stages = override(stages, assignment)
+    return stages
+
+
+def recipe_hash(stages):
+    return hashlib.sha1(json.dumps([CODE_VERSION, stages], sort_keys=True).encode()).hexdigest()
+
+
+def find_recordings(root, subjects):
+    '''(path, recipe) of the csvs with a recipe in the subject folders'''
+    recordings = []
+    for subject in subjects:
+        for name in sorted(os.listdir(os.path.join(root, subject))):
+            stem, ext = os.path.splitext(name)
+            if ext == '.csv' and stem in RECORDING_RECIPES:
+                recordings.append((os.path.join(root, subject, name), RECORDING_RECIPES[stem]))
+    return recordings
+
+
+def build_shard(path, recipe, shard):
+    '''Run the recipe on one recording and write its shard, returns its manifest entry'''
+    start = time.perf_counter()
+    stat = os.stat(path)
+    stages = recording_stages(path, recipe)
+    state = Pipeline(stages).run(path)
+    windows = state['windows'].astype(np.float32)
+    labels = np.full(len(windows), RECIPES[recipe]['label'], dtype=np.int64)
+    os.makedirs(os.path.dirname(shard), exist_ok=True)
+    tmp = f'{shard}.{os.getpid()}.tmp.npz'
+    np.savez(tmp, windows=windows, labels=labels)
+    os.replace(tmp, shard)
+    return {'source': path,
+            'bytes': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha1': sha1sum(path),
+            'recipe': recipe,
+            'recipe_hash': recipe_hash(stages),
+            'shard': shard,
+            'n_windows': len(windows),
+            'shape': list(windows.shape[1:]),
+            'label': RECIPES[recipe]['label'],
+            'elapsed': time.perf_counter() - start}
+
+
+def load_manifest(out_dir=OUTPUT_DIR):
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {entry['source']: entry for entry in json.load(f)}
+
+
+def save_manifest(manifest, out_dir=OUTPUT_DIR):
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(sorted(manifest.values(), key=lambda entry: entry['source']), f, indent=1)
+    os.replace(tmp, path)
+
+
+def is_current(entry, path, recipe):
+    '''Whether the manifest entry is the shard of path as it is now, with the current stages and code
+
+    An entry whose source was only touched gets the new mtime.
+    '''
+    if entry is None or entry['recipe_hash'] != recipe_hash(recording_stages(path, recipe)) \
+            or not os.path.exists(entry['shard']):
+        return False
+    stat = os.stat(path)
+    if entry['bytes'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return True
+    # Touched but maybe not changed, e.g. after a checkout
+    if entry['sha1'] != sha1sum(path):
+        return False
+    entry['mtime'] = stat.st_mtime
+    return True
+
+
+def build(subjects, root='dataset', out_dir=OUTPUT_DIR, jobs=None, force=False):
+    '''Build the stale shards of the subjects in parallel and update the manifest
+
+    Returns:
+        dict: the manifest, by source path
+    '''
+    manifest = load_manifest(out_dir)
+    recordings = find_recordings(root, subjects)
+    stale = [(path, recipe) for path, recipe in recordings
+             if force or not is_current(manifest.get(path), path, recipe)]
+    print(f'{len(recordings)} recordings in {", ".join(subjects)}, {len(stale)} to build')
+
+    # Recordings of these subjects that were deleted or lost their recipe
+    found = {path for path, _ in recordings}
+    subject_dirs = {os.path.join(root, subject) for subject in subjects}
+    for path in [path for path in manifest if os.path.dirname(path) in subject_dirs and path not in found]:
+        if os.path.exists(manifest[path]['shard']):
+            os.remove(manifest[path]['shard'])
+        del manifest[path]
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(build_shard, path, recipe,
+                                   os.path.join(out_dir, 'shards', os.path.relpath(path, root)[:-len('.csv')] + '.npz'))
+                   for path, recipe in stale]
+        for future in as_completed(futures):
+            entry = future.result()
+            manifest[entry['source']] = entry
+            print(f'{entry["source"]}: {entry["n_windows"]} windows, label {entry["label"]} in {entry["elapsed"]:.2f} s')
+    if stale:
+        print(f'built {len(stale)} shards in {time.perf_counter() - start:.2f} s')
+    os.makedirs(out_dir, exist_ok=True)
+    save_manifest(manifest, out_dir)
+    return manifest
+
+
+def load_windows(manifest, subjects=None, root='dataset'):
+    '''(windows [N, 7, n_points] float32, labels [N]) of the shards in the manifest, or only those of the given subjects'''
+    entries = sorted(manifest.values(), key=lambda entry: entry['source'])
+    if subjects is not None:
+        subject_dirs = {os.path.join(root, subject) for subject in subjects}
+        entries = [entry for entry in entries if os.path.dirname(entry['source']) in subject_dirs]
+    windows, labels = [], []
+    for entry in entries:
+        with np.load(entry['shard']) as shard:
+            windows.append(shard['windows'])
+            labels.append(shard['labels'])
+    return np.concatenate(windows), np.concatenate(labels)
+
+
+def load_dataset(manifest, subjects=None, root='dataset'):
+    '''LHMDualDataset of the shards in the manifest, or only those of the given subjects'''
+    import torch
+    from lhm_dataset import LHMDualDataset
+
+    windows, labels = load_windows(manifest, subjects, root)
+    return LHMDualDataset(torch.from_numpy(windows), torch.from_numpy(labels)[:, None])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build the dataset shards of subject folders.')
+    parser.add_argument('subjects', nargs='*',
+                        help='Subject folders under the dataset root, default yihan_20231130',
+                        default=['yihan_20231130'])
+    parser.add_argument('-r', '--root',
+                        help='Dataset folder, default dataset',
+                        default='dataset')
+    parser.add_argument('-d', '--out-dir',
+                        help=f'Shards and manifest folder, default {OUTPUT_DIR}',
+                        default=OUTPUT_DIR)
+    parser.add_argument('-j', '--jobs',
+                        default=os.cpu_count(),
+                        help='Worker processes, default one per core',
+                        type=int)
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help='Rebuild the shards that are up to date too.')
+    parser.add_argument('-o', '--output',
+                        help='Also save the LHMDualDataset of these subjects with torch.save, e.g. '
+                             'dataset/preprocessed/yihan_dual.pt')
+    parser.add_argument('-m', '--memmap',
+                        help='Also lay out the windows of these subjects for LHMMemmapDataset in this folder, e.g. '
+                             'dataset/preprocessed/yihan_dual')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    manifest = build(args.subjects, args.root, args.out_dir, args.jobs, args.force)
+    if args.output:
+        import torch
+        dataset = load_dataset(manifest, args.subjects, args.root)
+        torch.save(dataset, args.output)
+        print(f'{args.output}: {tuple(dataset.features.shape)}')
+    if args.memmap:
+        from lhm_dataset import write_memmap
+        windows, labels = load_windows(manifest, args.subjects, args.root)
+        write_memmap(args.memmap, windows, labels)
+        print(f'{args.memmap}: {len(windows)} windows')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+'''Catalog of the recordings under dataset/ and a binary cache of their parsed arrays.
+
+The catalog (dataset/catalog.json) has one entry per csv: path, subject (the
+folder), activity label and date taken from the file and folder names, rows,
+timestamp range and restarts, duration, median sampling rate, size, mtime and
+sha1. Empty or header-only csvs get 0 rows and null timestamps. A scan only
+re-reads the files whose size or mtime changed.
+
+Parsed arrays are cached as .npy files under dataset/.cache, named after the
+path, mtime and parse options, so editing a file or changing skiprows parses
+it again. Cache hits touch their file and the least recently used ones are
+deleted once the cache is larger than max_bytes.
+'''
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+DATASET = 'dataset'
+CATALOG_FILE = 'catalog.json'
+CACHE_DIR = '.cache'
+
+# test-2024-08-12-16-33-28.csv, written by the receiver
+RECEIVER_NAME = re.compile(r'test-(\d{4})-(\d{2})-(\d{2})-(\d{2})-(\d{2})-(\d{2})$')
+# yihan_20231130
+FOLDER_DATE = re.compile(r'_(\d{4})(\d{2})(\d{2})$')
+
+
+class ParseCache:
+    '''Parses delimited text recordings once and keeps the arrays as .npy files.
+
+    Args:
+        cache_dir (str, optional): Defaults to dataset/.cache.
+        max_bytes (int, optional): Cache size above which the least recently used arrays are deleted. Defaults to 1 GB.
+    '''
+
+    def __init__(self, cache_dir=os.path.join(DATASET, CACHE_DIR), max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, path, skiprows, delimiter):
+        stat = os.stat(path)
+        key = f'{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{skiprows}|{delimiter!r}'
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def read_csv(self, path, skiprows=0, delimiter=','):
+        '''(n, n_columns) float64 array of the recording, from the cache when it is up to date'''
+        cached = os.path.join(self.cache_dir, self._key(path, skiprows, delimiter) + '.npy')
+        try:
+            os.utime(cached)
+            data = np.load(cached)
+            self.hits += 1
+            return data
+        except FileNotFoundError:
+            # Not cached, or evicted by another process in between
+            pass
+
+        self.misses += 1
+        data = pd.read_csv(path, skiprows=skiprows, delimiter=delimiter, header=None).to_numpy(dtype=float)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write then rename, so a concurrent reader never sees half an array
+        tmp = f'{cached}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, cached)
+        self.evict()
+        return data
+
+    def evict(self):
+        '''Delete the least recently used arrays until the cache fits in max_bytes'''
+        # Other processes evict from the same folder, files can vanish at any point
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def stats(self):
+        size = sum(os.path.getsize(os.path.join(self.cache_dir, name)) for name in os.listdir(self.cache_dir)) \
+            if os.path.isdir(self.cache_dir) else 0
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'cache_bytes': size}
+
+
+def describe_name(path):
+    '''(subject, label, date) of a recording from its file and folder names, None when unknown'''
+    subject = os.path.basename(os.path.dirname(path))
+    stem = os.path.splitext(os.path.basename(path))[0]
+    match = RECEIVER_NAME.match(stem)
+    if match:
+        y, m, d, hh, mm, ss = match.groups()
+        return subject, None, f'{y}-{m}-{d}T{hh}:{mm}:{ss}'
+    match = FOLDER_DATE.search(subject)
+    return subject, stem, '-'.join(match.groups()) if match else None
+
+
+def sha1sum(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Catalog:
+    '''Index of the csv recordings under root, with cached loading.
+
+    Args:
+        root (str, optional): Dataset folder. Defaults to 'dataset'.
+        cache (ParseCache, optional): Defaults to a ParseCache under root.
+    '''
+
+    def __init__(self, root=DATASET, cache=None):
+        self.root = root
+        self.cache = cache or ParseCache(os.path.join(root, CACHE_DIR))
+        self.path = os.path.join(root, CATALOG_FILE)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = {entry['path']: entry for entry in json.load(f)}
+
+    def _describe(self, path, stat):
+        subject, label, date = describe_name(path)
+        try:
+            data = self.cache.read_csv(path)
+        except (pd.errors.EmptyDataError, ValueError):
+            # An empty file or a lone header line is a recording without samples, anything longer is broken
+            with open(path, 'rb') as f:
+                if sum(1 for line in f if line.strip()) > 1:
+                    raise
+            data = np.empty((0, 0))
+        t = data[:, 0] if len(data) else np.empty(0)
+        steps = np.diff(t)
+        dt = np.median(steps) if len(steps) else np.nan
+        return {'path': path,
+                'subject': subject,
+                'label': label,
+                'date': date,
+                'rows': len(data),
+                'columns': data.shape[1],
+                't_first': float(t[0]) if len(t) else None,
+                't_last': float(t[-1]) if len(t) else None,
+                # Receiver timestamps are in ms and restart when it reconnects
+                'time_resets': int(np.sum(steps < 0)),
+                'duration_s': float(np.sum(steps[steps > 0])) / 1000,
+                'fs': float(1000 / dt) if dt > 0 else None,
+                'bytes': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha1': sha1sum(path)}
+
+    def scan(self):
+        '''Index new and changed csvs under root, forget deleted ones and save the catalog
+
+        Returns:
+            dict: counts of the added, updated, unchanged and removed recordings
+        '''
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        found = set()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+            for name in sorted(filenames):
+                if not name.endswith('.csv'):
+                    continue
+                path = os.path.join(dirpath, name)
+                found.add(path)
+                stat = os.stat(path)
+                entry = self.entries.get(path)
+                if entry and entry['bytes'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                    counts['unchanged'] += 1
+                    continue
+                counts['updated' if entry else 'added'] += 1
+                self.entries[path] = self._describe(path, stat)
+        for path in set(self.entries) - found:
+            del self.entries[path]
+            counts['removed'] += 1
+        self.save()
+        return counts
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(sorted(self.entries.values(), key=lambda entry: entry['path']), f, indent=1)
+        os.replace(tmp, self.path)
+
+    def query(self, subject=None, label=None, date=None, min_duration_s=None, max_duration_s=None):
+        '''Catalog entries matching every given criterion, date matches as a prefix (e.g. '2024-08')'''
+        entries = []
+        for entry in sorted(self.entries.values(), key=lambda entry: entry['path']):
+            if subject is not None and entry['subject'] != subject:
+                continue
+            if label is not None and entry['label'] != label:
+                continue
+            if date is not None and not (entry['date'] or '').startswith(date):
+                continue
+            if min_duration_s is not None and entry['duration_s'] < min_duration_s:
+                continue
+            if max_duration_s is not None and entry['duration_s'] > max_duration_s:
+                continue
+            entries.append(entry)
+        return entries
+
+    def load(self, entry, skiprows=0, delimiter=','):
+        '''Parsed array of a catalog entry or path'''
+        return self.cache.read_csv(entry['path'] if isinstance(entry, dict) else entry, skiprows, delimiter)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Index the recordings under dataset/ and list them.')
+    parser.add_argument('-r', '--root',
+                        help='Dataset folder, default dataset',
+                        default=DATASET)
+    parser.add_argument('-s', '--subject',
+                        help='Only list this subject (folder)')
+    parser.add_argument('-l', '--label',
+                        help='Only list this activity label')
+    parser.add_argument('-d', '--date',
+                        help='Only list dates starting with this, e.g. 2024-08')
+    parser.add_argument('--max-cache-mb',
+                        help='Parse cache size bound, default 1024',
+                        default=1024, type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    catalog = Catalog(args.root, ParseCache(os.path.join(args.root, CACHE_DIR), args.max_cache_mb << 20))
+    start = time.perf_counter()
+    counts = catalog.scan()
+    print(', '.join(f'{k} {v}' for k, v in counts.items()) + f' in {time.perf_counter() - start:.2f} s')
+    for entry in catalog.query(args.subject, args.label, args.date):
+        fs = f'{entry["fs"]:.1f} Hz' if entry['fs'] else '-'
+        print(f'{entry["path"]}\t{entry["label"] or "-"}\t{entry["date"] or "-"}\t{entry["rows"]} rows\t'
+              f'{entry["duration_s"]:.1f} s\t{fs}')
+
+
+if __name__ == '__main__':
+    main()
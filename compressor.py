@@ -1,6 +1,20 @@
 import gzip
 import argparse
+import io
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+from scipy.signal import firwin
+
+# Sidecar index <name>.gz.idx, one entry per gzip member: byte offset and length of the
+# member, first data row and number of rows in it, first column of its first and last row.
+# The header lines are the first member, with n_rows 0.
+BLOCK_INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u8'), ('row', '<u8'), ('n_rows', '<u8'),
+                              ('t_first', '<f8'), ('t_last', '<f8')])
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Convert txt file to gz file.')
@@ -18,34 +32,206 @@ def parse_args():
                         default=6,
                         help='Lines of data to skip from the beginning of file.',
                         type=int)
+    parser.add_argument('-b', '--batch',
+                        help='Compress every .txt file under this directory (e.g. dataset/pv) instead of a single label.')
+    parser.add_argument('-j', '--jobs',
+                        default=os.cpu_count(),
+                        help='Worker processes in batch mode, default one per core',
+                        type=int)
+    parser.add_argument('-br', '--block-rows',
+                        default=10000,
+                        help='Data lines per independently compressed block, default 10000',
+                        type=int)
+    parser.add_argument('-m', '--mode',
+                        default='nth', choices=['nth', 'fir'],
+                        help='nth keeps every downsamp-th line, fir low-pass filters before decimating. Default nth')
+    parser.add_argument('--taps',
+                        help='FIR taps in fir mode, default 20 * downsamp + 1',
+                        type=int)
+    parser.add_argument('--delta',
+                        action='store_true',
+                        help='In fir mode, store fixed-point row differences instead of values.')
+    parser.add_argument('--decimals',
+                        default=6,
+                        help='Decimals kept in fir mode, default 6',
+                        type=int)
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help='Recompress files whose output is newer than the input.')
     return parser.parse_args()
 
-def compress_gz(category, date, filename, downsamp, skiprows):
+def _first_value(line):
+    try:
+        return float(line.split(None, 1)[0])
+    except (ValueError, IndexError):
+        return np.nan
+
+class FirDecimator:
+    '''Low-pass filters and decimates (n, C) blocks, carrying the filter history across blocks
+
+    The filter is a linear phase windowed-sinc FIR with its cutoff at the output
+    Nyquist frequency. Only the kept output samples are computed (one dot product
+    of each strided input window with the taps, all channels at once), so the
+    cost is that of a polyphase decimator. The first column is time and is
+    decimated without filtering. Output row k is centered on input row
+    k * ratio; the ends of the recording are extended with the first and last row.
+    '''
+
+    def __init__(self, ratio, numtaps=None):
+        self.ratio = ratio
+        self.numtaps = numtaps or 20 * ratio + 1
+        self.numtaps += 1 - self.numtaps % 2 # odd, for an integer delay
+        self.delay = (self.numtaps - 1) // 2
+        self.taps = firwin(self.numtaps, 1. / ratio)
+        self._history = None
+
+    def process(self, block, final=False):
+        if self._history is None:
+            x = np.concatenate([np.repeat(block[:1], self.delay, axis=0), block])
+        else:
+            x = np.concatenate([self._history, block])
+        if final:
+            x = np.concatenate([x, np.repeat(x[-1:], self.delay, axis=0)])
+        if len(x) < self.numtaps:
+            self._history = x
+            return np.empty((0, block.shape[1]))
+
+        windows = np.lib.stride_tricks.sliding_window_view(x, self.numtaps, axis=0)[::self.ratio]
+        out = windows[:, 1:] @ self.taps[::-1]
+        out = np.column_stack([windows[:, 0, self.delay], out])
+        self._history = x[len(windows) * self.ratio:]
+        return out
+
+    def header(self):
+        return (f'#decimation\tratio={self.ratio}\tfilter=firwin-hamming\ttaps={self.numtaps}'
+                f'\tcutoff={1. / self.ratio:g}')
+
+def _format(block, delta, decimals):
+    out = io.BytesIO()
+    if delta:
+        # Fixed point, first row as is and differences after it, so every block decodes on its own
+        fixed = np.round(block * 10**decimals).astype(np.int64)
+        fixed[1:] = np.diff(fixed, axis=0)
+        np.savetxt(out, fixed, fmt='%d', delimiter='\t')
+    else:
+        np.savetxt(out, block, fmt=f'%.{decimals}f', delimiter='\t')
+    return out.getvalue()
+
+def compress_file(src, dst, downsamp, skiprows, block_rows=10000, mode='nth', numtaps=None, delta=False, decimals=6):
+    '''Stream src into the gzip file dst, keeping one data line in downsamp
+
+    The skiprows header lines are copied as is. Data lines are compressed in
+    independent gzip members of block_rows lines, so dst is still an ordinary
+    .gz file, and each member is listed in the dst + '.idx' sidecar (see
+    BLOCK_INDEX_DTYPE) so a row or time range can be decompressed on its own.
+    The file is read block by block, so memory use does not depend on its size.
+
+    mode 'fir' parses each block of lines once and decimates all channels with
+    an anti-alias filter (FirDecimator) instead of dropping lines. It adds a
+    '#decimation' line with the ratio, the filter and the encoding to the
+    header, and writes values with `decimals` decimals, or as fixed-point row
+    differences if `delta`.
+
+    Returns:
+        dict: report with the bytes read and written and the elapsed seconds
+    '''
+    start = time.perf_counter()
+    index = []
+    with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+        header = b''.join(islice(f_in, skiprows))
+        if mode == 'fir':
+            decimator = FirDecimator(downsamp, numtaps)
+            header += (decimator.header() + f'\tdelta={int(delta)}\tdecimals={decimals}\n').encode()
+        member = gzip.compress(header)
+        f_out.write(member)
+        index.append((0, len(member), 0, 0, np.nan, np.nan))
+
+        def write_block(data, row, n_rows, t_first, t_last):
+            member = gzip.compress(data)
+            index.append((f_out.tell(), len(member), row, n_rows, t_first, t_last))
+            f_out.write(member)
+
+        row = 0
+        if mode == 'fir':
+            while True:
+                lines = list(islice(f_in, block_rows * downsamp))
+                final = len(lines) < block_rows * downsamp
+                if lines:
+                    block = pd.read_csv(io.BytesIO(b''.join(lines)), delimiter='\t', header=None).to_numpy(dtype=float)
+                elif decimator._history is not None:
+                    block = decimator._history[:0]
+                else:
+                    break
+                out = decimator.process(block, final=final)
+                if len(out):
+                    write_block(_format(out, delta, decimals), row, len(out), out[0, 0], out[-1, 0])
+                    row += len(out)
+                if final:
+                    break
+        else:
+            # sample one data point in *downsamp* consecutive data points to control gzip file size
+            lines = islice(f_in, 0, None, max(downsamp, 1))
+            while True:
+                block = list(islice(lines, block_rows))
+                if not block:
+                    break
+                write_block(b''.join(block), row, len(block), _first_value(block[0]), _first_value(block[-1]))
+                row += len(block)
+    np.array(index, dtype=BLOCK_INDEX_DTYPE).tofile(dst + '.idx')
+    return {'path': src,
+            'bytes_in': os.path.getsize(src),
+            'bytes_out': os.path.getsize(dst),
+            'elapsed': time.perf_counter() - start}
+
+def compress_gz(category, date, filename, downsamp, skiprows, block_rows=10000, **kwargs):
     path = os.path.join('dataset', category, date, filename)
+    return compress_file(path+'.txt', path+'.gz', downsamp, skiprows, block_rows, **kwargs)
 
-    # sample one data point in *downsamp* consecutive data points to control gzip file size
-    with open(path+'.txt', 'rb') as f_in, gzip.open(path+'.gz', 'wb') as f_out:
-        lines = f_in.readlines()
-        # f_out.write('\t'.join(['downsample ratio', str(downsamp)]).encode()) # NOTE: write downsample ratio to the head of output file
-        for i in range(skiprows):
-            f_out.write(lines[i])
-        if downsamp > 1:
-            for i in range(skiprows, len(lines)):
-                if i % downsamp == skiprows:
-                    f_out.write(lines[i])
-        elif downsamp == 1:
-            for i in range(skiprows, len(lines)):
-                f_out.write(lines[i])
-                    
+def find_stale(root, force=False):
+    '''Find the .txt recordings under root whose .gz is missing or older'''
+    stale = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in sorted(filenames):
+            if not name.endswith('.txt'):
+                continue
+            src = os.path.join(dirpath, name)
+            dst = src[:-len('.txt')] + '.gz'
+            if force or not os.path.exists(dst) or os.path.getmtime(dst) < os.path.getmtime(src):
+                stale.append((src, dst))
+    return stale
+
+def compress_batch(root, downsamp, skiprows, block_rows=10000, jobs=None, force=False, **kwargs):
+    '''Compress the stale recordings under root in parallel, printing one report line per file'''
+    stale = find_stale(root, force)
+    print(f'{len(stale)} files to compress under {root}')
+    reports = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(compress_file, src, dst, downsamp, skiprows, block_rows, **kwargs) for src, dst in stale]
+        for future in as_completed(futures):
+            report = future.result()
+            reports.append(report)
+            print(f'{report["path"]}: {report["bytes_in"]/1e6:.1f} MB -> {report["bytes_out"]/1e6:.1f} MB '
+                  f'in {report["elapsed"]:.2f} s')
+    if reports:
+        bytes_in = sum(r['bytes_in'] for r in reports)
+        bytes_out = sum(r['bytes_out'] for r in reports)
+        print(f'total: {bytes_in/1e6:.1f} MB -> {bytes_out/1e6:.1f} MB in {time.perf_counter() - start:.2f} s')
+    return reports
 
 def main():
     args = parse_args()
+    options = {'mode': args.mode, 'numtaps': args.taps, 'delta': args.delta, 'decimals': args.decimals}
+    if args.batch:
+        compress_batch(args.batch, args.downsamp, args.skiprows, args.block_rows, jobs=args.jobs, force=args.force,
+                       **options)
+        return
     category = args.category
     date = args.date
     label = args.label
     downsamp = args.downsamp
     skiprows = args.skiprows
-    compress_gz(category, date, label, downsamp, skiprows)
-    
+    compress_gz(category, date, label, downsamp, skiprows, args.block_rows, **options)
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,264 @@
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+from esp_lahmo_central_daq import SerialPlotter
+from frames import FrameDecoder, encode_frame
+from serial_simulator import SerialSimulator
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results.jsonl')
+
+# (plotting, csv export) configurations of the sustained-rate benchmark
+CONFIGS = ((False, False), (False, True), (True, False), (True, True))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the acquisition path of SerialPlotter.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    ingest = subparsers.add_parser('ingest', help='Compare readline and chunked ingestion on a fake port.')
+    ingest.add_argument('-n', '--n-samples',
+                        help='Number of samples to push through the fake port, default 200000',
+                        default=200000, type=int)
+    ingest.add_argument('-c', '--csv',
+                        help='Replay this recording instead of synthetic data.')
+    ingest.add_argument('-r', '--repeat',
+                        help='Number of runs per mode, default 3',
+                        default=3, type=int)
+
+    sustained = subparsers.add_parser('sustained', help='Find the maximum sustained sample rate on a simulated receiver.')
+    sustained.add_argument('-d', '--duration',
+                           help='Seconds per tested rate, default 3',
+                           default=3., type=float)
+    sustained.add_argument('--rates', nargs='+', type=float,
+                           default=[100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000],
+                           help='Sample rates to try in increasing order.')
+    sustained.add_argument('--ingest', choices=['chunked', 'readline'], default='chunked',
+                           help='Ingestion mode, default chunked.')
+    sustained.add_argument('--no-save', action='store_true',
+                           help=f'Do not append the results to {os.path.basename(RESULTS_FILE)}.')
+
+    frames = subparsers.add_parser('frames', help='Compare the decode cost of text and packed BLE frames.')
+    frames.add_argument('-n', '--n-samples',
+                        help='Number of samples to decode, default 100000',
+                        default=100000, type=int)
+    frames.add_argument('-s', '--samples-per-frame',
+                        help='Samples per packed frame, default 10',
+                        default=10, type=int)
+    frames.add_argument('-b', '--batch',
+                        help='Notifications decoded per call, default 100',
+                        default=100, type=int)
+
+    args = parser.parse_args()
+    if args.command is None:
+        args = parser.parse_args(['ingest'] + sys.argv[1:])
+    return args
+
+
+def synthesize_lines(n_samples, interval_ms=100):
+    '''Generate receiver output lines: timestamp\\tpv0..pv3\\troll\\tpitch\\tyaw'''
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(n_samples) * interval_ms
+    pv = 0.5 + 0.1 * rng.standard_normal((n_samples, 4))
+    angles = 180 * rng.uniform(-1, 1, (n_samples, 3))
+    lines = []
+    for ts, row in zip(timestamps, np.hstack([pv, angles])):
+        lines.append('\t'.join([str(int(ts))] + [f'{v:.4f}' for v in row]))
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+def replay_lines(csv_filename, n_samples):
+    '''Turn a recorded csv back into the tab-separated stream the receiver prints'''
+    with open(csv_filename, 'rb') as f:
+        lines = [line.strip().replace(b',', b'\t') for line in f if line.strip()]
+    lines = (lines * (n_samples // len(lines) + 1))[:n_samples]
+    return b'\r\n'.join(lines) + b'\r\n'
+
+
+class FakeSerial:
+    '''Serves a fixed byte stream through the subset of the pyserial API used by SerialPlotter'''
+
+    def __init__(self, data, arrival_size=4096, on_exhausted=None):
+        self._data = data
+        self._pos = 0
+        self.arrival_size = arrival_size # bytes that "arrived" since the previous read
+        self.on_exhausted = on_exhausted
+
+    @property
+    def in_waiting(self):
+        return min(len(self._data) - self._pos, self.arrival_size)
+
+    def _take(self, end):
+        chunk = self._data[self._pos:end]
+        self._pos = end
+        if self._pos >= len(self._data) and self.on_exhausted:
+            self.on_exhausted()
+        return chunk
+
+    def read(self, size=1):
+        return self._take(min(self._pos + size, len(self._data)))
+
+    def readline(self):
+        end = self._data.find(b'\n', self._pos)
+        end = len(self._data) if end < 0 else end + 1
+        return self._take(end)
+
+    def close(self):
+        pass
+
+
+def run_ingest(data, ingest):
+    '''Push the whole stream through SerialPlotter._read_serial and return elapsed seconds'''
+    fake = FakeSerial(data)
+    plotter = SerialPlotter(fake, max_len=500, ingest=ingest)
+    fake.on_exhausted = plotter._stop_event.set
+    start = time.perf_counter()
+    plotter._read_serial()
+    elapsed = time.perf_counter() - start
+    matplotlib.pyplot.close(plotter._fig)
+    return elapsed, plotter
+
+
+def run_sustained(rate_hz, duration, plot, record, ingest='chunked', plot_fps=30.):
+    '''Stream from a simulated receiver at rate_hz and check that nothing is lost.
+
+    Returns:
+        dict: samples sent and received, and whether the rate was sustained (>= 99.5%
+        of the nominal samples were sent and received)
+    '''
+    with tempfile.TemporaryDirectory() as tmp, SerialSimulator(rate_hz=rate_hz) as simulator:
+        csv_filename = os.path.join(tmp, 'bench.csv') if record else None
+        plotter = SerialPlotter(simulator.port, max_len=max(500, int(rate_hz * 10)), csv_filename=csv_filename,
+                                ingest=ingest, headless=not plot)
+        plotter._serial_thread.start()
+
+        start = time.monotonic()
+        while time.monotonic() - start < duration:
+            if plot:
+                # The Agg canvas has no event loop, drive the animation from here
+                plotter._update_plots(None)
+            time.sleep(1. / plot_fps)
+        simulator.stop()
+        n_sent = simulator.n_sent
+        # Let the reader catch up with what is already in the pty
+        deadline = time.monotonic() + 2.
+        while plotter.telemetry.n_samples < n_sent and time.monotonic() < deadline:
+            time.sleep(0.05)
+        n_received = plotter.telemetry.n_samples
+        plotter.stop()
+
+    expected = rate_hz * duration
+    return {'rate_hz': rate_hz,
+            'sent': n_sent,
+            'received': n_received,
+            'sustained': n_sent >= 0.995 * expected and n_received >= 0.995 * n_sent}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def previous_results():
+    '''Latest saved max sustained rate per configuration'''
+    previous = {}
+    if os.path.exists(RESULTS_FILE):
+        with open(RESULTS_FILE) as f:
+            for line in f:
+                entry = json.loads(line)
+                previous[entry['config']] = entry
+    return previous
+
+
+def sustained_main(args):
+    previous = previous_results()
+    for plot, record in CONFIGS:
+        config = f'{args.ingest}{"+plot" if plot else ""}{"+csv" if record else ""}'
+        best = 0.
+        for rate_hz in args.rates:
+            result = run_sustained(rate_hz, args.duration, plot, record, ingest=args.ingest)
+            print(f'{config:>20} @ {rate_hz:>8.0f} Hz: sent {result["sent"]}, received {result["received"]}'
+                  f'{"" if result["sustained"] else "  <- not sustained"}')
+            if not result['sustained']:
+                break
+            best = rate_hz
+
+        line = f'{config}: max sustained rate {best:.0f} Hz'
+        if config in previous:
+            before = previous[config]['max_rate_hz']
+            line += f' (previous {before:.0f} Hz at {previous[config]["revision"]})'
+            if best < before:
+                line += '  REGRESSION'
+        print(line)
+
+        if not args.no_save:
+            entry = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'revision': git_revision(),
+                     'host': platform.node(),
+                     'config': config,
+                     'duration_s': args.duration,
+                     'max_rate_hz': best}
+            with open(RESULTS_FILE, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+def frames_main(args):
+    records = np.loadtxt(io.BytesIO(synthesize_lines(args.n_samples)), delimiter='\t', ndmin=2)
+    # The firmware sends one comma separated sample per notification
+    formats = {'text': [','.join(f'{v:.6f}' for v in row).encode() for row in records]}
+    for encoding in ('int16', 'float16', 'float32'):
+        formats[encoding] = [encode_frame(records[i:i+args.samples_per_frame], seq, encoding)
+                             for seq, i in enumerate(range(0, len(records), args.samples_per_frame))]
+
+    for name, notifications in formats.items():
+        decoder = FrameDecoder()
+        start = time.perf_counter()
+        for i in range(0, len(notifications), args.batch):
+            decoder.decode(notifications[i:i+args.batch])
+        elapsed = time.perf_counter() - start
+        n_bytes = sum(len(n) for n in notifications)
+        print(f'{name:>8}: {n_bytes/len(records):5.1f} bytes/sample, {1e6*elapsed/len(records):.2f} us/sample, '
+              f'{len(records)/elapsed:,.0f} samples/s')
+
+
+def ingest_main(args):
+    if args.csv:
+        data = replay_lines(args.csv, args.n_samples)
+    else:
+        data = synthesize_lines(args.n_samples)
+
+    print(f'{args.n_samples} samples, {len(data)/1e6:.1f} MB')
+    results = {}
+    for ingest in ('readline', 'chunked'):
+        best, plotter = min((run_ingest(data, ingest) for _ in range(args.repeat)), key=lambda r: r[0])
+        results[ingest] = best
+        print(f'{ingest:>8}: {best:.3f} s, {args.n_samples/best:,.0f} samples/s, '
+              f'last timestamp {plotter._last_timestamp:.0f}')
+    print(f'speedup: {results["readline"]/results["chunked"]:.1f}x')
+
+
+def main():
+    args = parse_args()
+    if args.command == 'sustained':
+        sustained_main(args)
+    elif args.command == 'frames':
+        frames_main(args)
+    else:
+        ingest_main(args)
+
+
+if __name__ == '__main__':
+    main()
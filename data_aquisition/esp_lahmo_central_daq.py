@@ -2,8 +2,6 @@ import threading
 import serial
 import time
 from datetime import datetime
-import csv
-from collections import deque
 import argparse
 import sys
 
@@ -11,31 +9,40 @@ import numpy as np
 import matplotlib as mpl
 import matplotlib.pylab as pl
 import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
 import matplotlib.widgets as widgets
 
+from serial_ingest import ChunkedSerialReader
+from ring_buffer import RingBuffer
+from recorder import make_recorder
+from live_plot import LivePlot
+from telemetry import Telemetry, JsonLineReporter, MetricsServer
+
 class SerialPlotter:
-    def __init__(self, port, baudrate=115200, max_len=500, plot_interval=0.001, csv_filename=None, conn_timeout=5):
-        self.ser = serial.Serial(port=port, baudrate=baudrate)
+    _EMPTY = np.empty((0, 8))
+
+    def __init__(self, port, baudrate=115200, max_len=500, plot_interval=0.001, csv_filename=None, conn_timeout=5, ingest='chunked',
+                 flush_interval=1., flush_bytes=1 << 20, fsync='never', headless=False):
+        # Accept an already opened serial-like object (e.g. a fake port for benchmarking).
+        # Reads time out so that stop() is noticed on a silent port; the chunked reader carries partial lines over.
+        self.ser = port if hasattr(port, 'read') else serial.Serial(port=port, baudrate=baudrate, timeout=0.5)
         self.max_len = max_len
         self.plot_interval = plot_interval
         self.conn_timeout = conn_timeout
 
+        # 'chunked' drains the input buffer in bulk, 'readline' parses one line at a time
+        if ingest not in ('chunked', 'readline'):
+            raise ValueError(f'Unknown ingest mode: {ingest}')
+        self.ingest = ingest
+        self._reader = ChunkedSerialReader(self.ser)
+
         # Data export
         self.csv_filename = csv_filename
-        self.csvfile = None
-        self.csv_writer = None
-
-        # Initialize containers
-        self.timestamps = deque([], maxlen=self.max_len)
-        self.pv0 = deque([], maxlen=self.max_len)
-        self.pv1 = deque([], maxlen=self.max_len)
-        self.pv2 = deque([], maxlen=self.max_len)
-        self.pv3 = deque([], maxlen=self.max_len)
-        self.roll = deque([], maxlen=self.max_len)
-        self.pitch = deque([], maxlen=self.max_len)
-        self.yaw = deque([], maxlen=self.max_len)
-        
+        self.recorder = None
+        self._recorder_kwargs = {'flush_interval': flush_interval, 'flush_bytes': flush_bytes, 'fsync': fsync}
+
+        # Initialize containers: one (max_len, 8) ring of timestamp, pv0..pv3, roll, pitch, yaw
+        self.buffer = RingBuffer(self.max_len, n_channels=8)
+
         self._last_timestamp = 0
         self._last_pv0 = 0
         self._last_pv1 = 0
@@ -45,7 +52,22 @@ class SerialPlotter:
         self._last_pitch = 0
         self._last_yaw = 0
 
-        # Initialize plots
+        # Acquisition health, see telemetry.py
+        self.telemetry = Telemetry()
+        self.telemetry.sources['recorder'] = self._recorder_stats
+        self.telemetry.sources['buffer'] = lambda: {'fill': len(self.buffer), 'capacity': self.buffer.capacity}
+
+        # Start background thread for reading data from serial port
+        self._serial_thread = threading.Thread(target=self._read_serial)
+        self._stop_event = threading.Event()
+
+        # Headless mode only runs the reader and the recorder
+        self.headless = headless
+        self._fig = None
+        if not headless:
+            self._init_plots()
+
+    def _init_plots(self):
         self._fig, self._axes = plt.subplots(7, 1, sharex=True, figsize=[10, 10])
         self._line0, = self._axes[0].plot(self.timestamps, self.pv0)
         self._line1, = self._axes[1].plot(self.timestamps, self.pv1)
@@ -68,36 +90,86 @@ class SerialPlotter:
                 ax.set_xlabel('Time (ms)')
         
         self._colors = pl.cm.tab10(np.linspace(0, 1, 7))
-        
-        # Start background thread for reading data from serial port
-        self._serial_thread = threading.Thread(target=self._read_serial)
-        self._stop_event = threading.Event()
+        self._lines = [self._line0, self._line1, self._line2, self._line3, self._liner, self._linep, self._liney]
+        for line, color in zip(self._lines, self._colors):
+            line.set_color(color)
+        self._live_plot = LivePlot(self._fig, self._lines)
+        self.telemetry.sources['plot'] = self._live_plot.stats
 
         # Initialize a button for stopping the data acquisition
         self._stop_button_ax = self._fig.add_axes([0.85, 0.025, 0.1, 0.04])
         self._stop_button = widgets.Button(self._stop_button_ax, 'Stop')
         self._stop_button.on_clicked(self._on_stop_button_clicked)
         
+    # Column views of the latest samples, kept for consumers of the old deque attributes
+    @property
+    def timestamps(self):
+        return self.buffer.snapshot().data[:, 0]
+
+    @property
+    def pv0(self):
+        return self.buffer.snapshot().data[:, 1]
+
+    @property
+    def pv1(self):
+        return self.buffer.snapshot().data[:, 2]
+
+    @property
+    def pv2(self):
+        return self.buffer.snapshot().data[:, 3]
+
+    @property
+    def pv3(self):
+        return self.buffer.snapshot().data[:, 4]
+
+    @property
+    def roll(self):
+        return self.buffer.snapshot().data[:, 5]
+
+    @property
+    def pitch(self):
+        return self.buffer.snapshot().data[:, 6]
+
+    @property
+    def yaw(self):
+        return self.buffer.snapshot().data[:, 7]
+
     def _on_stop_button_clicked(self, event):
         self.stop()
 
     def start(self):
         # background thread
         self._serial_thread.start()
+        if self.headless:
+            return
 
-        # start animation
-        self._animation = FuncAnimation(self._fig, self._update_plots, interval=self.plot_interval, cache_frame_data=False)
+        # start animation, blitted by LivePlot
+        self._timer = self._fig.canvas.new_timer(interval=self.plot_interval)
+        self._timer.add_callback(self._update_plots, None)
+        self._timer.start()
         
     def stop(self):
         self._stop_event.set()
-        plt.close(self._fig)
+        if hasattr(self, '_timer'):
+            self._timer.stop()
+            print('Plot:', ', '.join(f'{k} {v:.2f}' if isinstance(v, float) else f'{k} {v}'
+                                     for k, v in self._live_plot.stats().items()))
+        if self._fig:
+            plt.close(self._fig)
 
-        if threading.current_thread() != self._serial_thread:
+        if threading.current_thread() != self._serial_thread and self._serial_thread.is_alive():
             self._serial_thread.join()
-        if self.csvfile:
-            self.csvfile.close()
-            self.csvfile = None
+        if self.recorder:
+            # Drains whatever the serial thread queued before it stopped
+            self.recorder.close()
+            print('Recorder:', ', '.join(f'{k} {v:.2f}' if isinstance(v, float) else f'{k} {v}'
+                                         for k, v in self.recorder.stats().items()))
+            self.recorder = None
     
+    def wait(self, timeout=None):
+        '''Block until the acquisition stops or timeout seconds pass, return True if stopped'''
+        return self._stop_event.wait(timeout)
+
     def _parse_serial_line(self, serial_line):
         try:
             split_strings = serial_line.split('\t')
@@ -123,6 +195,12 @@ class SerialPlotter:
             return False
 
     def _read_serial(self):
+        if self.ingest == 'chunked':
+            self._read_serial_chunked()
+        else:
+            self._read_serial_readline()
+
+    def _read_serial_readline(self):
         # timestamp to record the first disconnect (first occurrance of UnicodeDecodeError)
         disconn_start_time = None
         
@@ -133,11 +211,14 @@ class SerialPlotter:
                 serial_line = serial_byte.decode('utf-8').strip()
 
                 if not self._parse_serial_line(serial_line):
+                    if serial_line:
+                        self.telemetry.on_batch(self._EMPTY, n_malformed=1)
                     continue
 
                 disconn_start_time = None # reset the disconnect counter
 
             except UnicodeDecodeError:
+                self.telemetry.on_batch(self._EMPTY, n_undecodable=1)
                 if not disconn_start_time:
                     disconn_start_time = time.perf_counter()
                 elif time.perf_counter() - disconn_start_time > self.conn_timeout:
@@ -149,70 +230,94 @@ class SerialPlotter:
             except IndexError:
                 continue
             
-            self.timestamps.append(self._last_timestamp)
-            self.pv0.append(self._last_pv0)
-            self.pv1.append(self._last_pv1)
-            self.pv2.append(self._last_pv2)
-            self.pv3.append(self._last_pv3)
-            self.roll.append(self._last_roll)
-            self.pitch.append(self._last_pitch)
-            self.yaw.append(self._last_yaw)
-            
-            if not self.csvfile and self.csv_filename:
-                self.csvfile = open(self.csv_filename, 'a+', newline='')
-                self.csv_writer = csv.writer(self.csvfile)
+            record = [self._last_timestamp,
+                      self._last_pv0,
+                      self._last_pv1,
+                      self._last_pv2,
+                      self._last_pv3,
+                      self._last_roll,
+                      self._last_pitch,
+                      self._last_yaw]
+            self.buffer.append(record)
+            self.telemetry.on_sample(self._last_timestamp)
 
             # Write to csv
             if self.csv_filename:
-                self.csv_writer.writerow([np.around(self._last_timestamp, 3),
-                                          self._last_pv0,
-                                          self._last_pv1,
-                                          self._last_pv2,
-                                          self._last_pv3,
-                                          self._last_roll,
-                                          self._last_pitch,
-                                          self._last_yaw])
-                self.csvfile.flush()
-            
+                self._record(np.array([record]))
+
+    def _read_serial_chunked(self):
+        # timestamp to record the first disconnect (first batch with nothing but undecodable bytes)
+        disconn_start_time = None
+
+        while not self._stop_event.is_set():
+            n_malformed = self._reader.n_malformed
+            records, n_undecodable = self._reader.read()
+            read_time = time.monotonic()
+            self.telemetry.on_batch(records, self._reader.n_malformed - n_malformed, n_undecodable)
+
+            if n_undecodable and not len(records):
+                if not disconn_start_time:
+                    disconn_start_time = time.perf_counter()
+                elif time.perf_counter() - disconn_start_time > self.conn_timeout:
+                    print('Timeout connecting to the given LaHMo.')
+                    self.stop()
+                    break
+                continue
+
+            if not len(records):
+                continue
+
+            disconn_start_time = None # reset the disconnect counter
+            self._store_records(records, read_time)
+
+    def _store_records(self, records, read_time=None):
+        '''Append an (n, 8) batch of records to the containers and hand it to the recorder'''
+        self._last_timestamp, self._last_pv0, self._last_pv1, self._last_pv2, \
+            self._last_pv3, self._last_roll, self._last_pitch, self._last_yaw = records[-1]
+
+        self.buffer.extend(records)
+
+        # Write to csv
+        if self.csv_filename:
+            self._record(records, read_time)
+
+    def _recorder_stats(self):
+        # Read once, the reader thread can reset it between a check and a use
+        recorder = self.recorder
+        return recorder.stats() if recorder else {}
+
+    def _record(self, records, read_time=None):
+        if not self.recorder and not self._stop_event.is_set():
+            self.recorder = make_recorder(self.csv_filename, **self._recorder_kwargs)
+        if self.recorder:
+            self.recorder.put(records, read_time)
+
     def _update_plots(self, frame):
-        # Update plot data
-        self._line0.set_xdata(self.timestamps)
-        self._line0.set_ydata(self.pv0)
-        self._line1.set_xdata(self.timestamps)
-        self._line1.set_ydata(self.pv1)
-        self._line2.set_xdata(self.timestamps)
-        self._line2.set_ydata(self.pv2)
-        self._line3.set_xdata(self.timestamps)
-        self._line3.set_ydata(self.pv3)
-        
-        self._liner.set_xdata(self.timestamps)
-        self._liner.set_ydata(self.roll)
-        self._linep.set_xdata(self.timestamps)
-        self._linep.set_ydata(self.pitch)
-        self._liney.set_xdata(self.timestamps)
-        self._liney.set_ydata(self.yaw)
-        
-        for ax in self._axes:
-            ax.relim()
-            ax.autoscale_view()
-        
-        # Set line color
-        self._line0.set_color(self._colors[0])
-        self._line1.set_color(self._colors[1])
-        self._line2.set_color(self._colors[2])
-        self._line3.set_color(self._colors[3])
-        self._liner.set_color(self._colors[4])
-        self._linep.set_color(self._colors[5])
-        self._liney.set_color(self._colors[6])
-        
-        
-        return self._line0, self._line1, self._line2, self._line3, self._liner, self._linep, self._liney
-        
-    
+        # Update plot data from one consistent snapshot of the buffer
+        data = self.buffer.snapshot().data
+        self._live_plot.update(data[:, 0], data[:, 1:])
+
+        return self._lines
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Read serial data from specific serial port.')
     parser.add_argument('--port', metavar='P', type=str, help='The serial port to read from.')
+    parser.add_argument('--flush-interval', type=float, default=1.,
+                        help='Seconds between flushes of the csv file, default 1.')
+    parser.add_argument('--fsync', choices=['never', 'flush', 'close'], default='never',
+                        help='When to fsync the csv file, default never.')
+    parser.add_argument('--format', choices=['csv', 'lhm'], default='csv',
+                        help='Record to csv or to a binary .lhm session file, default csv.')
+    parser.add_argument('--ingest', choices=['chunked', 'readline'], default='chunked',
+                        help='Read the port in bulk (chunked) or one line at a time (readline).')
+    parser.add_argument('--headless', action='store_true',
+                        help='Record without plotting, e.g. for unattended sessions.')
+    parser.add_argument('--metrics-interval', type=float,
+                        help='Seconds between JSON telemetry lines on stdout, 0 to disable. '
+                             'Default 10 when headless, disabled otherwise.')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve telemetry as JSON on http://127.0.0.1:PORT/metrics.')
 
     args = parser.parse_args()
     if not args.port:
@@ -233,9 +338,30 @@ if __name__ == '__main__':
     second = now.strftime('%S')
     time_str = '-'.join((year, month, day, hour, minute, second))
     
-    serial_plotter = SerialPlotter(port, max_len=100, csv_filename=f'dataset/ble_test/test-{time_str}.csv')
-    
+    serial_plotter = SerialPlotter(port, max_len=100, csv_filename=f'dataset/ble_test/test-{time_str}.{args.format}', ingest=args.ingest,
+                                   flush_interval=args.flush_interval, fsync=args.fsync, headless=args.headless)
+
+    metrics_interval = args.metrics_interval
+    if metrics_interval is None:
+        metrics_interval = 10. if args.headless else 0.
+    reporters = []
+    if metrics_interval > 0:
+        reporters.append(JsonLineReporter(serial_plotter.telemetry, interval=metrics_interval))
+    if args.metrics_port:
+        reporters.append(MetricsServer(serial_plotter.telemetry, args.metrics_port))
+    for reporter in reporters:
+        reporter.start()
+
     serial_plotter.start()
-    plt.show(block=True)
+    if args.headless:
+        try:
+            while not serial_plotter.wait(1.):
+                pass
+        except KeyboardInterrupt:
+            pass
+    else:
+        plt.show(block=True)
 
-    serial_plotter.stop()
\ No newline at end of file
+    serial_plotter.stop()
+    for reporter in reporters:
+        reporter.stop()
\ No newline at end of file
@@ -0,0 +1,145 @@
+import struct
+
+import numpy as np
+
+from serial_ingest import N_FIELDS, parse_records
+
+# Packed frame layout, version 2 (version 1 had 0.01 degree int16 angles), little endian:
+#   header   uint8 magic, uint8 version << 4 | encoding, uint16 sequence number,
+#            uint8 samples in the frame, uint8 reserved, uint32 timestamp (ms) of the first sample
+#   samples  uint16 ms since the first sample, then pv0..pv3, roll, pitch, yaw
+# The magic byte is not ASCII, so text frames (starting with a digit or '-') are told apart by it.
+FRAME_MAGIC = 0xA5
+FRAME_VERSION = 2
+HEADER = struct.Struct('<BBHBBI')
+
+ENCODINGS = {'int16': 0, 'float16': 1, 'float32': 2}
+CHANNEL_DTYPES = {0: '<i2', 1: '<f2', 2: '<f4'}
+# int16 resolution: 0.1 mV for the photovoltages (range +-3.2 V), 0.02 degree for the angles (range +-655 degrees,
+# yaw goes from 0 to 360)
+INT16_SCALE = np.array([1e-4] * 4 + [2e-2] * 3)
+MAX_FRAME_SPAN_MS = 0xFFFF
+
+
+def _frame_dtype(encoding, n_samples):
+    sample = np.dtype([('dt', '<u2'), ('values', CHANNEL_DTYPES[encoding], N_FIELDS - 1)])
+    return np.dtype([('magic', 'u1'), ('version', 'u1'), ('seq', '<u2'), ('n', 'u1'), ('reserved', 'u1'),
+                     ('t0', '<u4'), ('samples', sample, n_samples)])
+
+
+def encode_frame(records, seq, encoding='int16'):
+    '''Pack (n, 8) records into one binary frame, the inverse of FrameDecoder
+
+    Raises:
+        ValueError: if the samples are not in time order, span more than MAX_FRAME_SPAN_MS, or
+            do not fit int16 with INT16_SCALE
+    '''
+    records = np.asarray(records, dtype=float)
+    code = ENCODINGS[encoding]
+    dt = records[:, 0] - records[0, 0]
+    if np.any(dt < 0) or np.any(dt > MAX_FRAME_SPAN_MS):
+        raise ValueError(f'Frame samples must be in time order within {MAX_FRAME_SPAN_MS} ms of the first one')
+    frame = np.zeros(1, dtype=_frame_dtype(code, len(records)))
+    frame['magic'] = FRAME_MAGIC
+    frame['version'] = FRAME_VERSION << 4 | code
+    frame['seq'] = seq & 0xFFFF
+    frame['n'] = len(records)
+    frame['t0'] = records[0, 0]
+    frame['samples']['dt'] = dt
+    values = records[:, 1:]
+    if code == 0:
+        values = np.round(values / INT16_SCALE)
+        if np.any(np.abs(values) > 32767):
+            raise ValueError(f'Values out of the int16 range {(32767 * INT16_SCALE).tolist()}')
+    frame['samples']['values'] = values
+    return frame.tobytes()
+
+
+class FrameDecoder:
+    '''Decodes BLE notifications, packed binary frames or legacy text, into records.
+
+    Binary frames of the same encoding and length are decoded together with a
+    single np.frombuffer. Text notifications hold one comma or tab separated
+    sample each and are parsed together with parse_records. Lost frames are
+    counted from gaps in the sequence number.
+    '''
+
+    def __init__(self):
+        self.n_frames = 0
+        self.n_text = 0
+        self.n_bytes = 0
+        self.n_lost = 0
+        self.n_malformed = 0
+        self._last_seq = None
+
+    def decode(self, notifications):
+        '''
+        Args:
+            notifications (list of bytes): notifications in arrival order
+
+        Returns:
+            np.ndarray: (n, 8) records in timestamp order
+        '''
+        text = []
+        groups = {} # (encoding, n_samples) -> frames
+        seqs = []
+        for data in notifications:
+            self.n_bytes += len(data)
+            if data[:1] != bytes([FRAME_MAGIC]):
+                text.append(data.strip(b'\x00\r\n'))
+                continue
+            if len(data) < HEADER.size:
+                self.n_malformed += 1
+                continue
+            _, version, seq, n, _, _ = HEADER.unpack_from(data)
+            encoding = version & 0x0F
+            if version >> 4 != FRAME_VERSION or encoding not in CHANNEL_DTYPES \
+                    or len(data) != _frame_dtype(encoding, n).itemsize:
+                self.n_malformed += 1
+                continue
+            groups.setdefault((encoding, n), []).append(data)
+            seqs.append(seq)
+
+        blocks = [self._decode_group(encoding, n, frames) for (encoding, n), frames in groups.items()]
+        if text:
+            records, n_malformed, n_undecodable = parse_records(b'\n'.join(text).replace(b',', b'\t') + b'\n')
+            self.n_text += len(text)
+            self.n_malformed += n_malformed + n_undecodable
+            blocks.append(records)
+        self._count_lost(seqs)
+
+        if not blocks:
+            return np.empty((0, N_FIELDS))
+        records = np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+        if len(blocks) > 1:
+            records = records[np.argsort(records[:, 0], kind='stable')]
+        return records
+
+    def _decode_group(self, encoding, n, frames):
+        decoded = np.frombuffer(b''.join(frames), dtype=_frame_dtype(encoding, n))
+        self.n_frames += len(decoded)
+        samples = decoded['samples']
+        records = np.empty((len(decoded), n, N_FIELDS))
+        records[:, :, 0] = decoded['t0'][:, None].astype(float) + samples['dt']
+        records[:, :, 1:] = samples['values']
+        if encoding == 0:
+            records[:, :, 1:] *= INT16_SCALE
+        return records.reshape(-1, N_FIELDS)
+
+    def _count_lost(self, seqs):
+        if not seqs:
+            return
+        seqs = np.array(seqs, dtype=np.int64)
+        if self._last_seq is not None:
+            seqs = np.concatenate([[self._last_seq], seqs])
+        lost = (np.diff(seqs) - 1) % 65536
+        # Repeated or reordered frames wrap to huge gaps, they are not losses
+        self.n_lost += int(np.sum(lost[lost < 32768]))
+        self._last_seq = int(seqs[-1])
+
+    def stats(self):
+        return {'frames': self.n_frames,
+                'text_frames': self.n_text,
+                'bytes': self.n_bytes,
+                'lost_frames': self.n_lost,
+                'malformed': self.n_malformed}
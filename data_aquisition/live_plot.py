@@ -0,0 +1,144 @@
+import time
+
+import numpy as np
+
+
+def minmax_decimate(x, y, n_bins):
+    '''Reduce each channel to the min and max of n_bins equal bins, in time order.
+
+    Keeps the visual envelope of the signal (spikes survive) with 2 points per bin.
+
+    Args:
+        x (array_like): (n,) sample times
+        y (array_like): (n,) or (n, C) samples
+        n_bins (int): Number of bins, usually the axis width in pixels
+
+    Returns:
+        tuple: (x_dec, y_dec), both (m,) or (m, C) with m <= 2*n_bins. With C > 1 every
+        channel keeps its own extrema, so x_dec has one column per channel.
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    squeeze = y.ndim == 1
+    if squeeze:
+        y = y[:, None]
+    n = y.shape[0]
+    n_bins = max(int(n_bins), 1)
+    if n <= 2 * n_bins:
+        x_out = np.broadcast_to(x[:, None], y.shape)
+        return (x_out[:, 0], y[:, 0]) if squeeze else (x_out, y)
+
+    bin_size = n // n_bins
+    n_full = n_bins * bin_size
+    binned = y[:n_full].reshape(n_bins, bin_size, -1)
+    offsets = np.arange(n_bins)[:, None] * bin_size
+    i_min = binned.argmin(axis=1) + offsets
+    i_max = binned.argmax(axis=1) + offsets
+    # (n_bins, 2, C) -> (2*n_bins, C), earlier extremum first
+    idx = np.stack([np.minimum(i_min, i_max), np.maximum(i_min, i_max)], axis=1).reshape(2 * n_bins, -1)
+    if n_full < n:
+        # Remainder shorter than a bin, kept as is
+        tail = np.broadcast_to(np.arange(n_full, n)[:, None], (n - n_full, y.shape[1]))
+        idx = np.concatenate([idx, tail])
+
+    y_out = np.take_along_axis(y, idx, axis=0)
+    x_out = x[idx]
+    return (x_out[:, 0], y_out[:, 0]) if squeeze else (x_out, y_out)
+
+
+class LivePlot:
+    '''Blitted live plot of one line per channel, for axes of equal width.
+
+    Several lines may share an axis; its y limits then cover all of them.
+
+    Lines are drawn on top of a cached background. The full figure is only
+    redrawn when the axis limits have to change: the x axis leaves `x_margin`
+    of the window as headroom on the right, and y limits grow when the data
+    leaves them and shrink once they are 4 times its range. Data is min/max decimated
+    to `points_per_pixel` points per horizontal pixel before drawing.
+    '''
+
+    def __init__(self, fig, lines, points_per_pixel=2, x_margin=0.2, y_margin=0.1):
+        self.fig = fig
+        self.canvas = fig.canvas
+        self.lines = list(lines)
+        self.points_per_pixel = points_per_pixel
+        self.x_margin = x_margin
+        self.y_margin = y_margin
+
+        for line in self.lines:
+            line.set_animated(True)
+        self._background = None
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+
+        # Frame statistics
+        self.n_frames = 0
+        self.n_full_redraws = 0
+        self.last_draw_time = 0.
+        self._total_draw_time = 0.
+        self._frame_times = []
+
+    def _on_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_lines()
+
+    def _draw_lines(self):
+        for line in self.lines:
+            line.axes.draw_artist(line)
+
+    def update(self, x, y):
+        '''Plot y[:, i] against x on line i and refresh the canvas'''
+        start = time.perf_counter()
+        if len(x) == 0:
+            return
+
+        redraw = self._background is None
+        # All channels in one pass, sized for the first axis (the axes share their width)
+        n_bins = max(self.lines[0].axes.bbox.width * self.points_per_pixel / 2, 1)
+        x_dec, y_dec = minmax_decimate(x, y, n_bins)
+        y_limits = {} # axes -> (min, max) over its lines
+        for i, line in enumerate(self.lines):
+            line.set_data(x_dec[:, i], y_dec[:, i])
+            y_min, y_max = y_limits.get(line.axes, (np.inf, -np.inf))
+            y_limits[line.axes] = (min(y_min, y_dec[:, i].min()), max(y_max, y_dec[:, i].max()))
+        for ax, (y_min, y_max) in y_limits.items():
+            redraw |= self._update_limits(ax, x[0], x[-1], y_min, y_max)
+
+        if redraw or not getattr(self.canvas, 'supports_blit', False):
+            self.n_full_redraws += 1
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self._background)
+            self._draw_lines()
+            self.canvas.blit(self.fig.bbox)
+        self.canvas.flush_events()
+
+        self.last_draw_time = time.perf_counter() - start
+        self._total_draw_time += self.last_draw_time
+        self.n_frames += 1
+        self._frame_times.append(start)
+        del self._frame_times[:-50]
+
+    def _update_limits(self, ax, x_first, x_last, y_min, y_max):
+        changed = False
+        x_lo, x_hi = ax.get_xlim()
+        if x_last > x_hi or x_first < x_lo or (x_hi - x_lo) > 2 * (1 + self.x_margin) * max(x_last - x_first, 1e-9):
+            span = max(x_last - x_first, 1e-9)
+            ax.set_xlim(x_first, x_first + span * (1 + self.x_margin))
+            changed = True
+
+        y_lo, y_hi = ax.get_ylim()
+        height = y_max - y_min if y_max > y_min else max(abs(y_max), 1.)
+        if y_min < y_lo or y_max > y_hi or (y_hi - y_lo) > 4 * height:
+            ax.set_ylim(y_min - self.y_margin * height, y_max + self.y_margin * height)
+            changed = True
+        return changed
+
+    def stats(self):
+        frames = self._frame_times
+        fps = (len(frames) - 1) / (frames[-1] - frames[0]) if len(frames) > 1 and frames[-1] > frames[0] else 0.
+        return {'fps': fps,
+                'frames': self.n_frames,
+                'full_redraws': self.n_full_redraws,
+                'last_draw_ms': 1e3 * self.last_draw_time,
+                'mean_draw_ms': 1e3 * self._total_draw_time / max(self.n_frames, 1)}
@@ -0,0 +1,223 @@
+import argparse
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+import serial
+
+from serial_ingest import ChunkedSerialReader
+from ring_buffer import RingBuffer
+from recorder import make_recorder
+
+
+class ClockSync:
+    '''Maps firmware timestamps (ms) onto the host monotonic clock (s).
+
+    Every batch contributes one (device time of its last record, host time of
+    its arrival) pair. A least-squares line through the latest `window` pairs
+    gives the offset and the drift of the device clock. Transport latency only
+    ever delays arrivals, so pairs far above the fit are ignored on refit.
+    '''
+
+    def __init__(self, window=256):
+        self._pairs = deque(maxlen=window)
+        self.offset = None # host seconds at device time 0
+        self.rate = 1. # host seconds per device second
+
+    def add(self, device_ms, host_s):
+        self._pairs.append((device_ms / 1e3, host_s))
+        pairs = np.array(self._pairs)
+        device_s, host_s = pairs[:, 0], pairs[:, 1]
+        if len(pairs) < 2 or np.ptp(device_s) <= 0:
+            self.offset = np.min(host_s - device_s)
+            return
+
+        rate, offset = np.polyfit(device_s, host_s, 1)
+        residual = host_s - (offset + rate * device_s)
+        # Refit on the lower half, the least delayed arrivals
+        keep = residual <= np.median(residual)
+        if keep.sum() >= 2 and np.ptp(device_s[keep]) > 0:
+            rate, offset = np.polyfit(device_s[keep], host_s[keep], 1)
+        self.rate, self.offset = rate, offset
+
+    @property
+    def drift_ppm(self):
+        return (self.rate - 1.) * 1e6
+
+    def to_host(self, device_ms):
+        return self.offset + self.rate * np.asarray(device_ms) / 1e3
+
+
+class DeviceStream:
+    '''Reads one LaHMo receiver on its own thread.
+
+    Keeps the latest records in a RingBuffer, stamps every batch with the host
+    monotonic clock, and counts dropped samples from gaps in the firmware
+    timestamp column.
+
+    Args:
+        name (str): device name used in statistics and file names
+        port (str or serial-like): serial port to read from
+        sample_interval_ms (float, optional): Nominal firmware sample interval, estimated from the data if None.
+        max_len (int, optional): Records kept in memory. Defaults to 10000.
+        filename (str, optional): Record the raw stream to this csv or .lhm file.
+    '''
+
+    def __init__(self, name, port, baudrate=115200, sample_interval_ms=None, max_len=10000, filename=None):
+        self.name = name
+        # The read timeout lets the reader thread notice stop() on a silent port
+        self.ser = port if hasattr(port, 'read') else serial.Serial(port=port, baudrate=baudrate, timeout=0.5)
+        self.sample_interval_ms = sample_interval_ms
+        self.buffer = RingBuffer(max_len, n_channels=8)
+        self.clock = ClockSync()
+        self.recorder = make_recorder(filename) if filename else None
+
+        self._reader = ChunkedSerialReader(self.ser)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'reader-{name}', daemon=True)
+
+        self.n_dropped = 0
+        self.start_time = None
+        self._last_device_ts = None
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self.recorder:
+            self.recorder.close()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            records, _ = self._reader.read()
+            host_s = time.monotonic()
+            if len(records):
+                self._add_batch(records, host_s)
+
+    def _add_batch(self, records, host_s):
+        timestamps = records[:, 0]
+        if self._last_device_ts is not None:
+            timestamps = np.concatenate([[self._last_device_ts], timestamps])
+        gaps = np.diff(timestamps)
+        if self.sample_interval_ms is None and self.buffer.total >= 16:
+            # Estimated once from the first samples; gaps before that are not counted
+            self.sample_interval_ms = float(np.median(np.diff(self.buffer.snapshot().data[:, 0])))
+        if self.sample_interval_ms:
+            self.n_dropped += int(np.sum(np.maximum(np.round(gaps / self.sample_interval_ms) - 1, 0)))
+        self._last_device_ts = records[-1, 0]
+
+        self.clock.add(records[-1, 0], host_s)
+        self.buffer.extend(records)
+        if self.recorder:
+            self.recorder.put(records, host_s)
+
+    def host_view(self):
+        '''Latest records with the timestamp column mapped onto the host clock (s)'''
+        data = self.buffer.snapshot().data
+        return self.clock.to_host(data[:, 0]), data[:, 1:]
+
+    def stats(self):
+        elapsed = time.monotonic() - self.start_time if self.start_time else 0.
+        n_records = self._reader.n_records
+        return {'samples': n_records,
+                'samples_per_s': n_records / elapsed if elapsed else 0.,
+                'bytes': self._reader.n_bytes,
+                'malformed': self._reader.n_malformed,
+                'undecodable': self._reader.n_undecodable,
+                'dropped': self.n_dropped,
+                'drop_ratio': self.n_dropped / max(self.n_dropped + n_records, 1),
+                'clock_offset_s': self.clock.offset if self.clock.offset is not None else float('nan'),
+                'clock_drift_ppm': self.clock.drift_ppm}
+
+
+class AcquisitionManager:
+    '''Reads several LaHMo receivers concurrently, one reader thread per port.
+
+    Args:
+        ports (list): serial ports (or serial-like objects)
+        names (list of str, optional): Device names. Defaults to dev0, dev1, ...
+        filename_pattern (str, optional): Per-device recording path with a {name} field.
+    '''
+
+    def __init__(self, ports, names=None, filename_pattern=None, **stream_kwargs):
+        names = names or [f'dev{i}' for i in range(len(ports))]
+        if len(names) != len(ports):
+            raise ValueError('One name per port is needed.')
+        self.streams = {name: DeviceStream(name, port,
+                                           filename=filename_pattern.format(name=name) if filename_pattern else None,
+                                           **stream_kwargs)
+                        for name, port in zip(names, ports)}
+
+    def start(self):
+        for stream in self.streams.values():
+            stream.start()
+
+    def stop(self):
+        for stream in self.streams.values():
+            stream.stop()
+
+    def stats(self):
+        return {name: stream.stats() for name, stream in self.streams.items()}
+
+    def merged(self, rate_hz=10.):
+        '''Resample every device onto one host-clock grid over the time they overlap.
+
+        Returns:
+            tuple: (t, data), t is (n,) host seconds and data is (n, 7 * n_devices),
+            device after device in the order of `streams`
+        '''
+        views = [stream.host_view() for stream in self.streams.values()]
+        if any(len(t) < 2 for t, _ in views):
+            return np.empty(0), np.empty((0, 7 * len(views)))
+        start = max(t[0] for t, _ in views)
+        end = min(t[-1] for t, _ in views)
+        t = np.arange(start, end, 1. / rate_hz)
+        data = np.empty((len(t), 7 * len(views)))
+        for i, (t_dev, values) in enumerate(views):
+            for ch in range(values.shape[1]):
+                data[:, 7*i+ch] = np.interp(t, t_dev, values[:, ch])
+        return t, data
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Read several LaHMo receivers on a shared clock.')
+    parser.add_argument('--ports', nargs='+', required=True,
+                        help='The serial ports to read from.')
+    parser.add_argument('--names', nargs='+',
+                        help='Device names, one per port (e.g. subject reference).')
+    parser.add_argument('--format', choices=['csv', 'lhm'], default='csv',
+                        help='Recording format, default csv.')
+    parser.add_argument('--no-record', action='store_true',
+                        help='Do not write the streams to disk.')
+    parser.add_argument('--interval', default=1., type=float,
+                        help='Seconds between statistics printouts, default 1.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    time_str = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
+    pattern = None if args.no_record else f'dataset/ble_test/test-{time_str}-{{name}}.{args.format}'
+    manager = AcquisitionManager(args.ports, names=args.names, filename_pattern=pattern)
+    manager.start()
+    try:
+        while True:
+            time.sleep(args.interval)
+            for name, stats in manager.stats().items():
+                print(f'{name}: {stats["samples_per_s"]:.1f} samples/s, {stats["dropped"]} dropped, '
+                      f'{stats["malformed"]} malformed, offset {stats["clock_offset_s"]:.3f} s, '
+                      f'drift {stats["clock_drift_ppm"]:.0f} ppm')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,50 @@
+import argparse
 import sys
 from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QVBoxLayout, QWidget, QListWidget, QTextEdit
 from PyQt5.QtBluetooth import QBluetoothDeviceDiscoveryAgent, QLowEnergyController, QBluetoothUuid, QLowEnergyService
-from PyQt5.QtCore import Qt, pyqtSignal, QByteArray
+from PyQt5.QtCore import Qt, QByteArray, QTimer
 
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 
+from frames import FrameDecoder
+from ring_buffer import RingBuffer
+from live_plot import LivePlot
+from recorder import make_recorder
+
 LHM_DEVICE_NAME  = 'LHM_Yihan'
 LHM_SERVICE_UUID = '12fb95d1-4954-450f-a82b-802f71541562'
 LHM_CHAR_UUID    = '67136980-20d0-4711-8b37-3acd0fec8e7f'
 
+# Lines kept in the text log
+LOG_LINES = 200
+
 class LHMReceiver(QMainWindow):
-    
-    # A custom signal for emitting received data
-    dataReceived = pyqtSignal(str)
 
-    def __init__(self):
+    def __init__(self, max_len=3000, refresh_interval=50, filename=None):
         '''
         Initialize the UI and the BLE device discovery agent.
+
+        Notifications are only queued as raw bytes. Every `refresh_interval` ms the queued
+        notifications are parsed in one batch into a buffer of the latest `max_len` records,
+        handed to the recorder thread (if `filename` is given), logged and plotted.
         '''
         super().__init__()
+        self.buffer = RingBuffer(max_len, n_channels=8)
+        self.recorder = make_recorder(filename) if filename else None
+        self.decoder = FrameDecoder()
+        self._pending = []
+        self.n_notifications = 0
+
         self.initUI()
         self.deviceDiscoveryAgent = QBluetoothDeviceDiscoveryAgent()
         self.deviceDiscoveryAgent.deviceDiscovered.connect(self.addDevice)
         self.devices = []
 
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.timeout.connect(self.refreshDisplay)
+        self.refreshTimer.start(refresh_interval)
+
     def initUI(self):
         '''
         Sets up the GUI, including a button for starting the scan and a list widget for displaying discovered devices.
@@ -54,14 +74,22 @@ class LHMReceiver(QMainWindow):
         centralWidget.setLayout(layout)
         self.setCentralWidget(centralWidget)
 
+        # Text log of the latest records, older lines are dropped
         self.dataDisplay = QTextEdit()
         self.dataDisplay.setReadOnly(True)
+        self.dataDisplay.document().setMaximumBlockCount(LOG_LINES)
         layout.addWidget(self.dataDisplay)
-        self.dataReceived.connect(self.updateDataDisplay)
 
-        self.fig, self.ax = plt.subplots()
+        # Photovoltages and angles
+        self.fig, (self.ax_pv, self.ax_ori) = plt.subplots(2, 1, sharex=True)
+        lines = [self.ax_pv.plot([], [], label=f'PV{i}')[0] for i in range(4)]
+        lines += [self.ax_ori.plot([], [], label=label)[0] for label in ('Roll', 'Pitch', 'Yaw')]
+        self.ax_pv.legend(loc='upper left', ncol=4)
+        self.ax_ori.legend(loc='upper left', ncol=3)
+        self.ax_ori.set_xlabel('Time (s)')
         self.canvas = FigureCanvas(self.fig)
         layout.addWidget(self.canvas)
+        self.livePlot = LivePlot(self.fig, lines)
 
     def startScan(self):
         '''
@@ -163,8 +191,9 @@ class LHMReceiver(QMainWindow):
                 print('Characteristic not found')
 
     def characteristicChanged(self, char, value):
-        data = value.data.decode()
-        self.dataReceived.emit(data)
+        # Parsed in batches by refreshDisplay
+        self._pending.append(bytes(value))
+        self.n_notifications += 1
 
     def descriptorWritten(self, descriptor, newValue):
         print('Descriptor written.')
@@ -172,30 +201,54 @@ class LHMReceiver(QMainWindow):
     '''
     Data display
     '''
-    def updateDataDisplay(self, data):
-        try:
-            split_data = data.split('\t')
-
-            timestamp = int(split_data[0])
-            photovoltage0 = float(split_data[1])
-            photovoltage1 = float(split_data[2])
-            photovoltage2 = float(split_data[3])
-            photovoltage3 = float(split_data[4])
-            roll = float(split_data[5])
-            pitch = float(split_data[6])
-            yaw = float(split_data[7])
-
-            display_text = f'Timestamp: {timestamp}, PV0: {photovoltage0}, PV1: {photovoltage1}, PV2: {photovoltage2}, PV3: {photovoltage3}, Roll: {roll}, Pitch: {pitch}, Yaw: {yaw}'
-            self.dataDisplay.append(display_text)
-
-        except ValueError:
-            print('Error parsing data: ', data)
-
-        except IndexError:
-            print('Incomplete data received: ', data)
+    def refreshDisplay(self):
+        '''
+        Parses the notifications queued since the last refresh and updates the log and the plot.
+        '''
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        # Packed frames or one text sample per notification, see frames.py
+        n_malformed = self.decoder.n_malformed
+        records = self.decoder.decode(pending)
+        if self.decoder.n_malformed > n_malformed:
+            print(f'Skipped {self.decoder.n_malformed - n_malformed} malformed notifications')
+        if not len(records):
+            return
+
+        self.buffer.extend(records)
+        if self.recorder:
+            self.recorder.put(records)
+
+        lines = [f'Timestamp: {r[0]:.0f}, PV0: {r[1]:.4f}, PV1: {r[2]:.4f}, PV2: {r[3]:.4f}, PV3: {r[4]:.4f}, '
+                 f'Roll: {r[5]:.2f}, Pitch: {r[6]:.2f}, Yaw: {r[7]:.2f}' for r in records[-LOG_LINES:]]
+        self.dataDisplay.append('\n'.join(lines))
+
+        data = self.buffer.snapshot().data
+        self.livePlot.update(data[:, 0] / 1e3, data[:, 1:])
+
+    def closeEvent(self, event):
+        self.refreshTimer.stop()
+        self.refreshDisplay()
+        if self.recorder:
+            self.recorder.close()
+        super().closeEvent(event)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Receive and plot LaHMo data over BLE.')
+    parser.add_argument('-r', '--record',
+                        help='Record the stream to this csv or .lhm file.')
+    parser.add_argument('--max-len', default=3000, type=int,
+                        help='Records kept in memory and plotted, default 3000')
+    parser.add_argument('--refresh-interval', default=50, type=int,
+                        help='Milliseconds between display refreshes, default 50')
+    args, _ = parser.parse_known_args()
+    return args
 
 if __name__ == '__main__':
+    args = parse_args()
     app = QApplication(sys.argv)
-    lhm_receiver = LHMReceiver()
+    lhm_receiver = LHMReceiver(max_len=args.max_len, refresh_interval=args.refresh_interval, filename=args.record)
     lhm_receiver.show()
     sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,232 @@
+import csv
+import io
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from session_file import SessionWriter
+
+FSYNC_POLICIES = ('never', 'flush', 'close')
+
+
+class Recorder:
+    '''Writes record batches to a file from a dedicated thread.
+
+    The acquisition thread only enqueues (n, 8) arrays. The recorder thread
+    drains everything that is queued, writes it in one go, and flushes the file
+    when `flush_bytes` have accumulated or `flush_interval` seconds have passed,
+    whichever comes first. `close` drains the queue before returning.
+    Subclasses implement `_open` and `_write` for a specific file format.
+
+    Args:
+        filename (str): file to append to
+        max_queue (int, optional): Maximum number of batches waiting to be written. Defaults to 1024.
+        flush_interval (float, optional): Seconds between flushes. Defaults to 1.
+        flush_bytes (int, optional): Pending bytes that trigger an early flush. Defaults to 1 MiB.
+        fsync (str, optional): 'never', 'flush' (fsync on every flush) or 'close'. Defaults to 'never'.
+    '''
+
+    _SENTINEL = None
+
+    def __init__(self, filename, max_queue=1024, flush_interval=1., flush_bytes=1 << 20, fsync='never'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'Unknown fsync policy: {fsync}')
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.fsync = fsync
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = self._open()
+        self._closed = False
+        self._error = None # exception that stopped the writer thread
+
+        # Metrics
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.n_flushes = 0
+        self.n_queue_full = 0
+        self.max_queue_depth = 0
+        self.max_write_latency = 0.
+        self._total_write_latency = 0.
+        self._n_writes = 0
+        self.max_e2e_latency = 0.
+        self._total_e2e_latency = 0.
+
+        self._thread = threading.Thread(target=self._run, name='recorder', daemon=True)
+        self._thread.start()
+
+    def put(self, records, read_time=None):
+        '''Queue an (n, 8) batch for writing. Blocks only if the queue is full.
+
+        Raises RuntimeError, from the writer's exception, once the writer thread died.
+
+        read_time is the time.monotonic() at which the batch was read from the
+        port, used for the end-to-end latency. Defaults to now.
+        '''
+        if self._closed:
+            raise RuntimeError('Recorder is closed.')
+        self._raise_writer_error()
+        item = (records, time.monotonic() if read_time is None else read_time)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.n_queue_full += 1
+            self._put(item)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def _put(self, item):
+        # Wait for room only while the writer thread can still make some
+        while True:
+            self._raise_writer_error()
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _raise_writer_error(self):
+        if self._error is not None:
+            raise RuntimeError(f'Recorder thread failed writing {self.filename}') from self._error
+        if not self._thread.is_alive():
+            raise RuntimeError(f'Recorder thread for {self.filename} is not running')
+
+    def close(self):
+        '''Write everything still queued, flush (and fsync if requested) and close the file
+
+        Raises the exception of the writer thread, if it died.
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread.is_alive():
+            try:
+                self._put(self._SENTINEL)
+            except RuntimeError:
+                pass
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError(f'Recorder thread failed writing {self.filename}') from self._error
+
+    def _run(self):
+        try:
+            self._drain()
+        except BaseException as e:
+            self._error = e
+            try:
+                self._file.close()
+            except Exception:
+                pass
+
+    def _drain(self):
+        pending_bytes = 0
+        last_flush = time.perf_counter()
+        done = False
+
+        while not done:
+            timeout = max(self.flush_interval - (time.perf_counter() - last_flush), 0.)
+            batches = []
+            try:
+                batches.append(self._queue.get(timeout=timeout))
+                # Group-commit whatever else is already waiting
+                while True:
+                    batches.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if any(b is self._SENTINEL for b in batches):
+                done = True
+                batches = [b for b in batches if b is not self._SENTINEL]
+
+            start = time.perf_counter()
+            if batches:
+                records = np.concatenate([records for records, _ in batches])
+                n_bytes = self._write(records)
+                self.rows_written += records.shape[0]
+                self.bytes_written += n_bytes
+                pending_bytes += n_bytes
+            if done or pending_bytes >= self.flush_bytes or time.perf_counter() - last_flush >= self.flush_interval:
+                if pending_bytes:
+                    self._flush(self.fsync == 'flush')
+                    pending_bytes = 0
+                last_flush = time.perf_counter()
+            if batches:
+                self._record_latency(time.perf_counter() - start, time.monotonic() - batches[0][1])
+
+        self._file.flush()
+        if self.fsync != 'never':
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+    def _open(self):
+        raise NotImplementedError
+
+    def _write(self, records):
+        '''Write an (n, 8) array and return the number of bytes written'''
+        raise NotImplementedError
+
+    def _flush(self, fsync):
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+        self.n_flushes += 1
+
+    def _record_latency(self, latency, e2e_latency):
+        self._n_writes += 1
+        self._total_write_latency += latency
+        self.max_write_latency = max(self.max_write_latency, latency)
+        # From the oldest batch being read off the port to it being written
+        self._total_e2e_latency += e2e_latency
+        self.max_e2e_latency = max(self.max_e2e_latency, e2e_latency)
+
+    def stats(self):
+        return {'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'queue_full': self.n_queue_full,
+                'rows_written': self.rows_written,
+                'bytes_written': self.bytes_written,
+                'flushes': self.n_flushes,
+                'mean_write_latency_ms': 1e3 * self._total_write_latency / max(self._n_writes, 1),
+                'max_write_latency_ms': 1e3 * self.max_write_latency,
+                'mean_e2e_latency_ms': 1e3 * self._total_e2e_latency / max(self._n_writes, 1),
+                'max_e2e_latency_ms': 1e3 * self.max_e2e_latency}
+
+
+class CsvRecorder(Recorder):
+    '''Appends records to a csv file, rounding the timestamp to 3 decimals'''
+
+    def _open(self):
+        return open(self.filename, 'a+', newline='', buffering=max(self.flush_bytes, io.DEFAULT_BUFFER_SIZE))
+
+    def _write(self, records):
+        rows = records.copy()
+        rows[:, 0] = np.around(rows[:, 0], 3)
+        text = io.StringIO()
+        csv.writer(text).writerows(rows.tolist())
+        text = text.getvalue()
+        self._file.write(text)
+        return len(text)
+
+
+class SessionRecorder(Recorder):
+    '''Appends records to a binary .lhm session file (see session_file.py)'''
+
+    def __init__(self, filename, device_id='', dtype='float64', **kwargs):
+        self.device_id = device_id
+        self.dtype = dtype
+        super().__init__(filename, **kwargs)
+
+    def _open(self):
+        return SessionWriter(self.filename, device_id=self.device_id, dtype=self.dtype)
+
+    def _write(self, records):
+        return self._file.write(records)
+
+
+def make_recorder(filename, **kwargs):
+    '''Pick the recorder from the file extension: .lhm for session files, csv otherwise'''
+    if filename.endswith('.lhm'):
+        return SessionRecorder(filename, **kwargs)
+    return CsvRecorder(filename, **kwargs)
@@ -0,0 +1,78 @@
+from collections import namedtuple
+
+import numpy as np
+
+# data is a read-only view of the latest rows, end is the total number of rows written when it was taken
+Snapshot = namedtuple('Snapshot', ['data', 'end'])
+
+
+class RingBuffer:
+    '''Single-writer/multi-reader ring buffer of fixed-width numeric records.
+
+    The storage is one preallocated array in which every row is written twice,
+    at i and i + length, so the latest n rows are always a contiguous slice and
+    snapshots are returned as views instead of copies. The ring is `slack` rows
+    longer than `capacity`: a snapshot stays intact until the writer has added at
+    least `slack` more rows, which readers can check with `is_intact`.
+
+    The writer publishes the row count only after the rows are in place, so a
+    reader never sees a half-written row.
+    '''
+
+    def __init__(self, capacity, n_channels=8, slack=None, dtype=np.float64):
+        self.capacity = capacity
+        self.n_channels = n_channels
+        self.slack = capacity if slack is None else slack
+        self._length = self.capacity + self.slack
+        self._buf = np.zeros((2 * self._length, n_channels), dtype=dtype)
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def total(self):
+        '''Number of rows written since creation'''
+        return self._count
+
+    def append(self, row):
+        pos = self._count % self._length
+        self._buf[pos] = row
+        self._buf[pos + self._length] = row
+        self._count += 1
+
+    def extend(self, rows):
+        '''Append an (n, n_channels) block of rows (writer thread only)'''
+        rows = np.asarray(rows)
+        n_rows = rows.shape[0]
+        if n_rows == 0:
+            return
+        count = self._count
+        if n_rows > self._length:
+            # Only the tail survives anyway
+            count += n_rows - self._length
+            rows = rows[-self._length:]
+            n_rows = self._length
+
+        pos = count % self._length
+        first = min(n_rows, self._length - pos)
+        self._buf[pos:pos+first] = rows[:first]
+        self._buf[pos+self._length:pos+self._length+first] = rows[:first]
+        rest = n_rows - first
+        if rest:
+            self._buf[:rest] = rows[first:]
+            self._buf[self._length:self._length+rest] = rows[first:]
+        self._count = count + n_rows
+
+    def snapshot(self, n=None):
+        '''Return a read-only view of the latest n rows (all buffered rows by default)'''
+        end = self._count
+        n = min(end, self.capacity) if n is None else min(n, end, self.capacity)
+        start = (end - n) % self._length
+        view = self._buf[start:start+n]
+        view.flags.writeable = False
+        return Snapshot(view, end)
+
+    def is_intact(self, snapshot):
+        '''Check that the writer has not wrapped around onto a snapshot yet'''
+        return self._count - snapshot.end <= self._length - snapshot.data.shape[0]
@@ -0,0 +1,123 @@
+import io
+
+import numpy as np
+
+# timestamp, pv0, pv1, pv2, pv3, roll, pitch, yaw
+N_FIELDS = 8
+
+
+def parse_records(block, n_fields=N_FIELDS):
+    '''Parse a block of complete tab-separated lines in one vectorized step.
+
+    Args:
+        block (bytes): newline-separated records, without a trailing partial line
+        n_fields (int, optional): Number of columns per record. Defaults to 8.
+
+    Returns:
+        tuple: (records, n_malformed, n_undecodable), records is an (n, n_fields) float64 array
+    '''
+    if not block.strip():
+        return np.empty((0, n_fields)), 0, 0
+
+    if block.isascii():
+        try:
+            records = np.loadtxt(io.BytesIO(block), delimiter='\t', comments=None,
+                                 dtype=np.float64, ndmin=2)
+            if records.shape[1] == n_fields:
+                return records, 0, 0
+        except ValueError:
+            pass
+
+    # Slow path: at least one line is corrupted, sort them out one by one
+    rows = []
+    n_malformed = 0
+    n_undecodable = 0
+    for line in block.split(b'\n'):
+        try:
+            split_strings = line.decode('utf-8').strip().split('\t')
+        except UnicodeDecodeError:
+            n_undecodable += 1
+            continue
+        if split_strings == ['']:
+            continue
+        if len(split_strings) != n_fields:
+            n_malformed += 1
+            continue
+        try:
+            rows.append([float(s) for s in split_strings])
+        except ValueError:
+            n_malformed += 1
+
+    records = np.array(rows, dtype=np.float64).reshape(-1, n_fields)
+    return records, n_malformed, n_undecodable
+
+
+class ChunkedSerialReader:
+    '''Drains the serial input buffer in bulk and parses it batch by batch.
+
+    Bytes after the last newline are carried over to the next read, so records
+    split across two reads are parsed once they are complete. A partial line
+    longer than max_line (e.g. noise without newlines) is dropped along with the
+    rest of it up to the next newline, and counted as one malformed record.
+    '''
+
+    def __init__(self, ser, n_fields=N_FIELDS, max_chunk=1 << 16, max_line=4096):
+        self.ser = ser
+        self.n_fields = n_fields
+        self.max_chunk = max_chunk
+        self.max_line = max_line
+        self._residual = b''
+        self._dropping = False
+
+        # Counters
+        self.n_bytes = 0
+        self.n_records = 0
+        self.n_malformed = 0
+        self.n_undecodable = 0
+        self.n_dropped = 0
+
+    def feed(self, data):
+        '''Append raw bytes and parse every record completed by them.
+
+        Returns:
+            tuple: (records, n_undecodable) for this batch
+        '''
+        self.n_bytes += len(data)
+        if self._dropping:
+            # Still inside an overlong line, skip to its end
+            start = data.find(b'\n')
+            self.n_dropped += len(data) if start < 0 else start + 1
+            if start < 0:
+                return np.empty((0, self.n_fields)), 0
+            self._dropping = False
+            data = data[start+1:]
+
+        buf = self._residual + data
+        end = buf.rfind(b'\n')
+        self._residual = buf[end+1:]
+        if len(self._residual) > self.max_line:
+            self.n_dropped += len(self._residual)
+            self.n_malformed += 1
+            self._residual = b''
+            self._dropping = True
+        if end < 0:
+            return np.empty((0, self.n_fields)), 0
+
+        records, n_malformed, n_undecodable = parse_records(buf[:end], self.n_fields)
+        self.n_records += records.shape[0]
+        self.n_malformed += n_malformed
+        self.n_undecodable += n_undecodable
+        return records, n_undecodable
+
+    def read(self):
+        '''Read everything waiting on the port (blocking for at least one byte) and parse it.'''
+        n_waiting = self.ser.in_waiting
+        data = self.ser.read(min(max(n_waiting, 1), self.max_chunk))
+        return self.feed(data)
+
+    def stats(self):
+        return {'bytes': self.n_bytes,
+                'records': self.n_records,
+                'malformed': self.n_malformed,
+                'undecodable': self.n_undecodable,
+                'dropped_bytes': self.n_dropped}
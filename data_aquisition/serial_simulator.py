@@ -0,0 +1,162 @@
+import argparse
+import os
+import select
+import threading
+import time
+import tty
+
+import numpy as np
+
+
+class SerialSimulator:
+    '''Stand-in for the LaHMo receiver on a pseudo-terminal.
+
+    Prints `timestamp\\tpv0\\tpv1\\tpv2\\tpv3\\troll\\tpitch\\tyaw\\r\\n` lines like
+    pharyngeal_sensor_foldable_receiver/src/main.cpp, at `rate_hz` samples per
+    second. `port` is the device path to open with pyserial or SerialPlotter.
+
+    Args:
+        rate_hz (float, optional): Samples per second. Defaults to 10.
+        csv_filename (str, optional): Replay the channels of this recording (looped) instead of synthetic data.
+        jitter_ms (float, optional): Standard deviation of the firmware timestamp jitter. Defaults to 0.
+        corrupt_prob (float, optional): Probability that a line gets one corrupted byte. Defaults to 0.
+        disconnect_every_s (float, optional): Seconds between disconnect bursts, 0 for none. Defaults to 0.
+        disconnect_len_s (float, optional): Duration of a disconnect burst, during which only
+            undecodable bytes are sent. Defaults to 1.
+        seed (int, optional): Random seed. Defaults to 0.
+    '''
+
+    def __init__(self, rate_hz=10., csv_filename=None, jitter_ms=0., corrupt_prob=0.,
+                 disconnect_every_s=0., disconnect_len_s=1., seed=0):
+        self.rate_hz = rate_hz
+        self.jitter_ms = jitter_ms
+        self.corrupt_prob = corrupt_prob
+        self.disconnect_every_s = disconnect_every_s
+        self.disconnect_len_s = disconnect_len_s
+        self._rng = np.random.default_rng(seed)
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        # Channel values are formatted once and looped over
+        if csv_filename:
+            values = np.loadtxt(csv_filename, delimiter=',', ndmin=2)[:, 1:]
+        else:
+            values = self._synthesize(10000)
+        self._lines = ['\t'.join(f'{v:.4f}' for v in row) for row in values]
+
+        self.n_sent = 0
+        self.n_corrupted = 0
+        self._next_sample = 0
+        self.n_disconnects = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='serial-simulator', daemon=True)
+
+    def _synthesize(self, n):
+        t = np.arange(n) / max(self.rate_hz, 1.)
+        pv = 0.5 + 0.05 * np.sin(2 * np.pi * 0.3 * t)[:, None] + 0.01 * self._rng.standard_normal((n, 4))
+        angles = np.cumsum(self._rng.standard_normal((n, 3)), axis=0)
+        return np.hstack([pv, angles])
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def close(self):
+        self.stop()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _format(self, first, n):
+        interval_ms = 1e3 / self.rate_hz
+        timestamps = (np.arange(first, first + n) * interval_ms).round()
+        if self.jitter_ms:
+            timestamps += self._rng.normal(0, self.jitter_ms, n).round()
+        lines = [f'{int(ts)}\t{self._lines[i % len(self._lines)]}\r\n'.encode()
+                 for ts, i in zip(timestamps, range(first, first + n))]
+        if self.corrupt_prob:
+            for i in np.flatnonzero(self._rng.random(n) < self.corrupt_prob):
+                line = bytearray(lines[i])
+                line[self._rng.integers(len(line) - 2)] = self._rng.integers(0x80, 0x100)
+                lines[i] = bytes(line)
+                self.n_corrupted += 1
+        return b''.join(lines)
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view and not self._stop_event.is_set():
+            # Waits when the reader falls behind and the pty buffer is full
+            _, writable, _ = select.select([], [self._master], [], 0.1)
+            if writable:
+                view = view[os.write(self._master, view):]
+
+    def _run(self):
+        start = time.monotonic()
+        next_disconnect = self.disconnect_every_s or np.inf
+        while not self._stop_event.is_set():
+            elapsed = time.monotonic() - start
+            if elapsed >= next_disconnect:
+                self.n_disconnects += 1
+                while time.monotonic() - start < next_disconnect + self.disconnect_len_s and not self._stop_event.is_set():
+                    self._write(bytes(self._rng.integers(0x80, 0x100, 64, dtype=np.uint8)) + b'\n')
+                    time.sleep(0.01)
+                next_disconnect += self.disconnect_every_s
+                # The receiver does not buffer samples across a disconnect
+                self._next_sample = int((time.monotonic() - start) * self.rate_hz)
+                continue
+
+            due = int(elapsed * self.rate_hz) - self._next_sample
+            if due > 0:
+                self._write(self._format(self._next_sample, due))
+                self._next_sample += due
+                self.n_sent += due
+            time.sleep(0.001)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Simulate a LaHMo receiver on a pseudo-terminal.')
+    parser.add_argument('-r', '--rate', default=10., type=float,
+                        help='Samples per second, default 10')
+    parser.add_argument('-c', '--csv',
+                        help='Recording to replay instead of synthetic data.')
+    parser.add_argument('--jitter', default=0., type=float,
+                        help='Timestamp jitter in ms, default 0')
+    parser.add_argument('--corrupt', default=0., type=float,
+                        help='Probability of a corrupted byte per line, default 0')
+    parser.add_argument('--disconnect-every', default=0., type=float,
+                        help='Seconds between disconnect bursts, default 0 (none)')
+    parser.add_argument('--disconnect-len', default=1., type=float,
+                        help='Seconds per disconnect burst, default 1')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    simulator = SerialSimulator(rate_hz=args.rate, csv_filename=args.csv, jitter_ms=args.jitter,
+                                corrupt_prob=args.corrupt, disconnect_every_s=args.disconnect_every,
+                                disconnect_len_s=args.disconnect_len)
+    print(f'Simulating a LaHMo receiver on {simulator.port}')
+    simulator.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+'''Append-only binary session files (.lhm) for LaHMo recordings.
+
+Layout of `<name>.lhm`:
+    magic (8 bytes) | header length (uint32) | JSON header, padded to 64 bytes | records
+
+The JSON header holds the channel names, units, device id, record dtype, time
+dtype and chunk size. Records are fixed-size rows of a time value and
+n_channels - 1 float32/float64 values appended back to back. The time column
+is float64 whatever the record dtype (float32 ms stop resolving single
+milliseconds after about 4.6 h), so float64 sessions map to one
+(n, n_channels) array, and float32 ones to a structured array. Files written
+before the time dtype existed store time in the record dtype.
+
+Every `chunk_rows` records the writer appends (first row, n rows, first
+timestamp, last timestamp) to the sidecar `<name>.lhm.idx`. The reader uses that
+time index to locate a time range and rebuilds it from the timestamp column if
+the sidecar is missing or stale (e.g. after a crash).
+'''
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+MAGIC = b'LHMSESS1'
+ALIGNMENT = 64
+
+CHANNELS = ('timestamp', 'pv0', 'pv1', 'pv2', 'pv3', 'roll', 'pitch', 'yaw')
+UNITS = ('ms', 'mV', 'mV', 'mV', 'mV', 'deg', 'deg', 'deg')
+
+TIME_DTYPE = '<f8'
+
+INDEX_DTYPE = np.dtype([('row', '<u8'), ('n_rows', '<u8'), ('t_first', '<f8'), ('t_last', '<f8')])
+
+
+class SessionWriter:
+    '''Appends record batches to a .lhm file and maintains its chunk time index.
+
+    Args:
+        path (str): output file, created if needed and appended to otherwise
+        channels (sequence of str, optional): Channel names, the first one is the time column. Defaults to CHANNELS.
+        units (sequence of str, optional): Channel units. Defaults to UNITS.
+        device_id (str, optional): Identifier of the recording device. Defaults to ''.
+        dtype (str, optional): 'float32' or 'float64'. Defaults to 'float64'.
+        chunk_rows (int, optional): Records per index entry. Defaults to 4096.
+    '''
+
+    def __init__(self, path, channels=CHANNELS, units=UNITS, device_id='', dtype='float64', chunk_rows=4096):
+        self.path = path
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            header, data_offset = read_header(path)
+            dtype, chunk_rows = header['dtype'], header['chunk_rows']
+            channels = header['channels']
+        else:
+            header = {'version': 2,
+                      'channels': list(channels),
+                      'units': list(units),
+                      'device_id': device_id,
+                      'dtype': np.dtype(dtype).str,
+                      'time_dtype': TIME_DTYPE,
+                      'chunk_rows': chunk_rows,
+                      'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+            data_offset = _write_header(path, header)
+
+        self.header = header
+        self.dtype = np.dtype(dtype)
+        self.n_channels = len(channels)
+        self.chunk_rows = chunk_rows
+        self._record_dtype = record_dtype(header)
+        self._record_size = self._record_dtype.itemsize
+
+        self._file = open(path, 'r+b')
+        # Drop a partially written trailing record, if any
+        n_rows = (os.path.getsize(path) - data_offset) // self._record_size
+        self._file.truncate(data_offset + n_rows * self._record_size)
+        self._file.seek(0, os.SEEK_END)
+        self.n_rows = n_rows
+
+        # Restart indexing at the last complete chunk
+        records = np.memmap(path, dtype=self._record_dtype, mode='r', offset=data_offset, shape=(n_rows,)) \
+            if n_rows else np.empty(0, dtype=self._record_dtype)
+        index = _rebuild_index(records['t'], chunk_rows)
+        complete = index[index['n_rows'] == chunk_rows]
+        with open(path + '.idx', 'wb') as f:
+            f.write(complete.tobytes())
+        self._index_file = open(path + '.idx', 'ab')
+        self._chunk_start = int(complete['row'][-1] + chunk_rows) if len(complete) else 0
+        self._chunk_t_first = index['t_first'][-1] if len(index) > len(complete) else None
+        self._chunk_t_last = index['t_last'][-1] if len(index) > len(complete) else None
+
+    def write(self, records):
+        '''Append an (n, n_channels) batch and return the number of bytes written'''
+        records = np.asarray(records)
+        if records.ndim != 2 or records.shape[1] != self.n_channels:
+            raise ValueError(f'Expected records of shape (n, {self.n_channels}), got {records.shape}')
+        records = _pack(records, self._record_dtype)
+
+        start = 0
+        while start < records.shape[0]:
+            # Split the batch at chunk boundaries so every index entry covers chunk_rows records
+            n = min(records.shape[0] - start, self._chunk_start + self.chunk_rows - self.n_rows)
+            chunk = records[start:start+n]
+            t = chunk['t']
+            if self._chunk_t_first is None:
+                self._chunk_t_first = t[0]
+            self._chunk_t_last = t[-1]
+            self._file.write(chunk.tobytes())
+            self.n_rows += n
+            start += n
+            if self.n_rows - self._chunk_start == self.chunk_rows:
+                self._write_index_entry()
+        return records.nbytes
+
+    def _write_index_entry(self):
+        entry = np.array([(self._chunk_start, self.n_rows - self._chunk_start,
+                           self._chunk_t_first, self._chunk_t_last)], dtype=INDEX_DTYPE)
+        self._index_file.write(entry.tobytes())
+        self._chunk_start = self.n_rows
+        self._chunk_t_first = self._chunk_t_last = None
+
+    def flush(self):
+        self._file.flush()
+        self._index_file.flush()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self.n_rows > self._chunk_start:
+            # Partial last chunk; a later writer truncates and rewrites it
+            self._write_index_entry()
+        self._file.close()
+        self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SessionReader:
+    '''Memory-maps a .lhm file and serves zero-copy views of it.
+
+    Assumes the time column is non-decreasing, as written by the receiver.
+    `data` is the (n, n_channels) view of sessions whose time column has the
+    record dtype and None for float32 ones, whose time column is float64.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.header, data_offset = read_header(path)
+        self.dtype = np.dtype(self.header['dtype'])
+        self.channels = list(self.header['channels'])
+        self.units = list(self.header['units'])
+        self.device_id = self.header['device_id']
+
+        n_channels = len(self.channels)
+        records = record_dtype(self.header)
+        n_rows = (os.path.getsize(path) - data_offset) // records.itemsize
+        if n_rows:
+            self.records = np.memmap(path, dtype=records, mode='r', offset=data_offset, shape=(n_rows,))
+        else:
+            self.records = np.empty(0, dtype=records)
+        self.data = None
+        if records['t'] == self.dtype:
+            self.data = self.records.view(self.dtype).reshape(n_rows, n_channels)
+        self.index = self._load_index()
+
+    def _load_index(self):
+        chunk_rows = self.header['chunk_rows']
+        try:
+            index = np.fromfile(self.path + '.idx', dtype=INDEX_DTYPE)
+            if index['n_rows'].sum() == len(self) and np.all(index['row'] == np.arange(len(index)) * chunk_rows):
+                return index
+        except (FileNotFoundError, ValueError):
+            pass
+        return _rebuild_index(self.timestamps, chunk_rows)
+
+    def __len__(self):
+        return self.records.shape[0]
+
+    @property
+    def timestamps(self):
+        return self.records['t']
+
+    def column(self, name):
+        i = self.channels.index(name)
+        return self.records['t'] if i == 0 else self.records['values'][:, i - 1]
+
+    def rows(self, t_start=None, t_end=None):
+        '''Return the (first, last + 1) row numbers of t_start <= t < t_end'''
+        first = 0 if t_start is None else self._search(t_start)
+        last = len(self) if t_end is None else self._search(t_end)
+        return first, max(first, last)
+
+    def _search(self, t):
+        # Coarse search on the chunk index, then a fine one inside a single chunk
+        chunk = np.searchsorted(self.index['t_last'], t, side='left')
+        if chunk >= len(self.index):
+            return len(self)
+        row, n_rows = int(self.index['row'][chunk]), int(self.index['n_rows'][chunk])
+        return row + int(np.searchsorted(self.timestamps[row:row+n_rows], t, side='left'))
+
+    def time_range(self, t_start=None, t_end=None):
+        '''Return the (n, n_channels) records with t_start <= t < t_end
+
+        A zero-copy view when the time column has the record dtype, else a float64 copy.
+        '''
+        first, last = self.rows(t_start, t_end)
+        if self.data is not None:
+            return self.data[first:last]
+        records = self.records[first:last]
+        return np.column_stack([records['t'], records['values']])
+
+
+def _write_header(path, header):
+    payload = json.dumps(header).encode()
+    header_len = len(MAGIC) + 4 + len(payload)
+    padding = -header_len % ALIGNMENT
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint32(len(payload) + padding).tobytes())
+        f.write(payload + b' ' * padding)
+    return header_len + padding
+
+
+def read_header(path):
+    '''Return the JSON header of a .lhm file and the byte offset of its first record'''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a LaHMo session file.')
+        payload_len = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(payload_len))
+    return header, len(MAGIC) + 4 + payload_len
+
+
+def record_dtype(header):
+    '''Structured dtype of one record, the time column t then the other channels as values'''
+    # Files without a time dtype store time in the record dtype
+    return np.dtype([('t', header.get('time_dtype', header['dtype'])),
+                     ('values', header['dtype'], (len(header['channels']) - 1,))])
+
+
+def _pack(records, dtype):
+    packed = np.empty(records.shape[0], dtype=dtype)
+    packed['t'] = records[:, 0]
+    packed['values'] = records[:, 1:]
+    return packed
+
+
+def _rebuild_index(timestamps, chunk_rows):
+    starts = np.arange(0, timestamps.shape[0], chunk_rows)
+    n_rows = np.minimum(chunk_rows, timestamps.shape[0] - starts)
+    index = np.empty(len(starts), dtype=INDEX_DTYPE)
+    index['row'] = starts
+    index['n_rows'] = n_rows
+    index['t_first'] = timestamps[starts]
+    index['t_last'] = timestamps[starts + n_rows - 1]
+    return index
+
+
+def convert_csv(csv_path, out_path=None, dtype='float64', chunk_rows=4096, device_id=''):
+    '''Convert a recorded csv (timestamp, pv0..pv3, roll, pitch, yaw) to a .lhm file'''
+    import pandas as pd
+
+    out_path = out_path or os.path.splitext(csv_path)[0] + '.lhm'
+    for p in (out_path, out_path + '.idx'):
+        if os.path.exists(p):
+            os.remove(p)
+    with SessionWriter(out_path, dtype=dtype, chunk_rows=chunk_rows, device_id=device_id) as writer:
+        for frame in pd.read_csv(csv_path, header=None, chunksize=1 << 16):
+            writer.write(frame.to_numpy(dtype=np.float64))
+    return out_path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert csv recordings to LaHMo session files.')
+    parser.add_argument('paths', nargs='+',
+                        help='csv files or directories to convert recursively')
+    parser.add_argument('--dtype', choices=['float32', 'float64'], default='float64',
+                        help='Precision of the channels after the time column, which is always float64. Default float64')
+    parser.add_argument('--chunk-rows', default=4096, type=int,
+                        help='Records per time index entry, default 4096')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Convert even if the .lhm file is newer than the csv')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    csv_paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                csv_paths += [os.path.join(root, f) for f in sorted(files) if f.endswith('.csv')]
+        else:
+            csv_paths.append(path)
+
+    for csv_path in csv_paths:
+        out_path = os.path.splitext(csv_path)[0] + '.lhm'
+        if not args.force and os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(csv_path):
+            continue
+        start = time.perf_counter()
+        convert_csv(csv_path, out_path, dtype=args.dtype, chunk_rows=args.chunk_rows)
+        print(f'{csv_path} -> {out_path} ({time.perf_counter()-start:.2f} s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import bisect
+import json
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Inter-sample gap histogram edges in ms, the receiver nominally sends every 100 ms
+GAP_EDGES_MS = (0, 10, 20, 50, 90, 110, 150, 200, 500, 1000, 5000, np.inf)
+
+
+class Telemetry:
+    '''Acquisition health counters, updated by the reader thread once per batch.
+
+    Args:
+        rate_window (float, optional): Seconds over which samples/s is averaged. Defaults to 5.
+        gap_edges_ms (sequence, optional): Edges of the inter-sample gap histogram. Defaults to GAP_EDGES_MS.
+    '''
+
+    def __init__(self, rate_window=5., gap_edges_ms=GAP_EDGES_MS):
+        self.rate_window = rate_window
+        self.gap_edges_ms = np.asarray(gap_edges_ms, dtype=float)
+        self.gap_counts = np.zeros(len(self.gap_edges_ms) - 1, dtype=np.int64)
+        self._gap_edges = self.gap_edges_ms.tolist()
+
+        self.start_time = time.monotonic()
+        self.n_samples = 0
+        self.n_malformed = 0
+        self.n_undecodable = 0
+        self.n_decode_bursts = 0
+        self._in_burst = False
+        self._last_timestamp = None
+        self._recent = deque() # (host time, samples) per batch within rate_window
+
+        # Other components reporting their own stats, e.g. the recorder
+        self.sources = {}
+
+    def on_batch(self, records, n_malformed=0, n_undecodable=0):
+        now = time.monotonic()
+        self.n_malformed += n_malformed
+        self.n_undecodable += n_undecodable
+
+        # A burst of UnicodeDecodeErrors is what a disconnect looks like
+        burst = n_undecodable > 0 and len(records) == 0
+        if burst and not self._in_burst:
+            self.n_decode_bursts += 1
+        self._in_burst = burst
+
+        if len(records):
+            timestamps = records[:, 0]
+            if self._last_timestamp is not None:
+                timestamps = np.concatenate([[self._last_timestamp], timestamps])
+            self.gap_counts += np.histogram(np.diff(timestamps), bins=self.gap_edges_ms)[0]
+            self._last_timestamp = records[-1, 0]
+            self.n_samples += len(records)
+
+        self._add_recent(now, len(records))
+
+    def on_sample(self, timestamp):
+        '''on_batch of a single record, with a scalar histogram update instead of np.histogram'''
+        if self._last_timestamp is not None:
+            gap = timestamp - self._last_timestamp
+            # Same bins as np.histogram: half-open but the last one, values outside the edges are dropped
+            if self._gap_edges[0] <= gap <= self._gap_edges[-1]:
+                self.gap_counts[min(bisect.bisect_right(self._gap_edges, gap), len(self.gap_counts)) - 1] += 1
+        self._last_timestamp = timestamp
+        self.n_samples += 1
+        self._in_burst = False
+        self._add_recent(time.monotonic(), 1)
+
+    def _add_recent(self, now, n):
+        self._recent.append((now, n))
+        while self._recent and now - self._recent[0][0] > self.rate_window:
+            self._recent.popleft()
+
+    def samples_per_s(self):
+        recent = list(self._recent)
+        if not recent:
+            return 0.
+        span = min(self.rate_window, time.monotonic() - self.start_time)
+        return sum(n for _, n in recent) / span if span > 0 else 0.
+
+    def snapshot(self):
+        metrics = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'uptime_s': time.monotonic() - self.start_time,
+                   'samples': self.n_samples,
+                   'samples_per_s': self.samples_per_s(),
+                   'gap_hist_ms': {'edges': [e if np.isfinite(e) else None for e in self.gap_edges_ms.tolist()],
+                                   'counts': self.gap_counts.tolist()},
+                   'malformed': self.n_malformed,
+                   'undecodable': self.n_undecodable,
+                   'decode_error_bursts': self.n_decode_bursts}
+        for name, stats in list(self.sources.items()):
+            metrics[name] = stats()
+        return metrics
+
+
+class JsonLineReporter:
+    '''Writes one JSON line of telemetry every `interval` seconds from a daemon thread'''
+
+    def __init__(self, telemetry, interval=1., stream=None):
+        self.telemetry = telemetry
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='telemetry-json', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.stream.write(json.dumps(self.telemetry.snapshot()) + '\n')
+            self.stream.flush()
+
+
+class MetricsServer:
+    '''Serves the latest telemetry as JSON on http://host:port/metrics'''
+
+    def __init__(self, telemetry, port, host='127.0.0.1'):
+        telemetry_ = telemetry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                body = json.dumps(telemetry_.snapshot()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='telemetry-http', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,179 @@
+import argparse
+import gzip
+import io
+import os
+import time
+import zlib
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+from compressor import BLOCK_INDEX_DTYPE
+
+def load_index(path):
+    '''Block index of a .gz written by compressor.py, None if missing or older than the archive'''
+    idx_path = path + '.idx'
+    if not os.path.exists(idx_path) or os.path.getmtime(idx_path) < os.path.getmtime(path):
+        return None
+    return np.fromfile(idx_path, dtype=BLOCK_INDEX_DTYPE)
+
+def _inflate(f, entry):
+    f.seek(int(entry['offset']))
+    # wbits=31: one gzip member
+    return zlib.decompressobj(wbits=31).decompress(f.read(int(entry['length'])))
+
+def _parse(data):
+    if not data.strip():
+        return np.empty((0, 0))
+    return pd.read_csv(io.BytesIO(data), delimiter='\t', header=None).to_numpy(dtype=float)
+
+def read_decimation(header):
+    '''Options of the '#decimation' header line written by compressor.py in fir mode, {} if absent'''
+    for line in header:
+        if line.startswith(b'#decimation'):
+            return dict(field.split('=', 1) for field in line.decode().split('\t')[1:] if '=' in field)
+    return {}
+
+def _parse_block(data, decimation):
+    block = _parse(data)
+    if int(decimation.get('delta', 0)) and len(block):
+        # Fixed-point differences from the first row of the block
+        block = np.cumsum(block, axis=0) / 10**int(decimation['decimals'])
+    return block
+
+def read_header(path):
+    '''Header lines (bytes) of an indexed archive'''
+    index = load_index(path)
+    if index is None:
+        raise FileNotFoundError(f'No up to date block index for {path}')
+    with open(path, 'rb') as f:
+        return _inflate(f, index[0]).splitlines(keepends=True)
+
+def read_rows(path, row_start=0, row_end=None, skip=None):
+    '''Decompress data rows row_start <= row < row_end of a .gz recording
+
+    With the compressor.py block index only the blocks holding those rows are
+    decompressed. Without it the archive is decompressed from the start up to
+    row_end.
+
+    Args:
+        path (str): .gz recording
+        row_start (int, optional): First row. Defaults to 0.
+        row_end (int, optional): Row after the last one, None for the end of the file.
+        skip (int, optional): Lines before the first data row, defaults to the header
+            stored in the index (or 0 without index).
+
+    Returns:
+        np.ndarray: (n, n_columns) data
+    '''
+    index = load_index(path)
+    if index is None:
+        with gzip.open(path, 'rb') as f:
+            if int(read_decimation(f.readlines(1 << 16)).get('delta', 0)):
+                raise ValueError(f'{path} is delta encoded and needs its block index')
+            f.seek(0)
+            first = (skip or 0) + row_start
+            last = None if row_end is None else (skip or 0) + row_end
+            return _parse(b''.join(islice(f, first, last)))
+
+    with open(path, 'rb') as f:
+        header = _inflate(f, index[0]).splitlines()
+        decimation = read_decimation(header)
+        if skip is not None:
+            # Header lines beyond the stored header are data rows to drop
+            n_header = len(header)
+            row_start += skip - n_header
+            row_end = None if row_end is None else row_end + skip - n_header
+        blocks = index[1:]
+        n_rows = int(blocks['row'][-1] + blocks['n_rows'][-1]) if len(blocks) else 0
+        row_start = max(row_start, 0)
+        row_end = n_rows if row_end is None else min(row_end, n_rows)
+        if row_end <= row_start:
+            return np.empty((0, 0))
+
+        first = np.searchsorted(blocks['row'], row_start, side='right') - 1
+        last = np.searchsorted(blocks['row'], row_end, side='left')
+        if decimation:
+            data = np.concatenate([_parse_block(_inflate(f, entry), decimation) for entry in blocks[first:last]])
+        else:
+            data = _parse(b''.join(_inflate(f, entry) for entry in blocks[first:last]))
+    offset = int(blocks['row'][first])
+    return data[row_start - offset:row_end - offset]
+
+def read_time(path, t_start=None, t_end=None, skip=None):
+    '''Decompress the rows with t_start <= first column < t_end, using the block time index
+
+    Args:
+        skip (int, optional): Lines before the first data row, as in read_rows.
+    '''
+    index = load_index(path)
+    if index is None:
+        data = read_rows(path, skip=skip)
+    else:
+        blocks = index[1:]
+        first = 0 if t_start is None else np.searchsorted(blocks['t_last'], t_start, side='left')
+        last = len(blocks) if t_end is None else np.searchsorted(blocks['t_first'], t_end, side='left')
+        if last <= first:
+            return np.empty((0, 0))
+        row_start = int(blocks['row'][first])
+        row_end = int(blocks['row'][last - 1] + blocks['n_rows'][last - 1])
+        if skip is not None:
+            # Block rows count from the end of the stored header, read_rows with skip from line skip
+            extra = skip - len(read_header(path))
+            row_start, row_end = max(row_start - extra, 0), row_end - extra
+        data = read_rows(path, row_start, row_end, skip=skip)
+    mask = np.ones(len(data), dtype=bool)
+    if t_start is not None:
+        mask &= data[:, 0] >= t_start
+    if t_end is not None:
+        mask &= data[:, 0] < t_end
+    return data[mask]
+
+def decompress_gz(category, label, delay_o_s=0., start_s=0., end_s=60., ts=0.0001, skip=None):
+    '''Load a time range of a compressed photovoltage recording
+
+    Args:
+        category (str): folder under dataset/
+        label (str): recording path under the category, without .gz
+        delay_o_s (float, optional): Delay of this instrument, subtracted from its time. Defaults to 0.
+        start_s (float, optional): Start time. Defaults to 0.
+        end_s (float, optional): End time. Defaults to 60.
+        ts (float, optional): Sample interval of the compressed (downsampled) data, gives fs. Defaults to 0.0001.
+        skip (int, optional): Header lines in the compressed file. Defaults to the header stored in the
+            block index, see read_rows.
+
+    Returns:
+        tuple: (time, pv, fs), time from the first column of the data, pv is 1D for a single channel and
+        (n, C) otherwise
+    '''
+    path = os.path.join('dataset', category, label + '.gz')
+    data = read_time(path, start_s + delay_o_s, end_s + delay_o_s, skip=skip)
+    if not data.size:
+        data = np.empty((0, 2))
+    t = data[:, 0] - delay_o_s
+    pv = data[:, 1:]
+    if pv.shape[1] == 1:
+        pv = pv[:, 0]
+    return t, pv, int(round(1 / ts))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Decompress a time range of a gz recording.')
+    parser.add_argument('path',
+                        help='.gz recording written by compressor.py')
+    parser.add_argument('-s', '--start',
+                        help='First row',
+                        default=0, type=int)
+    parser.add_argument('-e', '--end',
+                        help='Row after the last one',
+                        type=int)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    start = time.perf_counter()
+    data = read_rows(args.path, args.start, args.end)
+    print(f'{data.shape} in {time.perf_counter() - start:.3f} s')
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import matplotlib.pyplot as plt
-from statsmodels.tsa.seasonal import seasonal_decompose
+import numpy as np
+from scipy.ndimage import uniform_filter1d
 
 from decompressor import decompress_gz
 
@@ -24,48 +25,87 @@ def parse_args():
                         help='Interval, has downsampled from original data',
                         default=0.0001, type=float)
     parser.add_argument('-sr', '--skiprow',
-                        help='Number of rows needs to skip in the original data',
-                        default=7, type=int)
+                        help='Number of rows needs to skip in the compressed data, default the header stored '
+                             'in its index',
+                        type=int)
 
     return parser.parse_args()
 
-def pv_det_sea(pv, fs, trend_len_s=2., denoise_len_s=0.25):
+def _extrapolate(trend, front, back, npoints):
+    """Fill trend[:front] and trend[back+1:] with least-squares lines through the
+    npoints closest defined points, as statsmodels' extrapolate_trend does
+    (the fit at the back ends one point before back, like theirs)"""
+    for first, last, fill in ((front, min(front + npoints, back), slice(0, front)),
+                              (max(front, back - npoints), back, slice(back + 1, None))):
+        t = np.arange(first, last)
+        t_mean = t.mean()
+        y_mean = trend[first:last].mean(axis=0)
+        slope = ((t - t_mean) @ (trend[first:last] - y_mean)) / np.sum((t - t_mean)**2)
+        t_fill = np.arange(len(trend))[fill]
+        trend[fill] = y_mean + np.multiply.outer(t_fill - t_mean, slope)
+    return trend
+
+def moving_trend(x, period, dtype=None):
+    """Centered moving-average trend of every column, in O(n)
+
+    Same result as seasonal_decompose(x, model='additive', extrapolate_trend='freq',
+    period=period).trend: a centered mean over period samples (period + 1 with half
+    weights at both ends for even periods) from a running-sum filter, and linear
+    extrapolation over the period // 2 samples at each end.
+
+    Args:
+        x (array_like): (n,) or (n, C) signal, filtered along the first axis
+        period (int): moving average length in samples
+        dtype (dtype, optional): Computation and output dtype, e.g. np.float32 to halve
+            memory on long recordings. Defaults to float64.
+
+    Returns:
+        np.ndarray: trend with the shape of x
+    """
+    x = np.asarray(x, dtype=dtype or np.float64)
+    period = int(period)
+    n = x.shape[0]
+    if n < 2 * period:
+        raise ValueError(f'x must have 2 complete cycles requires {2 * period} observations. '
+                         f'x only has {n} observation(s)')
+    trend = uniform_filter1d(x, period, axis=0, mode='nearest')
+    if period % 2 == 0:
+        # Even periods: [0.5, 1, ..., 1, 0.5] / period is the mean of two neighbouring windows
+        trend[:-1] += trend[1:]
+        trend[:-1] *= 0.5
+    half = period // 2
+    return _extrapolate(trend, half, n - 1 - half, period)
+
+def pv_det_sea(pv, fs, trend_len_s=2., denoise_len_s=0.25, dtype=None):
     """Detrend the photovoltage with seasonal decompose
     Args:
-        pv (array_like): photovoltage values
+        pv (array_like): photovoltage values, (n,) or (n, channels)
         fs (int): sampling frequency
         trend_len_s (float, optional): Detrend window length for extracting baseline shift. Defaults to 2.
         denoise_len_s (float, optional): Detrend window length for high-frequency noises. Defaults to 0.25.
+        dtype (dtype, optional): Computation dtype, see moving_trend. Defaults to float64.
 
     Returns:
         array_like: The detrended signal
     """
 
-    dt1 = seasonal_decompose(pv,
-                             model='additive',
-                             extrapolate_trend='freq',
-                             period=int(denoise_len_s*fs))
-    dt2 = seasonal_decompose(pv,
-                             model='additive',
-                             extrapolate_trend='freq',
-                             period=int(trend_len_s*fs))
-    return dt1.trend-dt2.trend
-
-def audio_det_sea(audio, sr, trend_len_s=2.):
+    dt1 = moving_trend(pv, int(denoise_len_s*fs), dtype=dtype)
+    dt2 = moving_trend(pv, int(trend_len_s*fs), dtype=dtype)
+    return dt1-dt2
+
+def audio_det_sea(audio, sr, trend_len_s=2., dtype=None):
     """Detrend the audio captured by powerlab
     Args:
         audio (array_like): audio values (in the unit of mV)
         fs (int): sampling frequency
         trend_len_s (float, optional): Detrend window length for extracting baseline shift. Defaults to 2.
+        dtype (dtype, optional): Computation dtype, see moving_trend. Defaults to float64.
 
     Returns:
         array_like: The detrended audio
     """
-    dt = seasonal_decompose(audio,
-                            model='additive',
-                            extrapolate_trend='freq',
-                            period=int(trend_len_s)*sr)
-    return audio-dt.trend
+    dt = moving_trend(audio, int(trend_len_s)*sr, dtype=dtype)
+    return audio-dt
 
 def pv_read(args):
     # read in photovoltage
@@ -0,0 +1,139 @@
+import os
+from enum import Enum
+
+import numpy as np
+import torch
+
+
+class Label(Enum):
+    DEEP_BREATH = 0
+    SWALLOWING = 1
+    DRY_COUGH = 2
+    THROAT_CLEARING = 3
+    JUMPING_JACK = 4
+    PUSH_UP = 5
+
+
+class LHMDualDataset(torch.utils.data.Dataset):
+    '''Windows of the 4 photovoltages and the 3 Euler angles, with their labels.
+
+    Args:
+        features (torch.Tensor): [n_windows, 7, n_points], pv0..pv3 then roll, pitch, yaw
+        labels (torch.Tensor): [n_windows, 1] Label values
+    '''
+
+    def __init__(self, features, labels):
+        self.features = features
+        self.labels = labels
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    def __getitem__(self, idx):
+        photovoltage_data = self.features[idx, :4, :].float().transpose(0, 1)
+        euler_angle_data = self.features[idx, 4:, :].float().transpose(0, 1)
+        return photovoltage_data, euler_angle_data, self.labels[idx]
+
+
+def write_memmap(directory, windows, labels, seed=0, chunk=256):
+    '''Lay out windows for LHMMemmapDataset: pv.npy [N, T, 4], euler.npy [N, T, 3] float32 and labels.npy [N, 1]
+
+    The windows are shuffled once here (with seed), so contiguous batches are
+    random batches and LHMBatchSampler can slice them. The same batches come
+    back every epoch, unless the sampler mixes them with block_batches or the
+    layout is written again with another seed.
+
+    Args:
+        directory (str): output folder
+        windows (np.ndarray): [N, 7, T], pv0..pv3 then roll, pitch, yaw
+        labels (np.ndarray): [N] or [N, 1]
+    '''
+    os.makedirs(directory, exist_ok=True)
+    n, _, n_points = windows.shape
+    order = np.random.default_rng(seed).permutation(n)
+    pv = np.lib.format.open_memmap(os.path.join(directory, 'pv.npy'), mode='w+', dtype=np.float32,
+                                   shape=(n, n_points, 4))
+    euler = np.lib.format.open_memmap(os.path.join(directory, 'euler.npy'), mode='w+', dtype=np.float32,
+                                      shape=(n, n_points, 3))
+    for first in range(0, n, chunk):
+        block = windows[order[first:first + chunk]].transpose(0, 2, 1)
+        pv[first:first + chunk] = block[:, :, :4]
+        euler[first:first + chunk] = block[:, :, 4:]
+    pv.flush()
+    euler.flush()
+    np.save(os.path.join(directory, 'labels.npy'), np.asarray(labels, dtype=np.int64).reshape(n, 1)[order])
+
+
+class LHMMemmapDataset(torch.utils.data.Dataset):
+    '''LHMDualDataset read from the memory-mapped layout of write_memmap.
+
+    Items are already float32 and time major, nothing is converted per item.
+    Indexing with a slice or an index array returns a whole batch with one copy
+    per array, which is what LHMBatchSampler feeds it:
+
+        loader = DataLoader(ds, sampler=LHMBatchSampler(len(ds), 32, shuffle=True), batch_size=None)
+    '''
+
+    def __init__(self, directory):
+        self.pv = np.load(os.path.join(directory, 'pv.npy'), mmap_mode='r')
+        self.euler = np.load(os.path.join(directory, 'euler.npy'), mmap_mode='r')
+        self.labels = torch.from_numpy(np.load(os.path.join(directory, 'labels.npy')))
+
+    def __len__(self):
+        return self.pv.shape[0]
+
+    def __getitem__(self, idx):
+        # np.array copies out of the read-only map, torch.from_numpy wraps the copy
+        return (torch.from_numpy(np.array(self.pv[idx])), torch.from_numpy(np.array(self.euler[idx])),
+                self.labels[idx])
+
+
+class LHMBatchSampler(torch.utils.data.Sampler):
+    '''Yields batches of the items first <= i < last, in random order if shuffle
+
+    The items are shuffled once by write_memmap, shuffling the order of the
+    batches every epoch keeps each batch one contiguous read, a
+    slice(start, stop). The composition of the batches is then fixed: every
+    epoch sees the same batches, only in another order.
+
+    With shuffle and block_batches > 1, the items of every block_batches
+    consecutive batches are also permuted among those batches each epoch, and
+    the batches are sorted index arrays instead of slices. Each batch still
+    reads from one block of block_batches * batch_size rows.
+
+    Args:
+        n (int): Number of items
+        batch_size (int): Items per batch
+        shuffle (bool, optional): Shuffle the batches every epoch. Defaults to False.
+        drop_last (bool, optional): Drop the last incomplete batch. Defaults to False.
+        first (int, optional): First item. Defaults to 0.
+        last (int, optional): End of the items. Defaults to n.
+        block_batches (int, optional): Batches whose items are mixed every epoch. Defaults to 1, fixed batches.
+    '''
+
+    def __init__(self, n, batch_size, shuffle=False, drop_last=False, first=0, last=None, block_batches=1):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.block_batches = block_batches
+        last = n if last is None else last
+        stop = last - (last - first) % batch_size if drop_last else last
+        self.first, self.stop = first, stop
+        self.batches = [slice(start, min(start + batch_size, stop)) for start in range(first, stop, batch_size)]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        batches = self._mixed_batches() if self.shuffle and self.block_batches > 1 else self.batches
+        order = torch.randperm(len(batches)).tolist() if self.shuffle else range(len(batches))
+        for i in order:
+            yield batches[i]
+
+    def _mixed_batches(self):
+        # Blocks are whole batches, so the batch sizes are those of self.batches
+        block = self.block_batches * self.batch_size
+        batches = []
+        for start in range(self.first, self.stop, block):
+            items = torch.randperm(min(block, self.stop - start)).numpy() + start
+            batches += [np.sort(items[i:i + self.batch_size]) for i in range(0, len(items), self.batch_size)]
+        return batches
@@ -0,0 +1,277 @@
+'''Declarative preprocessing of one recording into labelled windows, with memoized stages.
+
+A recipe is a list of stages, each a dict with the operation name under 'op'
+and its parameters, e.g. the swallowing cell of adapGRU.ipynb:
+
+    [{'op': 'load', 'trim': [150, 900]},
+     {'op': 'detrend', 'channels': ['p', 'y'], 'method': 'butter', 'fc': 2},
+     {'op': 'despike', 'channels': ['r', 'p', 'y'], 'window_size': 10, 'threshold': 0.2},
+     {'op': 'upsample', 'ratio': 100},
+     ...]
+
+Every stage output is cached under a key hashing the source file checksum,
+the code of the operations (CODE_VERSION) and the operations and parameters
+of that stage and all stages before it, so changing a stage only reruns it
+and the stages after it, and editing the operations reruns everything. The
+cache is a dict in memory or one .npz per stage output on disk.
+'''
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+from scipy.signal import find_peaks
+
+import utils
+from catalog import sha1sum
+
+# Columns of the recordings after the timestamp
+CHANNELS = ('c', 'b', 'tl', 'tr', 'r', 'p', 'y')
+
+# Sources of the operations. Their checksum salts the cache keys, so outputs cached by older code are not reused
+CODE_FILES = ('pipeline.py', 'utils.py', 'streaming.py')
+CODE_VERSION = hashlib.sha1(''.join(sha1sum(os.path.join(os.path.dirname(os.path.abspath(__file__)), name))
+                                    for name in CODE_FILES).encode()).hexdigest()
+
+
+def _columns(channels):
+    return [CHANNELS.index(channel) for channel in channels]
+
+
+# Operations: (state, **params) -> new state. States are dicts of arrays and
+# are shared with the cache, so operations must not modify their input.
+
+def op_load(state, trim=(0, None)):
+    data = utils.parse_cache().read_csv(state['path'])[slice(*trim)]
+    return {'t': data[:, 0] - data[0, 0], 'x': data[:, 1:]}
+
+
+def op_detrend(state, channels, method='butter', fc=1):
+    x = state['x'].copy()
+    x[:, _columns(channels)] = utils.detrend(x[:, _columns(channels)], method=method, fc=fc)
+    return dict(state, x=x)
+
+
+def op_despike(state, channels, window_size=10, threshold=0.2):
+    x = state['x'].copy()
+    x[:, _columns(channels)] = utils.despike(x[:, _columns(channels)], window_size, threshold)
+    return dict(state, x=x)
+
+
+def op_upsample(state, ratio=100, dtype='float64'):
+    t, x = utils.upsample(state['t'], state['x'], ratio, dtype=np.dtype(dtype))
+    return dict(state, t=t, x=x)
+
+
+def op_butter(state, channels, order, cutoff, btype='bandpass', fs=1000):
+    x = state['x'].copy()
+    x[:, _columns(channels)] = utils.butter_filter(x[:, _columns(channels)], order, cutoff, btype, fs)
+    return dict(state, x=x)
+
+
+def op_find_peaks(state, channel='c', distance=4000, invert=False):
+    signal = state['x'][:, CHANNELS.index(channel)]
+    peaks, _ = find_peaks(-signal if invert else signal, distance=distance)
+    return dict(state, peaks=peaks)
+
+
+def op_slice(state, width=3000, shift=0):
+    return dict(state, windows=utils.peak_windows(state['x'], state['peaks'], width, shift))
+
+
+def op_filter(state, threshold=3, criterion='std'):
+    return dict(state, windows=state['windows'][utils.filter_windows(state['windows'], threshold, criterion)])
+
+
+def op_normalize(state):
+    '''Scale every channel of the windows to [0, 1] over the range of their mean window'''
+    mean = state['windows'].mean(axis=0) # [n_ch, n_points]
+    mean_min = mean.min(axis=1)[:, None]
+    amp_factors = 1 / (mean.max(axis=1)[:, None] - mean_min)
+    return dict(state, windows=(state['windows'] - mean_min) * amp_factors)
+
+
+OPS = {'load': op_load,
+       'detrend': op_detrend,
+       'despike': op_despike,
+       'upsample': op_upsample,
+       'butter': op_butter,
+       'find_peaks': op_find_peaks,
+       'slice': op_slice,
+       'filter': op_filter,
+       'normalize': op_normalize}
+
+# The per-activity cells of data_analysis/adapGRU.ipynb, on dataset/yihan_20231130
+ANGLE_BANDSTOP = {'op': 'butter', 'channels': ['r', 'p', 'y'], 'order': 2, 'cutoff': [3, 7], 'btype': 'bandstop'}
+DESPIKE_ANGLES = {'op': 'despike', 'channels': ['r', 'p', 'y'], 'window_size': 10, 'threshold': 0.2}
+WINDOWS = [{'op': 'slice', 'width': 3000}, {'op': 'filter'}, {'op': 'normalize'}]
+PVS = ['c', 'b', 'tl', 'tr']
+
+RECIPES = {
+    'swallowing': {'file': 'swallow.csv', 'label': 1, 'stages': [
+        {'op': 'load', 'trim': [150, 900]},
+        {'op': 'detrend', 'channels': ['p', 'y'], 'method': 'butter', 'fc': 2},
+        DESPIKE_ANGLES,
+        {'op': 'upsample', 'ratio': 100},
+        {'op': 'butter', 'channels': PVS, 'order': 3, 'cutoff': [0.1, 3]},
+        ANGLE_BANDSTOP,
+        {'op': 'find_peaks', 'channel': 'c', 'distance': 4000, 'invert': True}] + WINDOWS},
+    'dry_cough': {'file': 'dry_cough.csv', 'label': 2, 'stages': [
+        {'op': 'load', 'trim': [25, None]},
+        {'op': 'detrend', 'channels': ['r', 'p', 'y'], 'method': 'butter', 'fc': 2},
+        DESPIKE_ANGLES,
+        {'op': 'upsample', 'ratio': 100},
+        {'op': 'butter', 'channels': PVS, 'order': 3, 'cutoff': [0.5, 5]},
+        ANGLE_BANDSTOP,
+        {'op': 'find_peaks', 'channel': 'c', 'distance': 2000}] + WINDOWS},
+    'throat_clearing': {'file': 'throat_clearing.csv', 'label': 3, 'stages': [
+        {'op': 'load'},
+        {'op': 'detrend', 'channels': ['y'], 'method': 'butter', 'fc': 2},
+        DESPIKE_ANGLES,
+        {'op': 'upsample', 'ratio': 100},
+        {'op': 'butter', 'channels': PVS, 'order': 3, 'cutoff': [0.1, 5]},
+        {'op': 'butter', 'channels': ['b'], 'order': 3, 'cutoff': [0.5, 1]},
+        ANGLE_BANDSTOP,
+        {'op': 'find_peaks', 'channel': 'c', 'distance': 4000}] + WINDOWS},
+    'running': {'file': 'running.csv', 'label': 4, 'stages': [
+        {'op': 'load', 'trim': [250, 800]},
+        {'op': 'detrend', 'channels': ['r', 'p', 'y'], 'method': 'butter', 'fc': 50},
+        DESPIKE_ANGLES,
+        {'op': 'upsample', 'ratio': 100},
+        {'op': 'butter', 'channels': PVS, 'order': 3, 'cutoff': [0.1, 5]},
+        ANGLE_BANDSTOP,
+        {'op': 'find_peaks', 'channel': 'c', 'distance': 500}] + WINDOWS},
+}
+
+
+class MemoryCache(dict):
+    '''Stage outputs by key, in this process'''
+
+
+class DiskCache:
+    '''Stage outputs by key, one .npz per output under cache_dir'''
+
+    def __init__(self, cache_dir=os.path.join('dataset', '.cache', 'pipeline')):
+        self.cache_dir = cache_dir
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def __getitem__(self, key):
+        with np.load(self._path(key)) as f:
+            return dict(f)
+
+    def __setitem__(self, key, state):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = f'{self._path(key)}.{os.getpid()}.tmp.npz'
+        np.savez(tmp, **state)
+        os.replace(tmp, self._path(key))
+
+
+def stage_keys(source_key, stages):
+    '''Cache key of every stage output, chained from the source checksum and CODE_VERSION'''
+    keys = []
+    key = hashlib.sha1(f'{source_key}|{CODE_VERSION}'.encode()).hexdigest()
+    for stage in stages:
+        key = hashlib.sha1(json.dumps([key, stage], sort_keys=True).encode()).hexdigest()
+        keys.append(key)
+    return keys
+
+
+class Pipeline:
+    '''Runs a recipe on recordings, reusing the longest cached prefix of its stages.
+
+    Args:
+        stages (list of dict): stages, see OPS for the operations and their parameters
+        cache (MemoryCache or DiskCache, optional): Stage output cache. Defaults to None, no memoization.
+    '''
+
+    def __init__(self, stages, cache=None):
+        for stage in stages:
+            if stage['op'] not in OPS:
+                raise ValueError(f'Unknown operation {stage["op"]}, expected one of {", ".join(OPS)}')
+        self.stages = stages
+        self.cache = cache
+        self.timings = [] # (op, seconds, cached) of the last run
+
+    def run(self, path):
+        '''Final state of the recipe on the recording at path: t, x and, depending on the stages, peaks and windows'''
+        self.timings = []
+        keys = stage_keys(sha1sum(path), self.stages)
+        state = {'path': path}
+        first = 0
+        if self.cache is not None:
+            for i in reversed(range(len(self.stages))):
+                if keys[i] in self.cache:
+                    start = time.perf_counter()
+                    state = self.cache[keys[i]]
+                    self.timings.append(('+'.join(stage['op'] for stage in self.stages[:i + 1]),
+                                         time.perf_counter() - start, True))
+                    first = i + 1
+                    break
+
+        for stage, key in zip(self.stages[first:], keys[first:]):
+            start = time.perf_counter()
+            state = OPS[stage['op']](state, **{k: v for k, v in stage.items() if k != 'op'})
+            if self.cache is not None:
+                self.cache[key] = state
+            self.timings.append((stage['op'], time.perf_counter() - start, False))
+        return state
+
+    def report(self):
+        return ', '.join(f'{op} {seconds*1e3:.1f} ms' + (' (cached)' if cached else '')
+                         for op, seconds, cached in self.timings)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the per-activity preprocessing recipes and time their stages.')
+    parser.add_argument('recipes', nargs='*',
+                        help=f'Recipes to run among {", ".join(RECIPES)}, default all')
+    parser.add_argument('-d', '--directory',
+                        help='Folder of the recordings, default dataset/yihan_20231130',
+                        default=os.path.join('dataset', 'yihan_20231130'))
+    parser.add_argument('-c', '--cache',
+                        help='Stage cache, memory or disk. Default memory',
+                        default='memory', choices=['memory', 'disk', 'none'])
+    parser.add_argument('-s', '--set',
+                        help='Override a parameter of the stages of an operation, e.g. find_peaks.distance=3000 '
+                             '(value in JSON). Can be repeated',
+                        action='append', default=[])
+    parser.add_argument('-r', '--repeat',
+                        help='Runs per recipe, default 2',
+                        default=2, type=int)
+    args = parser.parse_args()
+    unknown = set(args.recipes) - set(RECIPES)
+    if unknown:
+        parser.error(f'unknown recipes: {", ".join(sorted(unknown))}')
+    return args
+
+
+def override(stages, assignment):
+    '''Copy of stages with op.param=value applied to every stage of op'''
+    target, value = assignment.split('=', 1)
+    op, param = target.split('.', 1)
+    return [dict(stage, **{param: json.loads(value)}) if stage['op'] == op else stage for stage in stages]
+
+
+def main():
+    args = parse_args()
+    cache = {'memory': MemoryCache(), 'disk': DiskCache(), 'none': None}[args.cache]
+    for name in args.recipes or RECIPES:
+        recipe = RECIPES[name]
+        stages = recipe['stages']
+        for assignment in args.set:
+            stages = override(stages, assignment)
+        pipeline = Pipeline(stages, cache)
+        for _ in range(args.repeat):
+            state = pipeline.run(os.path.join(args.directory, recipe['file']))
+            print(f'{name}: {state["windows"].shape} windows, label {recipe["label"]}; {pipeline.report()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,543 @@
+import argparse
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import CubicSpline
+from scipy.ndimage import uniform_filter1d
+from scipy.signal import butter, sosfilt, sosfilt_zi
+
+# One block of resampled output: t (m,) seconds, values (m, C), and filled (m,)
+# marking grid points interpolated across a detected gap
+Chunk = namedtuple('Chunk', ['t', 'values', 'filled'])
+
+
+class StreamingResampler:
+    '''Resamples the irregular receiver stream onto a fixed-rate grid, chunk by chunk.
+
+    Streaming counterpart of the reivision.ipynb recipe (drop_duplicates, fill the
+    missed samples, interp1d to 1 kHz). Records are (n, 1 + C) arrays with the
+    timestamp column first, as returned by ChunkedSerialReader or read from the
+    dataset csvs. Samples whose timestamp does not increase are dropped as
+    duplicates, and intervals longer than `gap_factor` nominal sample intervals
+    are counted as gaps. All channels are interpolated in one call.
+
+    Only the samples around the next grid point are kept between calls, so memory
+    does not grow with the recording. 'linear' output does not depend on how the
+    stream is chunked. 'cubic' fits a not-a-knot spline on the new samples plus
+    `context` samples of history, and holds the last `context` samples back until
+    more arrive (or flush() is called); it matches a spline over the whole
+    recording to a few 1e-6 of the signal range.
+
+    Args:
+        rate_hz (float, optional): Output rate. Defaults to 1000.
+        kind (str, optional): 'linear' or 'cubic'. Defaults to 'cubic'.
+        time_scale (float, optional): Seconds per timestamp unit. Defaults to 1e-3 (firmware ms).
+        interval (float, optional): Nominal input interval in timestamp units, estimated from
+            the first 16 intervals if None.
+        gap_factor (float, optional): Intervals longer than this many nominal intervals are gaps. Defaults to 1.5.
+        max_gap (float, optional): Output NaN inside gaps longer than this (timestamp units)
+            instead of interpolating across them. Defaults to None, interpolate everything.
+        context (int, optional): Samples of history for the cubic spline. Defaults to 8.
+    '''
+
+    def __init__(self, rate_hz=1000., kind='cubic', time_scale=1e-3, interval=None, gap_factor=1.5,
+                 max_gap=None, context=8):
+        if kind not in ('linear', 'cubic'):
+            raise ValueError(f'Unknown interpolation {kind}, expected linear or cubic.')
+        self.rate_hz = rate_hz
+        self.kind = kind
+        self.time_scale = time_scale
+        self.interval = interval
+        self.gap_factor = gap_factor
+        self.max_gap = max_gap
+        self.context = context
+
+        self._t = None # history, seconds
+        self._y = None
+        self._t0 = None # grid origin, seconds
+        self._k = 0 # index of the next grid point
+        self._warmup_dt = []
+
+        self.n_in = 0
+        self.n_out = 0
+        self.n_duplicates = 0
+        self.n_out_of_order = 0
+        self.n_gaps = 0
+        self.n_missing = 0
+        self.gap_time = 0.
+        self.max_gap_seen = 0.
+        self.gaps = deque(maxlen=1000) # latest (start, end) gaps in timestamp units
+
+    def push(self, records):
+        '''Add records and return the grid points that can be computed so far as a Chunk'''
+        records = np.asarray(records, dtype=float)
+        if records.ndim != 2 or len(records) == 0:
+            return self._empty(records.shape[1] - 1 if records.ndim == 2 else 0)
+        self.n_in += len(records)
+
+        ts = records[:, 0]
+        last = self._t[-1] / self.time_scale if self._t is not None else -np.inf
+        running_max = np.maximum.accumulate(np.concatenate([[last], ts]))[:-1]
+        keep = ts > running_max
+        n_equal = int(np.sum(ts == running_max))
+        self.n_duplicates += n_equal
+        self.n_out_of_order += int(np.sum(~keep)) - n_equal
+        ts, ys = ts[keep], records[keep, 1:]
+        if len(ts) == 0:
+            return self._empty(records.shape[1] - 1)
+
+        self._count_gaps(np.diff(np.concatenate([[last], ts])) if np.isfinite(last) else np.diff(ts), ts)
+
+        t = ts * self.time_scale
+        if self._t is None:
+            self._t, self._y, self._t0 = t, ys, t[0]
+        else:
+            self._t = np.concatenate([self._t, t])
+            self._y = np.concatenate([self._y, ys])
+
+        hold = self.context if self.kind == 'cubic' else 0
+        if len(self._t) <= hold:
+            return self._empty(ys.shape[1])
+        return self._emit(self._t[-1 - hold])
+
+    def flush(self):
+        '''Emit the grid points held back for the cubic spline, at the end of a recording'''
+        if self._t is None:
+            return self._empty(0)
+        return self._emit(self._t[-1])
+
+    def _empty(self, n_channels):
+        return Chunk(np.empty(0), np.empty((0, n_channels)), np.empty(0, dtype=bool))
+
+    def _count_gaps(self, dt, ts):
+        if self.interval is None:
+            self._warmup_dt.extend(dt[:16].tolist())
+            if len(self._warmup_dt) < 16:
+                return
+            # Estimated once from the first intervals; gaps before that are not counted
+            self.interval = float(np.median(self._warmup_dt))
+            self._warmup_dt = []
+        is_gap = dt > self.gap_factor * self.interval
+        if not is_gap.any():
+            return
+        gaps = dt[is_gap]
+        ends = ts[-len(dt):][is_gap]
+        self.n_gaps += len(gaps)
+        self.n_missing += int(np.sum(np.round(gaps / self.interval) - 1))
+        self.gap_time += float(np.sum(gaps - self.interval))
+        self.max_gap_seen = max(self.max_gap_seen, float(gaps.max()))
+        self.gaps.extend(zip((ends - gaps).tolist(), ends.tolist()))
+
+    def _emit(self, t_limit):
+        T, Y = self._t, self._y
+        k_end = int(np.floor((t_limit - self._t0) * self.rate_hz + 1e-9)) + 1
+        if k_end <= self._k or len(T) < 2:
+            return self._empty(Y.shape[1])
+        grid = self._t0 + np.arange(self._k, k_end) / self.rate_hz
+        self._k = k_end
+
+        # Segment of the history each grid point falls in
+        seg = np.clip(np.searchsorted(T, grid, side='right'), 1, len(T) - 1)
+        seg_len = (T[seg] - T[seg - 1]) / self.time_scale
+        if self.kind == 'linear':
+            w = ((grid - T[seg - 1]) / (T[seg] - T[seg - 1]))[:, None]
+            values = Y[seg - 1] + w * (Y[seg] - Y[seg - 1])
+        else:
+            values = CubicSpline(T, Y, axis=0)(grid)
+        filled = seg_len > self.gap_factor * self.interval if self.interval else np.zeros(len(grid), dtype=bool)
+        if self.max_gap is not None:
+            values[seg_len > self.max_gap] = np.nan
+
+        # Keep what the next grid point still needs
+        next_t = self._t0 + self._k / self.rate_hz
+        start = np.searchsorted(T, next_t, side='right') - 1 - (self.context if self.kind == 'cubic' else 0)
+        start = max(start, 0)
+        self._t, self._y = T[start:], Y[start:]
+
+        self.n_out += len(grid)
+        return Chunk(grid, values, filled)
+
+    def stats(self):
+        return {'samples_in': self.n_in,
+                'samples_out': self.n_out,
+                'duplicates': self.n_duplicates,
+                'out_of_order': self.n_out_of_order,
+                'gaps': self.n_gaps,
+                'missing_samples': self.n_missing,
+                'gap_time_s': self.gap_time * self.time_scale,
+                'max_gap_s': self.max_gap_seen * self.time_scale}
+
+
+class MovingTrend:
+    '''Centered moving-average trend of a stream, the online form of denoise.moving_trend.
+
+    Chunks of (n,) or (n, C) samples go in, trend values come out `latency` =
+    period // 2 samples later. Only the last period + 1 samples are kept. Once
+    warmed up the output equals the offline trend; the first `latency` samples,
+    which the offline version extrapolates linearly, are held at the first
+    average instead. flush() extrapolates the last `latency` samples the way the
+    offline version does.
+
+    Args:
+        period (int): moving average length in samples
+    '''
+
+    def __init__(self, period):
+        self.period = int(period)
+        self.latency = self.period // 2
+        self._length = self.period + 1 - self.period % 2 # filter taps, odd
+        self._history = None
+        self._tail = None # latest trend values, for the extrapolation in flush()
+        self._started = False
+
+    def push(self, x):
+        x = np.asarray(x, dtype=float)
+        ext = x if self._history is None else np.concatenate([self._history, x])
+        L = self._length
+        if len(ext) < L:
+            self._history = ext
+            return ext[:0]
+
+        cs = np.cumsum(np.concatenate([np.zeros((1,) + ext.shape[1:]), ext]), axis=0)
+        trend = cs[L:] - cs[:-L]
+        if self.period % 2 == 0:
+            # Half weights at both ends
+            trend -= 0.5 * (ext[:len(trend)] + ext[L - 1:])
+        trend /= self.period
+        self._history = ext[len(trend):]
+
+        if not self._started:
+            # Warm-up: hold the first average over the samples the window cannot center on
+            trend = np.concatenate([np.repeat(trend[:1], self.latency, axis=0), trend])
+            self._started = True
+        self._tail = trend[-(self.period + 1):] if self._tail is None else \
+            np.concatenate([self._tail, trend])[-(self.period + 1):]
+        return trend
+
+    def flush(self):
+        '''Linearly extrapolated trend of the last `latency` samples'''
+        if self._tail is None or self.latency == 0:
+            return np.empty((0,) + (self._history.shape[1:] if self._history is not None else ()))
+        # Least squares over the period values before the last one, as statsmodels does
+        y = self._tail[-(self.period + 1):-1]
+        t = np.arange(len(y)) - (len(y) - 1) / 2.
+        slope = (t @ (y - y.mean(axis=0))) / np.sum(t**2)
+        t_fill = (len(y) - 1) / 2. + np.arange(2, self.latency + 2)
+        return y.mean(axis=0) + np.multiply.outer(t_fill, slope)
+
+
+class StreamingDetrend:
+    '''Online counterpart of denoise.pv_det_sea and denoise.audio_det_sea.
+
+    With `denoise_len_s` the output is the denoise_len_s moving average minus
+    the trend_len_s one (pv_det_sea). Without it, the input minus the trend_len_s
+    moving average (audio_det_sea). The output of every chunk trails the input
+    by a fixed `latency` = int(trend_len_s * fs) // 2 samples, and only the
+    history the two windows need is kept. Except for the first `latency` samples
+    (see MovingTrend), it equals the offline result.
+
+    Args:
+        fs (int): sampling frequency
+        trend_len_s (float, optional): Baseline window length. Defaults to 2.
+        denoise_len_s (float, optional): Smoothing window length, None for no smoothing. Defaults to 0.25.
+    '''
+
+    def __init__(self, fs, trend_len_s=2., denoise_len_s=0.25):
+        self.smooth = MovingTrend(int(denoise_len_s * fs) if denoise_len_s else 1)
+        self.trend = MovingTrend(int(trend_len_s * fs))
+        self.latency = self.trend.latency
+        self._pending = None
+
+    def _combine(self, smoothed, trend):
+        smoothed = smoothed if self._pending is None else np.concatenate([self._pending, smoothed])
+        n = len(trend)
+        self._pending = smoothed[n:]
+        return smoothed[:n] - trend
+
+    def push(self, x):
+        return self._combine(self.smooth.push(x), self.trend.push(x))
+
+    def flush(self):
+        return self._combine(self.smooth.flush(), self.trend.flush())
+
+
+class StreamingSOS:
+    '''Causal second-order-sections IIR filter with its state carried across chunks.
+
+    The online alternative to sosfiltfilt: a single forward pass, so it adds the
+    filter's phase delay instead of `sosfiltfilt`'s zero phase and needs no
+    future samples. The state starts in steady state for the first sample, which
+    avoids the start-up transient. Concatenated outputs equal one sosfilt call
+    over the whole signal with the same initial state.
+    '''
+
+    def __init__(self, sos):
+        self.sos = sos
+        self._zi = None
+
+    def push(self, x):
+        x = np.asarray(x, dtype=float)
+        if len(x) == 0:
+            return x
+        if self._zi is None:
+            zi = sosfilt_zi(self.sos) # (n_sections, 2)
+            self._zi = zi.reshape(zi.shape + (1,) * (x.ndim - 1)) * x[0]
+        y, self._zi = sosfilt(self.sos, x, axis=0, zi=self._zi)
+        return y
+
+
+class StreamingButterDetrend(StreamingSOS):
+    '''Causal form of utils.detrend(method='butter'): the input minus its Butterworth low-pass'''
+
+    def __init__(self, fc=1, fs=1000, order=3):
+        super().__init__(butter(order, fc, btype='lowpass', output='sos', fs=fs))
+
+    def push(self, x):
+        x = np.asarray(x, dtype=float)
+        return x - super().push(x)
+
+
+class AngleUnwrapper:
+    '''Removes the wraps of yaw, roll or pitch angles, chunk by chunk.
+
+    A step larger than `jump` degrees between consecutive samples is taken as a
+    wrap and undone by adding or subtracting `period`, in both directions. The
+    offset and the last sample are carried to the next chunk, so the
+    concatenated output equals one call over the whole recording. Works on (n,)
+    or (n, C) chunks, every column separately.
+
+    Args:
+        jump (float, optional): Smallest step counted as a wrap. Defaults to 350.
+        period (float, optional): Defaults to 360.
+        initial (float, optional): Angle before the first sample, e.g. 0 so that a
+            recording starting above jump starts one period down. Defaults to None,
+            the first sample itself.
+    '''
+
+    def __init__(self, jump=350, period=360, initial=None):
+        self.jump = jump
+        self.period = period
+        self._last = None if initial is None else np.asarray(initial, dtype=float)
+        self._offset = 0.
+
+    def push(self, x):
+        x = np.asarray(x, dtype=float)
+        if len(x) == 0:
+            return x
+        previous = x[:1] if self._last is None else np.broadcast_to(self._last, x.shape[1:])[None]
+        step = np.diff(np.concatenate([previous, x]), axis=0)
+        wraps = (step < -self.jump).astype(float) - (step > self.jump)
+        offset = self._offset + self.period * np.cumsum(wraps, axis=0)
+        self._last = x[-1]
+        self._offset = offset[-1]
+        return x + offset
+
+
+class StreamingDespike:
+    '''Online form of utils.despike: samples further than threshold from their rolling mean become the mean.
+
+    The rolling mean is centered, so the output trails the input by `latency`
+    = (window_size - 1) // 2 samples; flush() returns the rest. The first and
+    last samples are mirrored as in the offline version, and the concatenated
+    output equals it to rounding. Only window_size samples are kept between
+    chunks.
+    '''
+
+    def __init__(self, window_size, threshold):
+        self.window_size = window_size
+        self.threshold = threshold
+        self._before = window_size // 2
+        self.latency = (window_size - 1) // 2
+        self._buffer = None
+        self._started = False
+
+    def _emit(self, buffer):
+        w = self.window_size
+        n = len(buffer) - w + 1
+        if n <= 0:
+            self._buffer = buffer
+            return buffer[:0]
+        cs = np.cumsum(np.concatenate([np.zeros((1,) + buffer.shape[1:]), buffer]), axis=0)
+        rolled = (cs[w:] - cs[:-w]) / w
+        center = buffer[self._before:self._before + n]
+        self._buffer = buffer[n:]
+        return np.where(np.abs(center - rolled) > self.threshold, rolled, center)
+
+    def push(self, x):
+        x = np.asarray(x, dtype=float)
+        buffer = x if self._buffer is None else np.concatenate([self._buffer, x])
+        if not self._started:
+            if len(buffer) <= self._before:
+                self._buffer = buffer
+                return buffer[:0]
+            # Mirror the first samples, without repeating the first one
+            buffer = np.concatenate([buffer[self._before:0:-1], buffer])
+            self._started = True
+        return self._emit(buffer)
+
+    def flush(self):
+        if self._buffer is None:
+            return np.empty(0)
+        buffer, self._buffer = self._buffer, None
+        if not self._started:
+            # Shorter than half a window, nothing was emitted yet
+            rolled = uniform_filter1d(buffer, self.window_size, axis=0, mode='mirror')
+            return np.where(np.abs(buffer - rolled) > self.threshold, rolled, buffer)
+        return self._emit(np.concatenate([buffer, buffer[-2:-2 - self.latency:-1]]))
+
+
+class RunningNormalize:
+    '''Scales every channel to [-1, 1] with its running minimum and maximum.
+
+    Streaming counterpart of utils.normalize, which needs the range of the whole
+    recording: here each sample is scaled with the range of the samples up to and
+    including it, carried across chunks, so the concatenated output equals one
+    call over the whole recording. Samples of a channel whose range is still 0
+    are 0.
+    '''
+
+    def __init__(self):
+        self._min = None
+        self._max = None
+
+    def push(self, x):
+        x = np.asarray(x, dtype=float)
+        if len(x) == 0:
+            return x
+        first_min = x[:1] if self._min is None else self._min[None]
+        first_max = x[:1] if self._max is None else self._max[None]
+        arr_min = np.minimum.accumulate(np.concatenate([first_min, x]), axis=0)[1:]
+        arr_max = np.maximum.accumulate(np.concatenate([first_max, x]), axis=0)[1:]
+        self._min, self._max = arr_min[-1], arr_max[-1]
+        span = arr_max - arr_min
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(span > 0, 2*((x - arr_min) / span) - 1, 0.)
+
+
+class StreamingWindowFilter:
+    '''Accepts or rejects windows as they are produced, the online form of utils.filter_windows.
+
+    Keeps a Welford running mean and sum of squared deviations per sample
+    position (and channel) instead of the stack of windows. Each window is
+    judged with the 'std' rule against the statistics of the windows seen so
+    far, itself included, so the last window of a stream gets the verdict
+    filter_windows would give it over the whole stack. The first `min_windows`
+    windows are held back until the statistics mean something, then judged
+    together.
+
+    Args:
+        threshold (float, optional): Standard deviations. Defaults to 3.
+        min_windows (int, optional): Windows held back before the first verdict. Defaults to 10.
+    '''
+
+    def __init__(self, threshold=3, min_windows=10):
+        self.threshold = threshold
+        self.min_windows = min_windows
+        self.count = 0
+        self.n_kept = 0
+        self._mean = None
+        self._m2 = None
+        self._pending = []
+
+    def _update(self, window):
+        self.count += 1
+        if self._mean is None:
+            self._mean = np.zeros_like(window)
+            self._m2 = np.zeros_like(window)
+        delta = window - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (window - self._mean)
+
+    def _judge(self, windows, keep, batch):
+        std = np.sqrt(self._m2 / self.count)
+        for window in batch:
+            windows.append(window)
+            keep.append(not np.any(np.abs(window - self._mean) > self.threshold * std))
+
+    def _result(self, windows, keep, shape):
+        keep = np.array(keep, dtype=bool)
+        self.n_kept += int(keep.sum())
+        return (np.array(windows) if windows else np.empty((0,) + shape)), keep
+
+    def push(self, windows):
+        '''
+        Args:
+            windows (np.ndarray): [m, window_width] or [m, n_ch, window_width]
+
+        Returns:
+            tuple: (windows judged by this call, boolean mask of the ones to keep)
+        '''
+        windows = np.asarray(windows, dtype=float)
+        judged, keep = [], []
+        for window in windows:
+            self._update(window)
+            if self._pending is None:
+                self._judge(judged, keep, [window])
+            else:
+                self._pending.append(window)
+                if self.count >= self.min_windows:
+                    self._judge(judged, keep, self._pending)
+                    self._pending = None
+        return self._result(judged, keep, windows.shape[1:])
+
+    def flush(self):
+        '''Judge the windows still held back, if the stream had fewer than min_windows'''
+        judged, keep = [], []
+        if self._pending:
+            self._judge(judged, keep, self._pending)
+        self._pending = None
+        return self._result(judged, keep, self._mean.shape if self._mean is not None else (0,))
+
+    def stats(self):
+        return {'windows': self.count,
+                'kept': self.n_kept,
+                'rejected': self.count - self.n_kept - len(self._pending or [])}
+
+
+def resample_files(paths, resampler, chunk_rows=100000):
+    '''Stream csv recordings, concatenated in the given order, through a resampler.
+
+    Yields:
+        Chunk: resampled blocks, the last one from resampler.flush()
+    '''
+    for path in paths:
+        for frame in pd.read_csv(path, header=None, chunksize=chunk_rows):
+            chunk = resampler.push(frame.to_numpy(dtype=float))
+            if len(chunk.t):
+                yield chunk
+    yield resampler.flush()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Resample LaHMo recordings onto a fixed-rate grid.')
+    parser.add_argument('paths', nargs='+',
+                        help='csv recordings, concatenated in the given order')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Output csv: time in s, then the channels.')
+    parser.add_argument('-r', '--rate', default=1000., type=float,
+                        help='Output rate in Hz, default 1000')
+    parser.add_argument('--kind', choices=['linear', 'cubic'], default='cubic',
+                        help='Interpolation, default cubic')
+    parser.add_argument('--max-gap', type=float,
+                        help='Write NaN inside gaps longer than this many ms instead of interpolating.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    resampler = StreamingResampler(rate_hz=args.rate, kind=args.kind, max_gap=args.max_gap)
+    start = time.perf_counter()
+    with open(args.output, 'w') as f:
+        for chunk in resample_files(args.paths, resampler):
+            # Fixed-point time, %g would round seconds to 6 significant digits and repeat timestamps
+            np.savetxt(f, np.column_stack([chunk.t, chunk.values]), delimiter=',',
+                       fmt=['%.6f'] + ['%.6g'] * chunk.values.shape[1])
+    stats = resampler.stats()
+    print(', '.join(f'{k} {v:.2f}' if isinstance(v, float) else f'{k} {v}' for k, v in stats.items()))
+    print(f'{time.perf_counter() - start:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import Catalog
+
+
+@pytest.fixture
+def root(tmp_path):
+    subject = tmp_path / 'subject_20240801'
+    subject.mkdir()
+    t = np.arange(100) * 10.
+    np.savetxt(subject / 'swallowing.csv', np.column_stack([t, np.ones((100, 7))]), delimiter=',')
+    (subject / 'empty.csv').write_text('')
+    (subject / 'header.csv').write_text('timestamp,pv0,pv1,pv2,pv3,roll,pitch,yaw\n')
+    return str(tmp_path)
+
+
+def test_scan(root):
+    catalog = Catalog(root)
+    assert catalog.scan() == {'added': 3, 'updated': 0, 'unchanged': 0, 'removed': 0}
+    entries = {os.path.basename(entry['path']): entry for entry in catalog.query()}
+
+    recording = entries['swallowing.csv']
+    assert (recording['rows'], recording['columns']) == (100, 8)
+    assert (recording['t_first'], recording['t_last']) == (0., 990.)
+    assert recording['duration_s'] == pytest.approx(0.99)
+    assert recording['fs'] == pytest.approx(100.)
+
+    for name in ('empty.csv', 'header.csv'):
+        entry = entries[name]
+        assert entry['rows'] == 0
+        assert entry['t_first'] is entry['t_last'] is entry['fs'] is None
+        assert (entry['time_resets'], entry['duration_s']) == (0, 0.)
+    assert [entry['path'] for entry in catalog.query(min_duration_s=0.5)] == [recording['path']]
+
+    assert Catalog(root).scan()['unchanged'] == 3
+
+
+def test_broken_csv_raises(root):
+    with open(os.path.join(root, 'subject_20240801', 'broken.csv'), 'w') as f:
+        f.write('timestamp,pv0\n0,1\n')
+    with pytest.raises(ValueError):
+        Catalog(root).scan()
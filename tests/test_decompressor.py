@@ -0,0 +1,42 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compressor import compress_gz
+from decompressor import decompress_gz
+
+TS = 1e-4
+HEADER = ['# instrument\n', '# date\n', '# rate 10000\n', '# channels 2\n', '# units V\n', 'time\tpv0\tpv1\n']
+
+
+@pytest.fixture
+def recording(tmp_path, monkeypatch):
+    '''20 s at 10 kHz of two slow sines, as dataset/pv/date/recording.txt with a 6 line header'''
+    monkeypatch.chdir(tmp_path)
+    t = np.arange(200000) * TS
+    data = np.column_stack([t, np.sin(2 * np.pi * 0.5 * t), 0.2 * np.cos(2 * np.pi * 0.3 * t)])
+    os.makedirs(os.path.join('dataset', 'pv', 'date'))
+    with open(os.path.join('dataset', 'pv', 'date', 'recording.txt'), 'w') as f:
+        f.writelines(HEADER)
+        np.savetxt(f, data, fmt='%.7f', delimiter='\t')
+    return data
+
+
+@pytest.mark.parametrize('options', [{'mode': 'nth'},
+                                     {'mode': 'fir'},
+                                     {'mode': 'fir', 'delta': True}])
+def test_round_trip(recording, options):
+    compress_gz('pv', 'date', 'recording', 10, 6, block_rows=5000, **options)
+    t, pv, fs = decompress_gz('pv', 'date/recording', delay_o_s=0.5, start_s=2., end_s=7., ts=10 * TS)
+
+    expected = recording[::10]
+    expected = expected[(expected[:, 0] >= 2.5 - 1e-9) & (expected[:, 0] < 7.5 - 1e-9)]
+    assert fs == 1000
+    assert len(t) == len(expected) == 5000
+    assert np.allclose(t, expected[:, 0] - 0.5)
+    # The slow sines pass the anti-alias filter
+    assert np.allclose(pv, expected[:, 1:], atol=1e-5)
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from statsmodels.tsa.seasonal import seasonal_decompose
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from denoise import moving_trend
+
+
+@pytest.fixture
+def signal():
+    rng = np.random.default_rng(0)
+    t = np.arange(2000)
+    return np.column_stack([np.sin(2 * np.pi * t / 100) + 1e-3 * t + 0.1 * rng.standard_normal(len(t)),
+                            np.cos(2 * np.pi * t / 37) + 0.1 * rng.standard_normal(len(t))])
+
+
+@pytest.mark.parametrize('period', [7, 8, 100, 101])
+def test_moving_trend_1d(signal, period):
+    x = signal[:, 0]
+    expected = seasonal_decompose(x, period=period, extrapolate_trend='freq').trend
+    assert np.allclose(moving_trend(x, period), expected)
+
+
+@pytest.mark.parametrize('period', [7, 8, 100, 101])
+def test_moving_trend_2d(signal, period):
+    expected = seasonal_decompose(signal, period=period, extrapolate_trend='freq').trend
+    trend = moving_trend(signal, period)
+    assert trend.shape == signal.shape
+    assert np.allclose(trend, expected)
+
+
+def test_moving_trend_too_short():
+    with pytest.raises(ValueError):
+        moving_trend(np.zeros(10), 6)
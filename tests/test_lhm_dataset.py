@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lhm_dataset import LHMBatchSampler, LHMMemmapDataset, write_memmap
+
+
+def batch_items(batches):
+    return [tuple(np.arange(b.start, b.stop)) if isinstance(b, slice) else tuple(b) for b in batches]
+
+
+def test_fixed_batches():
+    sampler = LHMBatchSampler(100, 8, shuffle=True, drop_last=True)
+    epochs = [sorted(batch_items(sampler)) for _ in range(2)]
+    assert len(epochs[0]) == len(sampler) == 12
+    assert epochs[0] == epochs[1]
+
+
+def test_mixed_batches():
+    torch.manual_seed(0)
+    sampler = LHMBatchSampler(100, 8, shuffle=True, first=10, block_batches=4)
+    epochs = [batch_items(sampler) for _ in range(2)]
+    assert sorted(epochs[0]) != sorted(epochs[1])
+    for batches in epochs:
+        assert len(batches) == len(sampler) == 12
+        assert sorted(len(b) for b in batches) == [2] + [8] * 11
+        assert sorted(i for b in batches for i in b) == list(range(10, 100))
+        # Every batch stays within its block of 4 batches
+        assert all((b[0] - 10) // 32 == (b[-1] - 10) // 32 for b in batches)
+
+
+def test_memmap_batches(tmp_path):
+    rng = np.random.default_rng(0)
+    windows = rng.standard_normal((40, 7, 16))
+    labels = np.arange(40)
+    write_memmap(str(tmp_path), windows, labels)
+    ds = LHMMemmapDataset(str(tmp_path))
+    loader = torch.utils.data.DataLoader(ds, sampler=LHMBatchSampler(len(ds), 8, shuffle=True, block_batches=2),
+                                         batch_size=None)
+
+    seen = []
+    for pv, euler, label in loader:
+        expected = windows[label[:, 0].numpy()].transpose(0, 2, 1).astype(np.float32)
+        assert np.array_equal(pv.numpy(), expected[:, :, :4])
+        assert np.array_equal(euler.numpy(), expected[:, :, 4:])
+        seen += label[:, 0].tolist()
+    assert sorted(seen) == list(range(40))
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data_aquisition'))
+
+from serial_ingest import ChunkedSerialReader
+
+
+def line(i):
+    return '\t'.join(str(float(i + k)) for k in range(8)).encode() + b'\n'
+
+
+def test_record_split_across_reads():
+    reader = ChunkedSerialReader(None)
+    data = line(0) + line(1)
+    first, _ = reader.feed(data[:20])
+    second, _ = reader.feed(data[20:])
+    assert first.shape == (0, 8)
+    assert np.array_equal(second[:, 0], [0., 1.])
+    assert reader.stats()['malformed'] == 0
+
+
+def test_overlong_line_is_dropped():
+    reader = ChunkedSerialReader(None, max_line=64)
+    noise = b'x' * 50
+    for _ in range(100):
+        records, _ = reader.feed(noise)
+        assert records.shape == (0, 8)
+        assert len(reader._residual) <= reader.max_line
+    records, _ = reader.feed(noise + b'\n' + line(0) + line(1))
+
+    assert np.array_equal(records[:, 0], [0., 1.])
+    stats = reader.stats()
+    assert stats['malformed'] == 1
+    assert stats['dropped_bytes'] == 101 * len(noise) + 1
+    assert stats['records'] == 2
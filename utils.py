@@ -1,37 +1,37 @@
 import numpy as np
-import pandas as pd
-from scipy import interpolate
-from scipy.signal import butter, sosfiltfilt, find_peaks
-from sklearn.linear_model import LinearRegression
+from scipy.signal import butter, sosfilt, sosfilt_zi, find_peaks
 import torch
+import os
+from functools import lru_cache
+
+_parse_cache = None
 
 # load
 
-def my_expand_yaw(yaw):
-    '''Fix yaw jumps from 0 to 360 and/or from 360 to 0'''
-    expanded_yaw = []
-    previous_val = 0
-    offset = 0
-    
-    for val in yaw:
-        diff = val - previous_val
-        if diff > 350:
-            offset -= 360
-        expanded_yaw.append(val + offset)
-        previous_val = val
+def parse_cache():
+    '''The catalog.ParseCache of the loaders, in dataset/.cache next to this file, created on first use'''
+    global _parse_cache
+    if _parse_cache is None:
+        from catalog import ParseCache
+        _parse_cache = ParseCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataset', '.cache'))
+    return _parse_cache
+
+def my_expand_yaw(yaw, jump=350):
+    '''Fix yaw jumps from 0 to 360 and/or from 360 to 0, see streaming.AngleUnwrapper
 
-    return np.array(expanded_yaw)
+    Starts from 0 as the original loop did, so a recording whose first yaw is
+    above jump is shifted down by 360.
+    '''
+    from streaming import AngleUnwrapper
+    return AngleUnwrapper(jump, initial=0).push(yaw)
 
 def fix_timestamps(timestamp):
     '''Redo IMU timestamps'''
     return np.around(timestamp)
 
-def load_pv(date, filename):
+def load_pv(date, filename, cache=None):
     path = '/'.join(['..', 'dataset', 'pv', date, filename])
-    data = pd.read_csv(path,
-                    skiprows=6,
-                    delimiter='\t',
-                    header=None).to_numpy()
+    data = (cache or parse_cache()).read_csv(path, skiprows=6, delimiter='\t')
     timestamp = data[:, 0]
     
     c = data[:, 1]
@@ -40,12 +40,9 @@ def load_pv(date, filename):
     tr = data[:, 4]
     return timestamp, c, b, tl, tr
 
-def load_ori(date, filename, shift):
+def load_ori(date, filename, shift, cache=None):
     path = '/'.join(['..', 'dataset', 'orientation', date, filename])
-    data = pd.read_csv(path,
-                      skiprows=1+shift,
-                      delimiter='\t',
-                      header=None).to_numpy()
+    data = (cache or parse_cache()).read_csv(path, skiprows=1+shift, delimiter='\t')
     timestamp = data[:, 0]-data[0, 0]
     timestamp = fix_timestamps(timestamp)
     y = data[:, 1]
@@ -55,33 +52,210 @@ def load_ori(date, filename, shift):
     y = my_expand_yaw(y)
     return timestamp, y, p, r
 
+def load_recording(path, t_start=None, t_end=None, cache=None):
+    '''Load a recording as an (n, 8) array [timestamp, pv0..pv3, roll, pitch, yaw]
+
+    Reads the memory-mapped .lhm session next to a csv when it is at least as new
+    as the csv (see data_aquisition/session_file.py), and the csv otherwise.
+    t_start and t_end select t_start <= timestamp < t_end. csvs are parsed
+    through cache, a catalog.ParseCache, parse_cache() by default.
+    '''
+    session_path = os.path.splitext(path)[0] + '.lhm'
+    if os.path.exists(session_path) and (not os.path.exists(path) or
+                                         os.path.getmtime(session_path) >= os.path.getmtime(path)):
+        from data_aquisition.session_file import SessionReader
+        return SessionReader(session_path).time_range(t_start, t_end)
+
+    data = (cache or parse_cache()).read_csv(path)
+    mask = np.ones(len(data), dtype=bool)
+    if t_start is not None:
+        mask &= data[:, 0] >= t_start
+    if t_end is not None:
+        mask &= data[:, 0] < t_end
+    return data[mask]
+
 # preprocessing
 
-def upsample(timestamp, arr, ratio=10):
-    f = interpolate.interp1d(timestamp, arr)
-    timestamp_upsampled = np.linspace(start=timestamp[0], stop=timestamp[-1], num=int(np.around((len(timestamp)+1)*ratio+1)))
-    arr_upsampled = f(timestamp_upsampled)
+def upsample_grid(timestamp, ratio=10):
+    '''(start, step, n) of the evenly spaced grid upsample puts ratio times as many points on'''
+    n = int(np.around((len(timestamp)+1)*ratio+1))
+    return timestamp[0], (timestamp[-1] - timestamp[0]) / (n - 1), n
+
+def _grid_points(timestamp, ratio, indices):
+    start, step, n = upsample_grid(timestamp, ratio)
+    t = indices * step + start
+    # np.linspace ends exactly on the last timestamp
+    return np.where(indices == n - 1, timestamp[-1], t)
+
+def _sort_samples(timestamp, arr):
+    '''timestamp and arr in increasing time order, the stable sort interp1d applies to unsorted x'''
+    if np.all(timestamp[1:] >= timestamp[:-1]):
+        return timestamp, arr
+    order = np.argsort(timestamp, kind='mergesort')
+    return timestamp[order], arr[order]
+
+def _interp(timestamp, arr, t, dtype, out=None):
+    '''Linear interpolation of the rows of arr at t, with interp1d's arithmetic, into out or a new dtype array
+
+    timestamp must be sorted, see _sort_samples.
+    '''
+    hi = np.clip(np.searchsorted(timestamp, t), 1, len(timestamp) - 1)
+    lo = hi - 1
+    dt = t - timestamp[lo]
+    slope = (np.diff(arr, axis=0).T / np.diff(timestamp)).T
+    if out is None:
+        out = np.empty(t.shape + arr.shape[1:], dtype=dtype)
+    if arr.ndim == 1:
+        out[:] = slope[lo] * dt + arr[lo]
+    for c in range(arr.shape[1] if arr.ndim > 1 else 0):
+        out[:, c] = slope[lo, c] * dt + arr[lo, c]
+    return out
+
+def upsample(timestamp, arr, ratio=10, dtype=np.float64, chunk_size=1000000):
+    '''Linearly interpolate arr onto ratio times as many evenly spaced timestamps
+
+    arr may be (n,) or (n, C), all channels share one grid and one call. The
+    output is filled chunk_size points at a time, so the only large array is
+    the result itself; float32 halves it.
+
+    Returns:
+        tuple: (timestamp_upsampled (float64), arr_upsampled in dtype)
+    '''
+    arr = np.asarray(arr)
+    n = upsample_grid(timestamp, ratio)[2]
+    samples = _sort_samples(timestamp, arr)
+    timestamp_upsampled = np.empty(n)
+    arr_upsampled = np.empty((n,) + arr.shape[1:], dtype=dtype)
+    for first in range(0, n, chunk_size):
+        last = min(first + chunk_size, n)
+        timestamp_upsampled[first:last] = _grid_points(timestamp, ratio, np.arange(first, last))
+        _interp(*samples, timestamp_upsampled[first:last], dtype, out=arr_upsampled[first:last])
     return timestamp_upsampled, arr_upsampled
 
-def despike(arr, window_size, threshold):
-    pad_size = window_size // 2
-    arr_padded = np.pad(arr, pad_size, mode='reflect')
-    arr_rolled = np.convolve(arr_padded, np.ones(window_size)/window_size, mode='same')
-    spikes = np.abs(arr-arr_rolled[pad_size:-pad_size]) > threshold
-    arr_despiked = np.copy(arr)
-    arr_despiked[spikes] = arr_rolled[pad_size:-pad_size][spikes]
-    return arr_despiked
-
-def detrend(arr, method='linear', fc=1):
-    x = np.arange(len(arr)).reshape(-1, 1)
+def upsample_chunks(timestamp, arr, ratio=10, chunk_size=1000000, dtype=np.float32):
+    '''Yield the upsample output in (timestamp, arr) chunks of chunk_size grid points
+
+    Only one chunk is in memory at a time. Time stays float64, a float32 of ms
+    timestamps would lose the 1 kHz resolution after a few hours.
+    '''
+    arr = np.asarray(arr)
+    n = upsample_grid(timestamp, ratio)[2]
+    samples = _sort_samples(timestamp, arr)
+    for first in range(0, n, chunk_size):
+        t = _grid_points(timestamp, ratio, np.arange(first, min(first + chunk_size, n)))
+        yield t, _interp(*samples, t, dtype)
+
+def upsample_at(timestamp, arr, indices, ratio=10, dtype=np.float32):
+    '''Values of the upsample output at the grid indices only, e.g. peak_expand(peaks, n, max)
+
+    Returns:
+        np.ndarray: indices.shape + arr.shape[1:]
+    '''
+    arr = np.asarray(arr)
+    indices = np.asarray(indices)
+    t = _grid_points(timestamp, ratio, indices.ravel())
+    return _interp(*_sort_samples(timestamp, arr), t, dtype).reshape(indices.shape + arr.shape[1:])
+
+@lru_cache(maxsize=128)
+def _butter_design(order, cutoff, btype, fs):
+    sos = butter(order, cutoff, btype=btype, output='sos', fs=fs)
+    return sos, sosfilt_zi(sos)
+
+def _design_key(order, cutoff, btype, fs):
+    cutoff = tuple(np.atleast_1d(cutoff).tolist()) if np.ndim(cutoff) else float(cutoff)
+    return int(order), cutoff, btype, float(fs)
+
+def butter_sos(order, cutoff, btype='lowpass', fs=1000):
+    '''Butterworth second-order sections, designed once per (order, cutoff, btype, fs)
+
+    The returned array is shared between callers, do not modify it.
+    '''
+    return _butter_design(*_design_key(order, cutoff, btype, fs))[0]
+
+def _sosfiltfilt(sos, zi, x, axis):
+    '''scipy.signal.sosfiltfilt(sos, x, axis) with its default odd padding and zi = sosfilt_zi(sos) given'''
+    x = np.moveaxis(np.asarray(x), axis, -1)
+    ntaps = 2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    padlen = 3 * ntaps
+    if x.shape[-1] <= padlen:
+        raise ValueError(f'The length of the input vector x must be greater than padlen, which is {padlen}.')
+    ext = np.concatenate([2 * x[..., :1] - x[..., padlen:0:-1], x,
+                          2 * x[..., -1:] - x[..., -2:-padlen - 2:-1]], axis=-1)
+    zi = zi.reshape((len(sos),) + (1,) * (x.ndim - 1) + (2,))
+    y, _ = sosfilt(sos, ext, zi=zi * ext[..., :1])
+    y, _ = sosfilt(sos, y[..., ::-1], zi=zi * y[..., -1:])
+    return np.moveaxis(y[..., ::-1][..., padlen:-padlen], -1, axis)
+
+def butter_filter(arr, order, cutoff, btype='lowpass', fs=1000, axis=0):
+    '''Zero-phase Butterworth filter of every channel along axis, e.g. the notebooks'
+    sosfiltfilt(butter(2, [0.1, 20], 'bandpass', output='sos', fs=1000), x)
+
+    Same result as sosfiltfilt, with the filter's initial conditions cached with its design.
+    '''
+    return _sosfiltfilt(*_butter_design(*_design_key(order, cutoff, btype, fs)), arr, axis)
+
+def _moving_sum(x, size):
+    '''Sums of size consecutive rows of x, from log2(size) shifted additions of whole rows'''
+    n = x.shape[0] - size + 1
+    segments = []
+    first, span, partial = 0, 1, x
+    while span <= size:
+        if size & span:
+            segments.append(partial[first:first + n])
+            first += span
+        span *= 2
+        if span <= size:
+            # partial[i] = x[i:i + span].sum(axis=0)
+            partial = partial[:-(span // 2)] + partial[span // 2:]
+    if len(segments) == 1:
+        return segments[0].copy()
+    total = segments[0] + segments[1]
+    for segment in segments[2:]:
+        total += segment
+    return total
+
+def despike(arr, window_size, threshold, axis=0):
+    '''Replace samples further than threshold from their rolling mean by the rolling mean
+
+    arr may be (n,) or multi-channel, with samples along axis. The rolling mean
+    is the window_size mean with reflected edges. All channels go through the
+    same few passes over the array, as whole rows.
+    '''
+    arr = np.asarray(arr)
+    arr = np.moveaxis(arr.astype(np.result_type(arr, 1.), copy=False), axis, 0)
+    half = window_size // 2
+    # np.pad(mode='reflect') of half rows before and window_size - 1 - half after
+    padded = np.concatenate([arr[half:0:-1], arr, arr[-2:-(window_size - half) - 1:-1]])
+    arr_rolled = _moving_sum(padded, window_size)
+    arr_rolled *= 1. / window_size
+    deviation = arr - arr_rolled
+    np.abs(deviation, out=deviation)
+    return np.moveaxis(np.where(deviation > threshold, arr_rolled, arr), 0, axis)
+
+def detrend(arr, method='linear', fc=1, axis=0):
+    '''Remove the trend of every channel along axis
+
+    'linear' subtracts the least-squares line (closed form), 'butter' the 3rd
+    order Butterworth low-pass at fc Hz (samples at 1 kHz). 'causal' subtracts
+    the same low-pass run forward only, as streaming.StreamingButterDetrend does
+    chunk by chunk in the live DAQ.
+    '''
+    arr = np.asarray(arr, dtype=np.float64)
     if method == 'linear':
-        model = LinearRegression().fit(x, arr)
-        trend = model.predict(x)
-        detrended = arr - trend.flatten()
+        arr_moved = np.moveaxis(arr, axis, 0)
+        n = arr_moved.shape[0]
+        columns = arr_moved.reshape(n, -1)
+        # Orthogonal basis of the lines, 1 and the centered sample number, so the fit is two dot products
+        # per channel. Matrix products keep every channel in one pass.
+        basis = np.column_stack([np.ones(n), np.arange(n) - (n - 1) / 2.])
+        coefs = (basis.T @ columns) / np.einsum('ij,ij->j', basis, basis)[:, None]
+        detrended = np.moveaxis((columns - basis @ coefs).reshape(arr_moved.shape), 0, axis)
     elif method == 'butter':
-        sos = butter(3, fc, btype='lowpass', output='sos', fs=1000/(x[1] - x[0]))
-        trend = sosfiltfilt(sos, arr)
-        detrended = arr - trend.flatten()
+        trend = butter_filter(arr, 3, fc, btype='lowpass', fs=1000, axis=axis)
+        detrended = arr - trend
+    elif method == 'causal':
+        from streaming import StreamingButterDetrend
+        detrended = np.moveaxis(StreamingButterDetrend(fc).push(np.moveaxis(arr, axis, 0)), 0, axis)
     return detrended
 
 def normalize(arr):
@@ -92,34 +266,83 @@ def normalize(arr):
 
 # slicing and reshaping data
 
+def window_view(data, width, step=1):
+    '''(n_windows, channels, width) windows of an (n, channels) array or tensor, every step samples
+
+    A strided view of data, nothing is copied. Tensors are unfolded, so the view
+    is a tensor as well.
+    '''
+    if isinstance(data, torch.Tensor):
+        return data.unfold(0, width, step)
+    return np.lib.stride_tricks.sliding_window_view(data, width, axis=0)[::step]
+
+def peak_starts(peaks, n, max, shift=0):
+    '''First indices of the windows range(peak-shift-n//2, peak-shift+n//2) lying within (0, max)
+
+    shift may be a sequence, the starts are then grouped by shift.
+    '''
+    peaks = np.asarray(peaks)
+    starts = (peaks[None, :] - np.atleast_1d(shift)[:, None] - n//2).ravel()
+    keep = (starts > 0) & (starts + 2*(n//2) - 1 < max)
+    return starts[keep]
+
 def peak_expand(peaks, n, max):
-    expanded_list = []
-    for peak in peaks:
-        temp_list = list(range(peak-n//2, peak+n//2))
-        if all(0 < x < max for x in temp_list):
-            expanded_list.append(temp_list) 
-    return np.array(expanded_list)
+    starts = peak_starts(peaks, n, max)
+    return starts[:, None] + np.arange(2*(n//2))
 
 def peak_shift(peaks, shift, n, max):
-    shifted_list = []
-    for peak in peaks:
-        temp_list = list(range(peak-shift-n//2, peak-shift+n//2))
-        if all(0 < x < max for x in temp_list):
-            shifted_list.append(temp_list)
-    return np.array(shifted_list)
+    starts = peak_starts(peaks, n, max, shift)
+    return starts[:, None] + np.arange(2*(n//2))
+
+def peak_windows(data, peaks, n, shift=0):
+    '''(n_windows, channels, 2*(n//2)) windows of data around peaks, as selected by peak_expand/peak_shift
+
+    Equivalent to data[peak_expand(peaks, n, len(data))] transposed to channels
+    first, gathered straight from a strided view without building index arrays.
+    Windows at arbitrary peaks cannot share one strided view, so this is the one
+    copy; it keeps the channels last memory order of data, which torch.from_numpy
+    wraps without another copy. Cast data (n, C) before slicing, not the windows.
+    With a tensor, the windows are gathered from data.unfold and stay a tensor.
+    '''
+    starts = peak_starts(peaks, n, len(data), shift)
+    if isinstance(data, torch.Tensor):
+        return window_view(data, 2*(n//2))[torch.from_numpy(starts)]
+    return window_view(data, 2*(n//2))[starts]
 
 def window_stack(data, window_size):
+    '''(n_windows, channels, window_size) consecutive windows of an (n, channels) tensor, a view of data'''
     n_windows = data.shape[0] // window_size
-    windowed_data = torch.stack([data[i: i+window_size] for i in range(0, n_windows*window_size, window_size)])
-    return windowed_data.transpose(1, 2)
-
-def filter_windows(all_windows):
-    '''shape: [n_window, window_width]'''
-    window_to_keep = np.ones(all_windows.shape[0])
-    avg = np.mean(all_windows, axis=0)
-    std = np.std(all_windows, axis=0)
-    for window_idx, window in enumerate(all_windows):
-        for idx, val in enumerate(window):
-            if np.abs(val-avg[idx]) > 3*std[idx]:
-                window_to_keep[window_idx] = 0
-    return window_to_keep
+    return window_view(data[:n_windows*window_size], window_size, window_size)
+
+def std_outliers(windows, threshold=3):
+    '''Samples further than threshold standard deviations from the mean window'''
+    return np.abs(windows - windows.mean(axis=0)) > threshold * windows.std(axis=0)
+
+def mad_outliers(windows, threshold=3):
+    '''Samples further than threshold robust deviations (1.4826 MAD) from the median window'''
+    median = np.median(windows, axis=0)
+    mad = np.median(np.abs(windows - median), axis=0)
+    return np.abs(windows - median) > threshold * 1.4826 * mad
+
+OUTLIER_CRITERIA = {'std': std_outliers,
+                    'mad': mad_outliers}
+
+def filter_windows(all_windows, threshold=3, criterion='std'):
+    '''Mask of the windows without outlier samples
+
+    A window is rejected if any of its samples is an outlier among the samples
+    at the same position (and channel) in all windows. With the default 'std'
+    criterion, further than 3 standard deviations from the mean window.
+
+    Args:
+        all_windows (np.ndarray): [n_window, window_width] or [n_window, n_ch, window_width]
+        threshold (float, optional): Defaults to 3.
+        criterion (str or callable, optional): 'std', 'mad' or a function
+            (windows, threshold) -> boolean outlier samples. Defaults to 'std'.
+
+    Returns:
+        np.ndarray: [n_window] boolean, True for the windows to keep
+    '''
+    all_windows = np.asarray(all_windows)
+    outliers = OUTLIER_CRITERIA.get(criterion, criterion)(all_windows, threshold)
+    return ~outliers.reshape(len(all_windows), -1).any(axis=1)